@@ -0,0 +1,9 @@
+"""
+Benchmarks for the proxy and its protocols.
+
+Each benchmark is a script that should be run from the repository root, for
+example::
+
+    python -m benchmarks.irc_latency
+
+"""
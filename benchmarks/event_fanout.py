@@ -0,0 +1,69 @@
+"""
+Measures sending the same events to several clients.
+
+A proxy's channel is filled with 1000 messages, then three clients, one
+after another, fetch them all with `get_events_after`, and each client's
+response is encoded, as XMLRPC and as JSON.  The time to make and encode
+each client's response is given, with the `EventCache` and without it
+(event_cache_bytes = 0).  Without it every client costs the same; with it
+only the first encodes the events, and the rest reuse its bytes.
+
+Run it with::
+
+    python -m benchmarks.event_fanout
+
+"""
+
+import gc
+import time
+
+from common import rpcformats
+from proxy.event import Event
+from common.securexmlrpc import dumps_response
+from proxy.eventcache import EventCache, EventMarshaller
+from benchmarks.rpc_dispatch import make_proxy
+from benchmarks.rpc_marshal import BATCH_SIZE, make_batch
+
+CLIENT_COUNT = 3
+REPEAT = 10
+
+def xml_response(proxy):
+    result = proxy._dispatch("get_events_after", ["0", BATCH_SIZE])
+    return dumps_response((result,), EventMarshaller)
+
+def json_response(proxy):
+    result = proxy._dispatch("get_events_after", ["0", BATCH_SIZE])
+    return rpcformats.dumps_response([(1, result)], False, "json")
+
+def client_times(respond, cache_bytes):
+    '''Return the best time of each client's response, in milliseconds.'''
+    best = [None] * CLIENT_COUNT
+    for i in xrange(REPEAT):
+        proxy = make_proxy()
+        if cache_bytes:
+            proxy.event_log.event_cache = EventCache(cache_bytes)
+        else:
+            proxy.event_log.event_cache = None
+        events = proxy.remote_irc_servers["bench"].channels["#bench"].events
+        for fields in make_batch()['events']:
+            del fields['seq']
+            fields['server'], fields['target'] = "bench", "#bench"
+            events.append(Event.from_dict(fields))
+        for client in xrange(CLIENT_COUNT):
+            gc.collect()  # Of the last run's proxy, not during this one
+            start = time.time()
+            respond(proxy)
+            elapsed = (time.time() - start) * 1000
+            if best[client] is None or elapsed < best[client]:
+                best[client] = elapsed
+    return best
+
+if __name__ == "__main__":
+    print "%-18s" % "" + "".join("%12s" % ("client %d ms" % (client + 1))
+                                 for client in xrange(CLIENT_COUNT))
+    for format, respond in [("xml", xml_response), ("json", json_response)]:
+        for name, cache_bytes in [("no cache", 0),
+                                  ("cache", 32*1024*1024)]:
+            print "%-18s" % ("%s, %s" % (format, name)) + "".join(
+                "%12.2f" % elapsed
+                for elapsed in client_times(respond, cache_bytes))
@@ -0,0 +1,70 @@
+"""
+Measures the memory used by 100,000 retained channel messages, stored as the
+dictionaries events used to be, and as `Event` records.
+
+Each message is parsed from its own line, as irclib does, so every event gets
+its own copies of the source, target and text strings unless they are
+interned.  Memory is the sum of `sys.getsizeof` over every distinct object
+reachable from the events, so strings and keys shared between events are
+counted once.
+
+    python -m benchmarks.event_memory
+
+"""
+
+import sys
+import time
+
+from proxy.event import Event
+
+EVENT_COUNT = 100000
+NICKS = 50
+CHANNELS = 5
+
+def irc_lines(count):
+    '''Yield (source, target, text), as split from a fresh line each time.'''
+    for i in xrange(count):
+        line = ":nick%d!user@host.example.com PRIVMSG #channel%d :message " \
+               "number %d from somebody" % (i % NICKS, i % CHANNELS, i)
+        prefix, command, target, text = line[1:].split(" ", 3)
+        yield prefix, target, text[1:]
+
+def dict_events(server_name):
+    return [{
+        'type': "pubmsg",
+        'time': time.time(),
+        'server': server_name,
+        'source': source,
+        'target': target,
+        'text': text,
+    } for source, target, text in irc_lines(EVENT_COUNT)]
+
+def record_events(server_name):
+    return [Event("pubmsg", time.time(), server_name, source, target, text)
+            for source, target, text in irc_lines(EVENT_COUNT)]
+
+def total_size(events):
+    '''Sum of sys.getsizeof over every distinct object in events.'''
+    seen = set()
+    size = sys.getsizeof(events)
+    def add(obj):
+        if id(obj) not in seen:
+            seen.add(id(obj))
+            return sys.getsizeof(obj)
+        return 0
+    for event in events:
+        size += add(event)
+        if isinstance(event, dict):
+            for key, value in event.iteritems():
+                size += add(key) + add(value)
+        else:
+            for name in Event.__slots__:
+                size += add(getattr(event, name))
+    return size
+
+if __name__ == "__main__":
+    server_name = "irc.example.com"
+    for name, build in (("dict", dict_events), ("Event", record_events)):
+        size = total_size(build(server_name))
+        print "%-6s %8.1f MB per 100k events   %4d bytes per event" % (
+            name, size * (100000.0 / EVENT_COUNT) / 2**20, size / EVENT_COUNT)
@@ -0,0 +1,48 @@
+"""
+Microbenchmark for `EventList.get_events_since` on large event lists.
+
+Measures how long it takes to fetch the newest few events from lists of 10^4,
+10^5 and 10^6 events, using the old linear scan and the current binary
+search::
+
+    python -m benchmarks.eventlist_since
+
+"""
+
+import timeit
+
+from proxy.eventlist import EventList
+
+SIZES = (10**4, 10**5, 10**6)
+NEW_EVENTS = 10
+
+def legacy_get_events_since(events, start_time):
+    '''get_events_since as it was before it used binary search.'''
+    event_list = []
+    for event in events[::-1]:
+        if event["time"] <= start_time:
+            return event_list
+        else:
+            event_list.append(event)
+    return event_list
+
+def build(size):
+    event_list = EventList()
+    for i in xrange(size):
+        event_list.append(type="pubmsg", text="hello", time=float(i))
+    return event_list
+
+def measure(func, repeat=5, number=20):
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+if __name__ == "__main__":
+    print "%10s %14s %14s" % ("events", "linear scan", "binary search")
+    for size in SIZES:
+        event_list = build(size)
+        since = float(size - NEW_EVENTS - 1)
+        assert len(event_list.get_events_since(since)) == NEW_EVENTS
+
+        events = event_list.get_events_since(-1)
+        old = measure(lambda: legacy_get_events_since(events, since))
+        new = measure(lambda: event_list.get_events_since(since))
+        print "%10d %11.1f us %11.1f us" % (size, old * 1e6, new * 1e6)
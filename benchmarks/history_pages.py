@@ -0,0 +1,47 @@
+"""
+Measures what fetching one page of 100 events from deep in a channel's
+history costs as the channel holds more events.
+
+Before `EventList.get_events_before`, the only way to page back was
+`get_event_slice`, which copied the whole list twice, reversed, to return a
+page.  Now a page costs the same however many events are kept::
+
+    python -m benchmarks.history_pages
+
+"""
+
+import timeit
+
+from proxy.eventlist import EventList, RetentionPolicy
+
+EVENT_COUNTS = (1000, 10000, 100000)
+PAGE = 100
+
+def build(event_count):
+    events = EventList(RetentionPolicy(max_events=event_count),
+                       target="#channel")
+    for i in xrange(event_count):
+        events.append(type="pubmsg", text="hello")
+    return events
+
+def legacy_slice(events, start_index, end_index):
+    '''get_event_slice as it was, with two reversed copies of the list.'''
+    with events._lock:
+        all_events = events._events(0, len(events._seqs))[::-1]
+    return all_events[start_index:end_index][::-1]
+
+def measure(func, repeat=5, number=20):
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+if __name__ == "__main__":
+    print "%9s %14s %14s" % ("events", "legacy slice", "before cursor")
+    for event_count in EVENT_COUNTS:
+        events = build(event_count)
+        # The page halfway back through the list
+        start = event_count // 2
+        seq = events.get_event_slice(start - 1, start)[0].seq
+        assert [e.seq for e in legacy_slice(events, start, start + PAGE)] == \
+               [e.seq for e in events.get_events_before(seq, PAGE)]
+        old = measure(lambda: legacy_slice(events, start, start + PAGE))
+        new = measure(lambda: events.get_events_before(seq, PAGE))
+        print "%9d %11.1f us %11.1f us" % (event_count, old * 1e6, new * 1e6)
@@ -0,0 +1,154 @@
+"""
+Measures the latency from an IRC line arriving at the proxy to a proxy client
+seeing it as an event.
+
+A fake IRC server is started on localhost, a real `IRCProxyServer` connects to
+it, and a client polls `get_events_since` back to back while the fake server
+sends PRIVMSG lines.  The proxy is run with both the old polling main loop
+(`handle_request` then `process_once`, each with a 0.1 second timeout) and the
+reactor main loop.
+
+The proxy needs a certificate, so generate one first::
+
+    cd keys && python generate_keys.py proxy && cd ..
+    python -m benchmarks.irc_latency
+
+"""
+
+import socket
+import threading
+import time
+import xmlrpclib
+import ssl
+
+from proxy import IRCProxyServer
+from proxy.proxy import _TestConf
+from common import securexmlrpc
+
+MESSAGE_COUNT = 100
+
+# Seconds to wait for the proxy to connect, and for each message to be seen,
+# before giving up
+TIMEOUT = 10
+
+class BenchConf(_TestConf):
+    cert_file = "keys/proxy_cert.pem"
+    key_file = "keys/proxy_key.pem"
+
+class FakeIRCServer(object):
+    '''Accepts one IRC connection and sends it timestamped PRIVMSG lines.'''
+
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.sock = None
+        self.ready = threading.Event()
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        self.sock, address = self.listener.accept()
+        self.sock.sendall(":fake 001 bench :Welcome\r\n")
+        self.ready.set()
+
+    def send_message(self, text):
+        '''Send a channel message and return the time it was sent.'''
+        t = time.time()
+        self.sock.sendall(":alice!a@localhost PRIVMSG #bench :%s\r\n" % text)
+        return t
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+        self.listener.close()
+
+def legacy_loop_iteration(proxy):
+    '''The main loop iteration the proxy used before the reactor.
+
+    The proxy now connects to IRC servers in the background, and hands the
+    results to the reactor with call_soon_threadsafe, so those calls, and the
+    reactor's timers, are run too.  The reactor doesn't wait for, or handle,
+    any files.
+
+    '''
+    proxy.xmlrpc_server.timeout = 0.1
+    proxy.xmlrpc_server.handle_request()
+    proxy.irc_client.process_once(0.1)
+    proxy.reactor._run_threadsafe_calls()
+    proxy.reactor._run_due_timers()
+
+def reactor_loop_iteration(proxy):
+    proxy._loop_iteration(timeout=0.5)
+
+def run_proxy(proxy, loop_iteration, stop):
+    while not stop.is_set():
+        loop_iteration(proxy)
+
+def measure(loop_iteration):
+    irc_server = FakeIRCServer()
+    proxy = IRCProxyServer(BenchConf())
+    if loop_iteration is legacy_loop_iteration:
+        # Don't let the reactor own the listening socket
+        proxy.reactor.remove_reader(proxy.xmlrpc_server)
+        # Nor keep connections open.  handle_request would go on serving a
+        # kept connection, and never get back to IRC.
+        proxy.xmlrpc_server.idle_timeout = None
+    stop = threading.Event()
+    thread = threading.Thread(target=run_proxy,
+                              args=(proxy, loop_iteration, stop))
+    thread.daemon = True
+    thread.start()
+
+    port = proxy.xmlrpc_server.server_address[1]
+    client = xmlrpclib.ServerProxy("https://127.0.0.1:%s/" % port,
+        transport = securexmlrpc.HTTPSTransport(cert_reqs=ssl.CERT_NONE))
+
+    latencies = []
+    try:
+        client.server_connect("bench", "bench", "127.0.0.1", irc_server.port)
+        client.channel_join("bench", "#bench")
+        if not irc_server.ready.wait(TIMEOUT):
+            raise RuntimeError("The proxy didn't connect to the IRC server")
+        last_time = time.time()
+
+        for i in xrange(MESSAGE_COUNT):
+            text = "message %s" % i
+            sent_at = irc_server.send_message(text)
+            seen = False
+            while not seen:
+                if time.time() > sent_at + TIMEOUT:
+                    raise RuntimeError("%r wasn't seen in %s seconds"
+                                       % (text, TIMEOUT))
+                for event in client.get_events_since(last_time):
+                    last_time = max(last_time, event['time'])
+                    if event.get('text') == text:
+                        latencies.append(time.time() - sent_at)
+                        seen = True
+
+        client.server_disconnect("bench")
+    finally:
+        stop.set()
+        thread.join()
+        proxy.xmlrpc_server.server_close()
+        irc_server.close()
+
+    return latencies
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    def percentile(p):
+        return latencies[min(len(latencies)-1, int(len(latencies) * p))]
+    print "%-8s median %7.2f ms   p95 %7.2f ms   max %7.2f ms" % (
+        name,
+        percentile(0.5) * 1000,
+        percentile(0.95) * 1000,
+        latencies[-1] * 1000,
+    )
+
+if __name__ == "__main__":
+    report("legacy", measure(legacy_loop_iteration))
+    report("reactor", measure(reactor_loop_iteration))
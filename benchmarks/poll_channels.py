@@ -0,0 +1,55 @@
+"""
+Measures what a client's poll for new events costs as the number of channels
+grows.
+
+Each channel has 100 events, and a poll asks for everything after the newest
+one (so nothing is returned), or after the newest 10 events.  Before the
+global event log, a poll asked every channel's list in turn, then sorted the
+results.  Now it is one read from the tail of the log::
+
+    python -m benchmarks.poll_channels
+
+"""
+
+import timeit
+from operator import attrgetter
+
+from proxy.eventlist import EventList, EventLog
+
+CHANNEL_COUNTS = (10, 100, 1000)
+EVENTS_PER_CHANNEL = 100
+
+def build(channel_count):
+    log = EventLog()
+    channels = [EventList(log=log, target="#channel%d" % i)
+                for i in xrange(channel_count)]
+    for i in xrange(EVENTS_PER_CHANNEL):
+        for channel in channels:
+            channel.append(type="pubmsg", text="hello")
+    return log, channels
+
+def legacy_poll(log, channels, seq, limit=1000):
+    '''get_events_after as it was before the global event log.'''
+    last_seq = log.last_seq()
+    events = []
+    for channel in channels:
+        events.extend(channel.get_events_after(seq, limit, last_seq))
+    events.sort(key=attrgetter("seq"))
+    return events[:limit]
+
+def measure(func, repeat=5, number=20):
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+if __name__ == "__main__":
+    print "%9s %10s %14s %14s" % ("channels", "new events", "every list",
+                                  "log tail")
+    for channel_count in CHANNEL_COUNTS:
+        log, channels = build(channel_count)
+        for new in (0, 10):
+            seq = log.last_seq() - new
+            assert len(legacy_poll(log, channels, seq)) == new
+            assert len(log.get_events_after(seq, 1000)[0]) == new
+            old = measure(lambda: legacy_poll(log, channels, seq))
+            tail = measure(lambda: log.get_events_after(seq, 1000))
+            print "%9d %10d %11.1f us %11.1f us" % (channel_count, new,
+                                                    old * 1e6, tail * 1e6)
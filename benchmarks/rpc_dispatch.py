@@ -0,0 +1,57 @@
+"""
+Measures the per-call overhead of routing an RPC call to its method.
+
+A proxy is made with one IRC server and one channel, neither connected.
+For a method of each kind (an `IRCProxyServer` method, a `RemoteIRCServer`
+method and a `RemoteIRCChannel` method), calling it through
+`IRCProxyServer._dispatch` is timed against calling it directly.  The
+difference is what finding the method and checking its arguments costs.
+Encoding and sending requests aren't included.
+
+The asyncio engine's proxy is used, as it needs no IRC library, but its
+dispatching is the same as the reactor engine's.  Run it with::
+
+    python -m benchmarks.rpc_dispatch
+
+"""
+
+import timeit
+
+from proxy.asyncengine import AsyncIRCProxyServer
+from proxy.remoteircserver import RemoteIRCServer
+from benchmarks.irc_latency import BenchConf
+
+CALL_COUNT = 100000
+
+def make_proxy():
+    proxy = AsyncIRCProxyServer(BenchConf())
+    server = RemoteIRCServer(None, "bench", "bench", "127.0.0.1", 6667,
+                             retention=proxy.retention,
+                             event_log=proxy.event_log)
+    proxy.remote_irc_servers["bench"] = server
+    server.channel_join("#bench")
+    return proxy
+
+def per_call(func):
+    '''Return the best of a few runs' microseconds per call of func.'''
+    return min(timeit.repeat(func, number=CALL_COUNT, repeat=3)) \
+        / CALL_COUNT * 1e6
+
+if __name__ == "__main__":
+    proxy = make_proxy()
+    server = proxy.remote_irc_servers["bench"]
+    channel = server.channels["#bench"]
+    calls = [
+        ("server_list", (), proxy.server_list),
+        ("server_state", ("bench",), server.state),
+        ("channel_history", ("bench", "#bench", "", 1),
+         lambda: channel.history("", 1)),
+    ]
+
+    print "%-18s %12s %12s %12s" % ("", "direct us", "dispatch us",
+                                    "overhead us")
+    for method, params, direct in calls:
+        direct_time = per_call(direct)
+        dispatch_time = per_call(lambda: proxy._dispatch(method, params))
+        print "%-18s %12.2f %12.2f %12.2f" % (method, direct_time,
+            dispatch_time, dispatch_time - direct_time)
@@ -0,0 +1,80 @@
+"""
+Measures encoding and decoding a batch of events in each RPC format.
+
+The batch is what `get_events_after` returns for a busy channel: 1000
+messages, with a few joins and parts, as the proxy sends them.  For each of
+XMLRPC, JSON and (if the msgpack module is installed) msgpack, the proxy's
+side (encoding the response) and the client's (decoding it) are timed
+separately, and the size of the response is given.
+
+Run it from the top of the repository::
+
+    python -m benchmarks.rpc_marshal
+
+"""
+
+import time
+import random
+import xmlrpclib
+
+from common import rpcformats
+from proxy.event import Event
+
+BATCH_SIZE = 1000
+REPEAT = 20
+
+WORDS = ("the", "proxy", "channel", "is", "down", "again", "lol", "anyone",
+         "know", "why", "build", "fails", "on", "my", "machine", "works",
+         "http://example.com/some/long/path", "ok", "thanks", ":)")
+
+def make_batch():
+    random.seed(1)
+    events = []
+    for seq in xrange(1, BATCH_SIZE + 1):
+        nick = "user%d" % random.randint(1, 40)
+        source = "%s!~%s@host-%d.example.net" % (nick, nick, len(nick))
+        if random.random() < 0.05:
+            event = Event(random.choice(("join", "part")), time.time(),
+                          "freenode", source, "#python", seq=seq)
+        else:
+            text = " ".join(random.choice(WORDS)
+                            for i in xrange(random.randint(3, 20)))
+            event = Event("pubmsg", time.time(), "freenode", source,
+                          "#python", text, seq=seq)
+        events.append(event.to_dict())
+    return {'events': events, 'cursor': str(BATCH_SIZE)}
+
+def xml_encode(result):
+    return xmlrpclib.dumps((result,), methodresponse=1)
+
+def xml_decode(data):
+    return xmlrpclib.loads(data)[0][0]
+
+def format_coder(format):
+    encode = lambda result: rpcformats.dumps_response([(1, result)], False,
+                                                      format)
+    decode = lambda data: rpcformats.loads_response(data, format)
+    return encode, decode
+
+def best_time(func, arg):
+    best = None
+    for i in xrange(REPEAT):
+        start = time.time()
+        func(arg)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == "__main__":
+    batch = make_batch()
+    coders = [("xml", xml_encode, xml_decode)]
+    for format in sorted(rpcformats.AVAILABLE_FORMATS):
+        coders.append((format,) + format_coder(format))
+
+    print "%-10s %12s %12s %10s" % ("", "encode ms", "decode ms", "KB")
+    for name, encode, decode in coders:
+        data = encode(batch)
+        assert decode(data) == batch
+        print "%-10s %12.2f %12.2f %10.1f" % (
+            name, best_time(encode, batch) * 1000,
+            best_time(decode, data) * 1000, len(data) / 1024.0)
@@ -0,0 +1,117 @@
+"""
+Measures TLS handshakes: CPU time each, and connections per second.
+
+A server thread accepts connections and does the server side of the
+handshake, either with `ssl.wrap_socket` and the certificate files, as
+every connection did before `SSLContextCache`, or with the cached context.
+A client connects, finishes the handshake and disconnects, over and over.
+The CPU time is the whole process's, both ends, divided by the number of
+connections.
+
+Python 2.7 clients can't resume TLS sessions, so resumption is checked
+separately, if openssl is installed: `openssl s_client -reconnect` connects
+to the cached context's server a few times, and the number of connections
+that resumed their session is reported.  (Its CPU time would mostly be
+starting openssl.)
+
+The server needs a certificate, so generate one first::
+
+    cd keys && python generate_keys.py proxy && cd ..
+    python -m benchmarks.tls_handshake
+
+"""
+
+import os
+import ssl
+import time
+import socket
+import threading
+import subprocess
+
+from common import securexmlrpc
+
+CONNECTION_COUNT = 300
+
+# Times `openssl s_client -reconnect` is run.  It connects 6 times each run.
+OPENSSL_RUNS = 5
+
+CERT_FILE = "keys/proxy_cert.pem"
+KEY_FILE = "keys/proxy_key.pem"
+
+def file_wrap(sock):
+    return ssl.wrap_socket(sock,
+                           server_side = True,
+                           certfile = CERT_FILE,
+                           keyfile = KEY_FILE,
+                           cert_reqs = ssl.CERT_NONE,
+                           ssl_version = ssl.PROTOCOL_TLSv1)
+
+def start_server(wrap):
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(16)
+
+    def serve():
+        while True:
+            sock, address = listener.accept()
+            try:
+                sock = wrap(sock)
+                sock.recv(1)  # Until the client closes
+            except (socket.error, ssl.SSLError):
+                pass
+            sock.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return listener.getsockname()[1]
+
+def python_client(port, count):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+    for i in xrange(count):
+        sock = context.wrap_socket(
+            socket.create_connection(("127.0.0.1", port)))
+        sock.close()
+
+def measure(wrap):
+    port = start_server(wrap)
+    cpu_start = os.times()
+    start = time.time()
+    python_client(port, CONNECTION_COUNT)
+    elapsed = time.time() - start
+    cpu_end = os.times()
+    cpu = cpu_end[0] + cpu_end[1] - cpu_start[0] - cpu_start[1]
+    return cpu / CONNECTION_COUNT * 1000, CONNECTION_COUNT / elapsed
+
+def openssl_resumed(contexts):
+    """Return (sessions resumed, connections) for openssl reconnecting, or
+    None if openssl isn't installed."""
+    port = start_server(contexts.wrap_socket)
+    hits = contexts.get().session_stats()["hits"]
+    devnull = open(os.devnull, "w")
+    connections = 0
+    for i in xrange(OPENSSL_RUNS):
+        try:
+            subprocess.call(["openssl", "s_client", "-tls1", "-reconnect",
+                             "-connect", "127.0.0.1:%d" % port],
+                            stdin=devnull, stdout=devnull, stderr=devnull)
+        except OSError:
+            return None
+        connections += 6
+    return contexts.get().session_stats()["hits"] - hits, connections
+
+if __name__ == "__main__":
+    contexts = securexmlrpc.SSLContextCache(
+        server_side = True,
+        certfile = CERT_FILE,
+        keyfile = KEY_FILE,
+        cert_reqs = ssl.CERT_NONE,
+    )
+    print "%-20s %16s %15s" % ("", "CPU ms/handshake", "connections/s")
+    for name, wrap in [("wrap_socket, files", file_wrap),
+                       ("cached context", contexts.wrap_socket)]:
+        print "%-20s %16.2f %15.0f" % ((name,) + measure(wrap))
+
+    resumed = openssl_resumed(contexts)
+    if resumed is not None:
+        print "openssl sessions resumed: %d of %d connections" % resumed
@@ -0,0 +1,63 @@
+"""
+Measures XMLRPC requests per second with and without connection reuse.
+
+A `SecureXMLRPCServer` with an `idle_timeout` serves a method that does
+nothing, and an `HTTPSTransport` calls it back to back.  With reuse, every
+call goes over one kept connection.  Without, the transport is closed after
+each call, so each one pays for a new TCP connection and TLS handshake, as
+every request did before keep-alive.
+
+The server needs a certificate, so generate one first::
+
+    cd keys && python generate_keys.py proxy && cd ..
+    python -m benchmarks.xmlrpc_keepalive
+
+"""
+
+import ssl
+import time
+import threading
+import xmlrpclib
+
+from common import securexmlrpc
+
+REQUEST_COUNT = 500
+
+def start_server():
+    server = securexmlrpc.SecureXMLRPCServer(
+        ("127.0.0.1", 0),
+        certfile = "keys/proxy_cert.pem",
+        keyfile = "keys/proxy_key.pem",
+        cert_reqs = ssl.CERT_NONE,
+        idle_timeout = 60,
+        logRequests = False,
+    )
+    server.register_function(lambda: True, "ping")
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def requests_per_second(port, reuse):
+    transport = securexmlrpc.HTTPSTransport(cert_reqs=ssl.CERT_NONE)
+    proxy = xmlrpclib.ServerProxy("https://127.0.0.1:%d" % port, transport)
+    start = time.time()
+    for i in xrange(REQUEST_COUNT):
+        proxy.ping()
+        if not reuse:
+            transport.close()
+    elapsed = time.time() - start
+    transport.close()
+    return REQUEST_COUNT / elapsed
+
+if __name__ == "__main__":
+    server = start_server()
+    port = server.socket.getsockname()[1]
+    # The server handles one connection at a time, so each run's connection
+    # has to be closed before the next starts
+    print "%-20s %10s" % ("", "requests/s")
+    print "%-20s %10.0f" % ("new connection each",
+                            requests_per_second(port, False))
+    print "%-20s %10.0f" % ("reused connection",
+                            requests_per_second(port, True))
+    server.shutdown()
@@ -1,15 +1,25 @@
 
 from multiprocessing import Process, Pipe
+from urlparse import urlparse
 import xmlrpclib
 import time
 import os.path
 import socket
+import json
+import ssl
 from sys import exit
 
 from interfaces import WXInterface
 from formatter import Formatter
 from common import securexmlrpc
 from common import config
+from common.streamframes import FORMATS, FrameReader, pack_frame
+
+# Most events fetched from the proxy in one request.
+EVENT_BATCH_SIZE = 1000
+
+# Seconds the proxy is asked to wait for new events before replying with none.
+EVENT_WAIT_TIMEOUT = 30
 
 class IRCProxyClient(object):
 
@@ -29,19 +39,31 @@ class IRCProxyClient(object):
             raise RuntimeError('accepted_certs_file "%s" not found!' % conf.accepted_certs_file)
 
         #TODO: proxy and port need to be parsed more robustly with urlparse
-        self.proxy = xmlrpclib.ServerProxy(
+        self.proxy = securexmlrpc.ServerProxy(
             "%s:%s/" % (self.proxy_address, self.proxy_port),
             transport = securexmlrpc.HTTPSTransport(
                 certfile = conf.cert_file,
                 keyfile = conf.key_file,
                 ca_certs = conf.accepted_certs_file,
+                format = conf.proxy_format,
             )
         )
 
-        # Start event subprocess
+        # Start event subprocess.  Events are pushed over the proxy's event
+        # stream if it has one, otherwise they are fetched with XMLRPC.
         self.event_pipe, child_conn = Pipe()
-        self.event_process = Process(target=event_loop, args=(self.proxy,
-                                     child_conn,))
+        if conf.proxy_stream_port:
+            self.event_process = Process(target=stream_loop, args=(
+                (urlparse(self.proxy_address).hostname or self.proxy_address,
+                 conf.proxy_stream_port),
+                conf.cert_file,
+                conf.key_file,
+                conf.accepted_certs_file,
+                child_conn,
+            ))
+        else:
+            self.event_process = Process(target=event_loop, args=(self.proxy,
+                                         child_conn,))
         self.event_process.start()
 
     def get_events(self):
@@ -158,14 +180,19 @@ class IRCProxyClient(object):
                         print "Wrong number of args"
 
                 elif command == "join":
-                    if len(args) != 1:
+                    # "/join #a #b" or "/join #a,#b" joins several at once
+                    channel_names = [name for arg in args
+                                     for name in arg.split(",") if name]
+                    if not channel_names:
                         #TODO: Print useage message
                         print "Wrong number of args"
                     elif not server:
                         #TODO: Print useage message
                         print "You must connect a server before joining a channel"
+                    elif len(channel_names) == 1:
+                        self.proxy.channel_join(server, channel_names[0])
                     else:
-                        self.proxy.channel_join(server, args[0])
+                        self.proxy.channel_join_many(server, channel_names)
 
                 elif command == "leave" or command == "part":
                     if not server or not channel:
@@ -181,9 +208,13 @@ class IRCProxyClient(object):
                     print "Warning: Bad command!"
                     pass #TODO: Invalid command, provide help!
 
-            # Privmsg
+            # Privmsg.  Pasted lines are sent in one request.
             elif server and channel:
-                self.proxy.channel_message(server, channel, command_string)
+                lines = [line for line in command_string.splitlines() if line]
+                if len(lines) > 1:
+                    self.proxy.channel_message_many(server, channel, lines)
+                elif lines:
+                    self.proxy.channel_message(server, channel, lines[0])
 
             # Nothing
             else:
@@ -204,16 +235,18 @@ class IRCProxyClient(object):
 
 
 def event_loop(proxy_server, pipe):
-    last_event_time = 0
+    cursor = "0"
     last_error = None
     while True:
+        events = []
         try:
 
-            events = proxy_server.get_events_since(last_event_time)
+            result = proxy_server.wait_for_events(cursor, EVENT_WAIT_TIMEOUT,
+                                                  EVENT_BATCH_SIZE)
+            events = result['events']
+            cursor = result['cursor']
             if events:
-                events.sort(key=lambda x:x['time'])
                 pipe.send(events)
-                last_event_time = events[-1]['time']
             if last_error != None:
                 #TODO: Log
                 print "Connection to proxy resumed!"
@@ -231,7 +264,71 @@ def event_loop(proxy_server, pipe):
             pipe.send(_KillSignal())
             raise
 
-        time.sleep(2)
+        # Nothing waits after an error, so don't ask again straight away
+        if last_error is not None:
+            time.sleep(2)
+
+def stream_loop(address, cert_file, key_file, accepted_certs_file, pipe):
+    '''Like event_loop, but has events pushed over the proxy's event stream.
+
+    After the connection drops, it reconnects and resumes from the last
+    cursor it got.
+
+    '''
+    format = "msgpack" if "msgpack" in FORMATS else "json"
+    loads = FORMATS[format][1]
+    cursor = "0"
+    last_error = None
+    ssl_contexts = securexmlrpc.SSLContextCache(
+        certfile = cert_file,
+        keyfile = key_file,
+        cert_reqs = ssl.CERT_REQUIRED,
+        ca_certs = accepted_certs_file,
+        ssl_version = ssl.PROTOCOL_TLSv1,
+    )
+    while True:
+        sock = None
+        try:
+
+            sock = ssl_contexts.wrap_socket(socket.create_connection(address))
+            sock.sendall(pack_frame(json.dumps({
+                'format': format,
+                'cursor': cursor,
+            })))
+            reader = FrameReader()
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    raise socket.error("Proxy closed the event stream.")
+                for frame in reader.feed(data):
+                    result = loads(frame)
+                    if 'error' in result:
+                        raise RuntimeError("Proxy refused the event stream: "
+                                           "%s" % result['error'])
+                    if result['events']:
+                        pipe.send(result['events'])
+                    cursor = result['cursor']
+                    if last_error != None:
+                        #TODO: Log
+                        print "Connection to proxy resumed!"
+                        last_error = None
+
+        # Fail gracefully when proxy cannot be accessed
+        except (socket.error, ssl.SSLError) as e:
+            if str(e) != str(last_error):  # Ignore repeat errors
+                #TODO: Log
+                print "Unable to reach proxy:", e
+                last_error = e
+            time.sleep(2)
+
+        # Kill superprocess before raising
+        except Exception as e:
+            pipe.send(_KillSignal())
+            raise
+
+        finally:
+            if sock:
+                sock.close()
 
 class _KillSignal(Exception):
     '''Sent between processes to indicate that the recipienc should exit.'''
@@ -40,6 +40,21 @@ class Formatter(object):
     print_event_luserlist = print_event_welcome
     print_event_motd = print_event_welcome
 
+    def print_event_server_connecting(self, event):
+        return "Connecting to %s (attempt %s)...\n" % (event['server'],
+                                                       event['attempt'])
+
+    def print_event_server_connect_failed(self, event):
+        return "Could not connect to %s: %s\n" % (event['server'],
+                                                  event['text'])
+
+    def print_event_server_connection_lost(self, event):
+        return "Lost connection to %s: %s\n" % (event['server'],
+                                                event['text'])
+
+    def print_event_history_truncated(self, event):
+        return "(Older events are no longer kept by the proxy)\n"
+
     def print_event_channel_join(self, event):
         return "%s joined %s\n" % (event['user'], event['target'])
 
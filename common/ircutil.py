@@ -1,4 +1,6 @@
 
+import unittest
+
 def chan_validate(channel_name):
     '''Returns the channel_name.  Raises ValueError if name is invalid.
 
@@ -29,3 +31,113 @@ def nick_split(full_nick):
     else:
         raise ValueError('Invalid Nickname: "%s".' % full_nick)
     return nick, location
+
+def join_batches(channel_names, max_length=510):
+    '''Group channel names into as few comma separated JOIN targets as fit.
+
+    Returns a list of strings like "#a,#b,#c", each short enough that
+    "JOIN <targets>" fits in an IRC line of max_length bytes (512 including
+    the trailing CRLF).
+
+    '''
+    batches = []
+    batch = []
+    length = len("JOIN ")
+    for name in channel_names:
+        added = len(name) + (1 if batch else 0)
+        if batch and length + added > max_length:
+            batches.append(",".join(batch))
+            batch = []
+            length = len("JOIN ")
+            added = len(name)
+        batch.append(name)
+        length += added
+    if batch:
+        batches.append(",".join(batch))
+    return batches
+
+# Servers put ":nick!user@host " in front of each message they pass on, and
+# the whole line must still fit.  Besides the nick, allow for the longest
+# usual user (USERLEN of 10, plus a "~") and host (HOSTLEN of 63).
+_PREFIX_BYTES = len(":!%s@%s " % ("u" * 11, "h" * 63))
+
+def _utf8(string):
+    if isinstance(string, unicode):
+        return string.encode("utf-8")
+    return string
+
+def max_message_bytes(nick, target, command="PRIVMSG"):
+    '''Return how many bytes of text fit in one command to target sent by
+    nick, once a server passes it on as
+    ":nick!user@host <command> <target> :<text>", in 512 bytes including the
+    trailing CRLF.'''
+    return 510 - _PREFIX_BYTES - len(_utf8(nick)) - \
+        len("%s %s :" % (command, _utf8(target)))
+
+def split_message(text, max_bytes):
+    '''Split text into lines of at most max_bytes bytes of UTF-8 each.
+
+    Text is split at its line breaks first, and empty lines are dropped, as
+    IRC can't send them.  Longer lines are split at the last space that fits,
+    which is dropped, unless that is in the first half of the line, in which
+    case the line is split between two characters.  A UTF-8 character is
+    never split.
+
+    Returns a list of strings of the same type as text.
+
+    '''
+    pieces = []
+    for line in _utf8(text).splitlines():
+        while len(line) > max_bytes:
+            cut = line.rfind(" ", 0, max_bytes + 1)
+            if cut > max_bytes // 2:
+                pieces.append(line[:cut])
+                line = line[cut+1:]
+                continue
+            # Back up to the start of a character: a byte that isn't
+            # 0b10xxxxxx
+            cut = max_bytes
+            while cut > 0 and 0x80 <= ord(line[cut]) < 0xc0:
+                cut -= 1
+            cut = cut or max_bytes
+            pieces.append(line[:cut])
+            line = line[cut:]
+        if line:
+            pieces.append(line)
+    if isinstance(text, unicode):
+        return [piece.decode("utf-8") for piece in pieces]
+    return pieces
+
+
+class TestSplitMessage(unittest.TestCase):
+
+    def test_short(self):
+        self.assertEquals(split_message("hi there", 20), ["hi there"])
+        self.assertEquals(split_message("a\r\n\nb\n", 20), ["a", "b"])
+        self.assertEquals(split_message("", 20), [])
+
+    def test_words(self):
+        self.assertEquals(split_message("one two three four", 9),
+                          ["one two", "three", "four"])
+        self.assertEquals(split_message("a abcdefghij", 5),
+                          ["a abc", "defgh", "ij"])
+
+    def test_utf8(self):
+        text = u"\xe9\u20ac" * 5  # 2 and 3 bytes
+        pieces = split_message(text, 6)
+        self.assertEquals(u"".join(pieces), text)
+        for piece in pieces:
+            self.assertTrue(len(piece.encode("utf-8")) <= 6)
+        self.assertEquals(pieces[0], u"\xe9\u20ac")
+        self.assertEquals(split_message(text.encode("utf-8"), 6)[0],
+                          u"\xe9\u20ac".encode("utf-8"))
+
+    def test_max_message_bytes(self):
+        nick, target = "bob", "#chan"
+        length = max_message_bytes(nick, target)
+        line = ":%s!~%s@%s PRIVMSG %s :%s\r\n" % (nick, "u" * 10, "h" * 63,
+                                                 target, "x" * length)
+        self.assertEquals(len(line), 512)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,287 @@
+"""Encodings, besides XML, for the proxy's RPC requests and responses.
+
+Building and parsing XML is slow, and event batches are large, so the proxy
+also takes requests in JSON, and (if the msgpack module is installed on both
+ends) msgpack.  They are sent to the same port and path as XMLRPC, and the
+request's Content-Type says which encoding it is in:
+
+    ======================= ========
+    Content-Type            Encoding
+    ======================= ========
+    text/xml                XMLRPC
+    application/json        JSON
+    application/msgpack     msgpack
+    ======================= ========
+
+The response is in the same encoding, with the same Content-Type.  In JSON
+and msgpack, requests and responses are shaped like JSON-RPC 2.0's::
+
+    {"jsonrpc": "2.0", "method": "server_list", "params": [], "id": 1}
+    {"jsonrpc": "2.0", "result": ["freenode"], "id": 1}
+    {"jsonrpc": "2.0", "error": {"code": 2, "message": "..."}, "id": 1}
+
+The methods, their arguments and their results are the same as over XMLRPC,
+and error codes are the XMLRPC fault codes.  A list of requests is a batch,
+answered with a list of responses, in the same order.  Unlike JSON-RPC,
+every request is answered, whether or not it has an id.
+
+"""
+
+import sys
+import xmlrpclib
+import traceback
+import unittest
+from xmlrpclib import Fault
+from StringIO import StringIO
+
+from common.streamframes import FORMATS
+
+__all__ = [
+    "CONTENT_TYPES",
+    "AVAILABLE_FORMATS",
+    "format_for",
+    "dumps_request",
+    "loads_response",
+    "parse_request",
+    "dumps_response",
+    "marshaled_dispatch",
+]
+
+# Content-Type of each encoding's requests and responses
+CONTENT_TYPES = {
+    "json": "application/json",
+    "msgpack": "application/msgpack",
+}
+
+# Encodings that can be used here
+AVAILABLE_FORMATS = frozenset(CONTENT_TYPES) & frozenset(FORMATS)
+
+_FORMATS_BY_TYPE = {
+    "application/json": "json",
+    "application/msgpack": "msgpack",
+    "application/x-msgpack": "msgpack",
+}
+
+# JSON-RPC's error codes, for requests that can't be answered at all
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+
+# What a call that raised anything but a Fault returns, in every format and
+# from both of the proxy's engines.  The error itself is only logged.
+_UNEXPECTED_FAULT = Fault(3, "Proxy server received an unexpected error.  "
+                             "See log file for details.")
+
+def format_for(content_type):
+    '''Return the encoding of a request with content_type, or None if it is
+    XMLRPC (or an encoding that isn't available).'''
+    content_type = content_type.partition(";")[0].strip().lower()
+    format = _FORMATS_BY_TYPE.get(content_type)
+    return format if format in AVAILABLE_FORMATS else None
+
+def dumps_request(method, params, format):
+    '''Return a request calling method with params.'''
+    return FORMATS[format][0]({
+        'jsonrpc': "2.0",
+        'method': method,
+        'params': list(params),
+        'id': 1,
+    })
+
+def loads_response(data, format):
+    '''Return the result of a response to a request from `dumps_request`,
+    raising Fault if it is an error.'''
+    try:
+        response = FORMATS[format][1](data)
+    except ValueError as e:
+        raise xmlrpclib.ResponseError("Invalid %s response: %s" %
+                                      (format, e))
+    if not isinstance(response, dict) or \
+            ("result" not in response and "error" not in response):
+        raise xmlrpclib.ResponseError("Invalid %s response." % format)
+    error = response.get("error")
+    if error is not None:
+        if not isinstance(error, dict):
+            raise xmlrpclib.ResponseError("Invalid %s error." % format)
+        raise Fault(error.get("code", 0), error.get("message", ""))
+    return response["result"]
+
+def parse_request(data, format):
+    '''Parse a request, or a batch of them.
+
+    :returns:
+        (calls, batch).  calls is a list of (id, call), where call is either
+        (method, params) or, if the request is invalid, a Fault.  batch is
+        whether the requests were in a list.
+
+    :raises Fault:
+        If data can't be decoded at all.
+
+    '''
+    try:
+        requests = FORMATS[format][1](data)
+    except Exception:
+        raise Fault(PARSE_ERROR, "Request is not valid %s." % format)
+    batch = isinstance(requests, list)
+    if not batch:
+        requests = [requests]
+    elif not requests:
+        raise Fault(INVALID_REQUEST, "Batch is empty.")
+
+    calls = []
+    for request in requests:
+        if not isinstance(request, dict):
+            calls.append((None, Fault(INVALID_REQUEST,
+                                      "Request must be an object.")))
+            continue
+        request_id = request.get("id")
+        method = request.get("method")
+        params = request.get("params", [])
+        if not isinstance(method, basestring):
+            call = Fault(INVALID_REQUEST, "Request method must be a string.")
+        elif not isinstance(params, list):
+            call = Fault(INVALID_REQUEST, "Request params must be a list.")
+        else:
+            call = (method, params)
+        calls.append((request_id, call))
+    return calls, batch
+
+def dumps_response(results, batch, format):
+    '''Return the response to a request from `parse_request`.
+
+    :param results:
+        List of (id, result), where result is a Fault for calls that failed.
+
+    '''
+    responses = []
+    for request_id, result in results:
+        response = {'jsonrpc': "2.0", 'id': request_id}
+        if isinstance(result, Fault):
+            response['error'] = {
+                'code': result.faultCode,
+                'message': result.faultString,
+            }
+        else:
+            response['result'] = result
+        responses.append(response)
+    return FORMATS[format][0](responses if batch else responses[0])
+
+def marshaled_dispatch(data, format, dispatch):
+    '''Like SimpleXMLRPCDispatcher._marshaled_dispatch, for a request in
+    format.
+
+    :param dispatch:
+        Function taking a method name and list of parameters, that makes
+        the call, and returns its result or raises a Fault.  Any other
+        exception it raises is logged, and the call answered with fault 3,
+        which says no more than that there was an error.
+
+    '''
+    try:
+        calls, batch = parse_request(data, format)
+    except Fault as fault:
+        return dumps_response([(None, fault)], False, format)
+    results = []
+    for request_id, call in calls:
+        try:
+            if isinstance(call, Fault):
+                raise call
+            result = dispatch(*call)
+        except Fault as fault:
+            result = fault
+        except Exception:
+            #TODO: Log
+            traceback.print_exc()
+            result = _UNEXPECTED_FAULT
+        results.append((request_id, result))
+    return dumps_response(results, batch, format)
+
+
+class TestRPCFormats(unittest.TestCase):
+
+    def dispatch(self, method, params):
+        if method == "echo":
+            return params
+        if method == "fail":
+            raise Fault(2, "Failed.")
+        raise KeyError("secret")
+
+    def test_format_for(self):
+        self.assertEquals(format_for("application/json; charset=utf-8"),
+                          "json")
+        self.assertEquals(format_for("text/xml"), None)
+        self.assertEquals(format_for("application/msgpack"),
+                          "msgpack" if "msgpack" in AVAILABLE_FORMATS
+                          else None)
+
+    def test_round_trip(self):
+        for format in AVAILABLE_FORMATS:
+            request = dumps_request("echo", ("a", 1, ["b"]), format)
+            self.assertEquals(parse_request(request, format),
+                              ([(1, ("echo", ["a", 1, ["b"]]))], False))
+            response = marshaled_dispatch(request, format, self.dispatch)
+            self.assertEquals(loads_response(response, format),
+                              ["a", 1, ["b"]])
+
+    def test_faults(self):
+        for format in AVAILABLE_FORMATS:
+            response = marshaled_dispatch(dumps_request("fail", (), format),
+                                          format, self.dispatch)
+            try:
+                loads_response(response, format)
+            except Fault as fault:
+                self.assertEquals((fault.faultCode, fault.faultString),
+                                  (2, "Failed."))
+            else:
+                self.fail("No fault")
+
+            # Other errors are logged, not sent to the client
+            stderr, sys.stderr = sys.stderr, StringIO()
+            try:
+                response = marshaled_dispatch(
+                    dumps_request("other", (), format), format,
+                    self.dispatch)
+                self.assertTrue("KeyError: 'secret'" in sys.stderr.getvalue())
+            finally:
+                sys.stderr = stderr
+            try:
+                loads_response(response, format)
+            except Fault as fault:
+                self.assertEquals(fault.faultCode, 3)
+                self.assertFalse("KeyError" in fault.faultString)
+                self.assertFalse("secret" in fault.faultString)
+            else:
+                self.fail("No fault")
+
+    def test_batch(self):
+        for format in AVAILABLE_FORMATS:
+            dumps, loads = FORMATS[format]
+            request = dumps([
+                {"method": "echo", "params": ["a"], "id": 1},
+                {"method": "fail", "id": 2},
+                {"method": 3, "id": 3},
+                {"method": "echo", "params": "a", "id": 4},
+                "not a request",
+                {"method": "echo"},
+            ])
+            responses = loads(marshaled_dispatch(request, format,
+                                                 self.dispatch))
+            self.assertEquals([response.get("id") for response in responses],
+                              [1, 2, 3, 4, None, None])
+            self.assertEquals(responses[0]["result"], ["a"])
+            self.assertEquals(responses[5]["result"], [])
+            self.assertEquals(
+                [responses[i]["error"]["code"] for i in xrange(1, 5)],
+                [2, INVALID_REQUEST, INVALID_REQUEST, INVALID_REQUEST])
+
+    def test_bad_requests(self):
+        for format in AVAILABLE_FORMATS:
+            dumps, loads = FORMATS[format]
+            for request, code in ((dumps([]), INVALID_REQUEST),
+                                  ("\xc1 not encoded", PARSE_ERROR)):
+                response = loads(marshaled_dispatch(request, format,
+                                                    self.dispatch))
+                self.assertEquals(response["error"]["code"], code)
+                self.assertEquals(response["id"], None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -29,6 +29,16 @@ In the example, the server will use the certificate and private key stored in
 the file "server.pem" and it will only accept clients that use one of the
 certificates stored in "server_trusted.pem".
 
+With `idle_timeout`, clients can keep a connection open with HTTP/1.1
+keep-alive, and send more requests on it without another TLS handshake.
+
+The certificate files are loaded once, into an `SSLContextCache`, rather
+than for every connection, and loaded again when they change, so a renewed
+certificate is used without restarting the server.  The context keeps a TLS
+session cache, and issues session tickets, so clients that reconnect can
+resume their session with a shorter handshake.  (Python 2.7's `ssl` module
+can't resume sessions, so only other clients benefit.)
+
 
 ======
 Client
@@ -52,6 +62,17 @@ In the example, the client will use the certificate and private key stored in
 the file "client.pem" and it will only connect to servers that use one of the
 certificates listed in "client_trusted.pem".
 
+The transport asks for gzip compressed responses, and decompresses them as
+they arrive.  The server compresses responses of at least
+`compress_threshold` bytes for clients that ask.
+
+The transport keeps its connection open between requests.  If the server
+has closed it in the meantime, a new one is made.
+
+To send requests in JSON or msgpack (see `common.rpcformats`) instead of
+XML, give the transport a `format`, and pass it to this module's
+`ServerProxy` instead of xmlrpclib's.
+
 
 ============
 Certificates
@@ -80,18 +101,334 @@ including) the lines "-----BEGIN CERTIFICATE-----" and
 
 """
 
-from SimpleXMLRPCServer import SimpleXMLRPCServer
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
 import xmlrpclib
 import httplib
+import hashlib
+import threading
+import select
 import socket
+import errno
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+import sys
+import zlib
 import ssl
+import os
+
+from common import rpcformats
 
 __all__ = [
     "SecureXMLRPCServer",
+    "KeepAliveRequestHandler",
     "HTTPSTransport",
     "HTTPSConnection",
+    "ServerProxy",
+    "SSLContextCache",
+    "cert_fingerprint",
+    "encode_response",
+    "dumps_response",
 ]
 
+# Seconds between checks of whether certificate files have changed
+CERT_CHECK_INTERVAL = 1
+
+# Responses shorter than this are sent uncompressed.  Compressing them would
+# save little, and cost more than it saves on a fast link.
+COMPRESS_THRESHOLD = 4096
+
+# Bytes of a response compressed, and sent, at a time
+COMPRESS_CHUNK_BYTES = 64 * 1024
+
+# zlib level for gzip.  The fastest still shrinks XML event batches several
+# times over.
+COMPRESS_LEVEL = 1
+
+def cert_fingerprint(sslsocket):
+    """
+    Return the SHA-256 fingerprint, in hex, of the certificate the other end
+    of sslsocket presented, or None if it presented none.  This identifies a
+    client more reliably than its address.
+    """
+    der = sslsocket.getpeercert(binary_form=True)
+    if not der:
+        return None
+    return hashlib.sha256(der).hexdigest()
+
+class SSLContextCache(object):
+    """
+    An `ssl.SSLContext` built once from certificate files, and built again
+    when any of the files change.
+
+    `ssl.wrap_socket` reads and parses the certificate, key and CA files on
+    every call, and makes a new context each time, so no TLS session can be
+    resumed.  Wrapping sockets with the context from `get` does neither.
+    Servers keep a session cache, and issue session tickets, in their
+    context, so clients that can resume a session skip most of the
+    handshake.  Python 2.7's ssl module can't resume sessions, so clients
+    made with it, this project's included, still do a full handshake for
+    every connection, and on their side the cache only saves loading the
+    files.
+
+    The arguments are the same as `ssl.wrap_socket`'s.
+    """
+
+    def __init__(self, server_side=False, certfile=None, keyfile=None,
+                 ca_certs=None, cert_reqs=ssl.CERT_NONE,
+                 ssl_version=ssl.PROTOCOL_TLSv1):
+        self.server_side = server_side
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.ca_certs = ca_certs
+        self.cert_reqs = cert_reqs
+        self.ssl_version = ssl_version
+        self.reloads = 0  # Times the files were loaded again
+        self._lock = threading.Lock()
+        self._checked = time.time()
+        self._files = self._file_stamps()
+        self._context = self._build()
+
+    def get(self):
+        """
+        Return the context, first building it again if the files have changed
+        since it was built.  If the new files can't be loaded (they may be
+        half written), the old context is kept, and loading is tried again
+        on the next check.
+        """
+        now = time.time()
+        if now - self._checked < CERT_CHECK_INTERVAL:
+            return self._context
+        with self._lock:
+            self._checked = now
+            files = self._file_stamps()
+            if files != self._files:
+                try:
+                    self._context = self._build()
+                except (IOError, OSError, ssl.SSLError):
+                    #TODO: Log
+                    pass
+                else:
+                    self._files = files
+                    self.reloads += 1
+        return self._context
+
+    def wrap_socket(self, sock, **kwargs):
+        """Wrap sock with the current context, as `ssl.wrap_socket` would."""
+        return self.get().wrap_socket(sock, server_side=self.server_side,
+                                      **kwargs)
+
+    def _file_stamps(self):
+        stamps = []
+        for path in (self.certfile, self.keyfile, self.ca_certs):
+            try:
+                stat = os.stat(path) if path else None
+            except OSError:
+                stat = None
+            stamps.append(stat and (stat.st_mtime, stat.st_size, stat.st_ino))
+        return stamps
+
+    def _build(self):
+        context = ssl.SSLContext(self.ssl_version)
+        if self.certfile:
+            context.load_cert_chain(self.certfile, self.keyfile)
+        if self.ca_certs:
+            context.load_verify_locations(self.ca_certs)
+        context.verify_mode = self.cert_reqs
+        return context
+
+def accepts_gzip(accept_encoding):
+    """Whether an Accept-Encoding header value allows gzip."""
+    wildcard = False
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        name = name.strip().lower()
+        if name not in ("gzip", "x-gzip", "*"):
+            continue
+        params = params.replace(" ", "").lower()
+        try:
+            accepted = not params.startswith("q=") or float(params[2:]) > 0
+        except ValueError:
+            accepted = False
+        if name != "*":
+            return accepted
+        # gzip by name takes precedence over "*", wherever it is
+        wildcard = accepted
+    return wildcard
+
+def _gzip_pieces(data):
+    """Yield data gzip compressed, a piece at a time."""
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    for start in xrange(0, len(data), COMPRESS_CHUNK_BYTES):
+        piece = compressor.compress(buffer(data, start, COMPRESS_CHUNK_BYTES))
+        if piece:
+            yield piece
+    yield compressor.flush()
+
+def _http_chunks(pieces):
+    """Yield pieces with HTTP/1.1 chunked transfer encoding."""
+    for piece in pieces:
+        yield "%x\r\n%s\r\n" % (len(piece), piece)
+    yield "0\r\n\r\n"
+
+def encode_response(response, accept_encoding, chunked,
+                    threshold=COMPRESS_THRESHOLD):
+    """
+    Decide how to send response, the body of an XMLRPC response.
+
+    If it is at least threshold bytes long, and the client accepts gzip, it
+    is compressed.  With chunked transfer encoding, the compression is done a
+    piece at a time, as the body is sent, so there is never a compressed copy
+    of all of it in memory.  Without, the Content-Length has to be sent
+    first, so the (much shorter) compressed pieces are all kept until then.
+
+    :param accept_encoding:
+        The request's Accept-Encoding header, or "" if it had none.
+
+    :param chunked:
+        Whether the response can use chunked transfer encoding (it is
+        HTTP/1.1, to an HTTP/1.1 request).
+
+    :param threshold:
+        Shortest response compressed, or None to never compress.
+
+    :returns:
+        (headers, pieces), the headers to send as (name, value) pairs, and
+        the strings to send, in order, after them.
+    """
+    if threshold is None or len(response) < threshold or \
+            not accepts_gzip(accept_encoding):
+        return [("Content-Length", str(len(response)))], [response]
+    headers = [("Content-Encoding", "gzip")]
+    pieces = _gzip_pieces(response)
+    if chunked:
+        headers.append(("Transfer-Encoding", "chunked"))
+        return headers, _http_chunks(pieces)
+    pieces = list(pieces)
+    headers.append(("Content-Length", str(sum(len(p) for p in pieces))))
+    return headers, pieces
+
+def dumps_response(response, marshaller=xmlrpclib.Marshaller, encoding=None,
+                   allow_none=False):
+    """
+    The same as xmlrpclib.dumps(response, methodresponse=True), but the
+    response is marshalled with marshaller, an xmlrpclib.Marshaller subclass.
+
+    :param response:
+        A tuple of the result, or a Fault.
+    """
+    encoding = encoding or "utf-8"
+    data = marshaller(encoding, allow_none).dumps(response)
+    if encoding != "utf-8":
+        header = "<?xml version='1.0' encoding='%s'?>\n" % str(encoding)
+    else:
+        header = "<?xml version='1.0'?>\n"
+    return "%s<methodResponse>\n%s</methodResponse>\n" % (header, data)
+
+class KeepAliveRequestHandler(SimpleXMLRPCRequestHandler):
+    """
+    Handles one request per instance, leaving the connection open if the
+    client asked for HTTP/1.1 keep-alive and the server has an
+    `idle_timeout`.  Whoever made the handler decides when, and whether, to
+    read the next request, by checking `close_connection`.
+
+    Clients must wait for each response before sending the next request
+    (xmlrpclib always does), since anything read ahead into `rfile` is lost
+    with the handler.
+
+    If the server's `defer_request` defers the request, it isn't answered
+    here.  `deferred` is then the function that takes it over, and `resume`
+    answers it later.
+    """
+
+    def handle(self):
+        if self.server.idle_timeout is not None:
+            self.protocol_version = "HTTP/1.1"
+        self.close_connection = 1
+        self.deferred = None
+        self.handle_one_request()
+
+    def do_POST(self):
+        """
+        The same as SimpleXMLRPCRequestHandler's, except that the response
+        is sent as `encode_response` decides, so large responses are
+        compressed as they are sent, and that requests can be in any of the
+        encodings in `common.rpcformats`.
+        """
+        if not self.is_rpc_path_valid():
+            self.report_404()
+            return
+
+        format = rpcformats.format_for(self.headers.get("content-type", ""))
+        try:
+            data = self.rfile.read(int(self.headers["content-length"]))
+            data = self.decode_request_content(data)
+            if data is None:
+                return  # The error response has been sent
+            if self.server.defer_request is not None:
+                self.deferred = self.server.defer_request(self, data, format)
+                if self.deferred is not None:
+                    self._deferred_request = (data, format)
+                    return
+            response = self._dispatch_request(data, format)
+        except Exception:
+            #TODO: Log
+            self._send_server_error()
+            return
+        self._send_rpc_response(response, format)
+
+    def resume(self):
+        """
+        Answer a request that was deferred.  The handler has finished, and
+        closed its `wfile`, so another is made for the response.
+        """
+        data, format = self._deferred_request
+        self.deferred = self._deferred_request = None
+        self.wfile = self.connection.makefile("wb", self.wbufsize)
+        try:
+            try:
+                response = self._dispatch_request(data, format)
+            except Exception:
+                #TODO: Log
+                self._send_server_error()
+            else:
+                self._send_rpc_response(response, format)
+            self.wfile.flush()
+        finally:
+            self.wfile.close()
+
+    def _send_server_error(self):
+        self.send_response(500)
+        self.send_header("Content-length", "0")
+        self.end_headers()
+
+    def _dispatch_request(self, data, format):
+        """Make the calls in data, a request in format, and return the
+        response body."""
+        if format is None:
+            return self.server._marshaled_dispatch(
+                data, getattr(self, '_dispatch', None), self.path)
+        return rpcformats.marshaled_dispatch(data, format,
+                                             self.server._dispatch)
+
+    def _send_rpc_response(self, response, format):
+        chunked = self.protocol_version == "HTTP/1.1" and \
+            self.request_version == "HTTP/1.1"
+        headers, pieces = encode_response(
+            response, self.headers.get("accept-encoding", ""), chunked,
+            self.server.compress_threshold)
+        self.send_response(200)
+        self.send_header("Content-type",
+                         rpcformats.CONTENT_TYPES.get(format, "text/xml"))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        for piece in pieces:
+            self.wfile.write(piece)
+
 class SecureXMLRPCServer(SimpleXMLRPCServer):
     """XMLRPC Server that uses HTTPS and checks certificates."""
 
@@ -120,6 +457,37 @@ class SecureXMLRPCServer(SimpleXMLRPCServer):
         :param ssl_version:
             SSL protocol version to use.  Must be one of `ssl.PROTOCOL_*`.
             Default `ssl.PROTOCOL_TLSv1`.
+
+        :param connection_timeout:
+            Socket timeout, in seconds, for accepted connections.  This bounds
+            how long a stalled client can hold up the TLS handshake or a
+            request.  Default None (no timeout).
+
+        :param idle_timeout:
+            Seconds a connection is kept open, waiting for another request,
+            when the client asks for HTTP/1.1 keep-alive.  Default None,
+            which closes the connection after every request, like
+            SimpleXMLRPCServer.
+
+        :param compress_threshold:
+            Shortest response that is gzip compressed, for clients that
+            accept gzip.  None never compresses.  Default
+            `COMPRESS_THRESHOLD`.
+
+        :param defer_request:
+            Function called as defer_request(handler, data, format) with
+            each request's body, and its encoding from `common.rpcformats`
+            (None for XMLRPC), before the request is dispatched.  If it
+            returns None, the request is answered as usual.  Otherwise it
+            returns a function, which `handle_connection` calls with the
+            handler once the handler has finished.  That function takes the
+            connection over, and answers the request whenever, and in
+            whatever thread, it likes, with `resume_request`.  Default None.
+
+        :param marshaller:
+            xmlrpclib.Marshaller subclass that XMLRPC results are marshalled
+            with, for results with types xmlrpclib doesn't know.  Default
+            xmlrpclib.Marshaller.
         """
 
         self.keyfile = kwargs.pop("keyfile", None)
@@ -127,8 +495,49 @@ class SecureXMLRPCServer(SimpleXMLRPCServer):
         self.cert_reqs = kwargs.pop("cert_reqs", ssl.CERT_REQUIRED)
         self.ca_certs = kwargs.pop("ca_certs", None)
         self.ssl_version = kwargs.pop("ssl_version", ssl.PROTOCOL_TLSv1)
+        self.connection_timeout = kwargs.pop("connection_timeout", None)
+        self.idle_timeout = kwargs.pop("idle_timeout", None)
+        self.compress_threshold = kwargs.pop("compress_threshold",
+                                             COMPRESS_THRESHOLD)
+        self.defer_request = kwargs.pop("defer_request", None)
+        self.marshaller = kwargs.pop("marshaller", xmlrpclib.Marshaller)
+        kwargs.setdefault("requestHandler", KeepAliveRequestHandler)
+        # Loads the files now, so a bad file is reported straight away
+        self.ssl_contexts = SSLContextCache(
+            server_side = True,
+            certfile = self.certfile,
+            keyfile = self.keyfile,
+            ca_certs = self.ca_certs,
+            cert_reqs = self.cert_reqs,
+            ssl_version = self.ssl_version,
+        )
         SimpleXMLRPCServer.__init__(self, *args, **kwargs)
 
+    def _marshaled_dispatch(self, data, dispatch_method=None, path=None):
+        """
+        The same as SimpleXMLRPCServer's, except that results are marshalled
+        with `marshaller`.
+        """
+        try:
+            params, method = xmlrpclib.loads(data)
+            if dispatch_method is not None:
+                response = dispatch_method(method, params)
+            else:
+                response = self._dispatch(method, params)
+            response = dumps_response((response,), self.marshaller,
+                                      self.encoding, self.allow_none)
+        except xmlrpclib.Fault as fault:
+            response = xmlrpclib.dumps(fault, allow_none=self.allow_none,
+                                       encoding=self.encoding)
+        except:
+            # report exception back to server
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            response = xmlrpclib.dumps(
+                xmlrpclib.Fault(1, "%s:%s" % (exc_type, exc_value)),
+                encoding=self.encoding, allow_none=self.allow_none,
+                )
+        return response
+
     def get_request(self):
         """
         as SimpleXMLRPCServer.get_request, but it uses ssl and checks
@@ -136,13 +545,7 @@ class SecureXMLRPCServer(SimpleXMLRPCServer):
         """
         try:
             newsocket, fromaddr = self.socket.accept()
-            sslsocket = ssl.wrap_socket(newsocket,
-                                        server_side = True,
-                                        keyfile = self.keyfile,
-                                        certfile = self.certfile,
-                                        cert_reqs = self.cert_reqs,
-                                        ca_certs = self.ca_certs,
-                                        ssl_version = self.ssl_version)
+            sslsocket = self.wrap_request(newsocket)
         except socket.error as e:
             # SocketServer._handle_request_noblock ignores socket.error, so we
             # print it out before raising.
@@ -150,6 +553,158 @@ class SecureXMLRPCServer(SimpleXMLRPCServer):
             raise
         return sslsocket, fromaddr
 
+    def wrap_request(self, newsocket):
+        """
+        Do the SSL handshake on a newly accepted socket and return the SSL
+        socket.  This is split out of `get_request` so the (possibly slow)
+        handshake can be done somewhere other than where the socket was
+        accepted.
+        """
+        newsocket.settimeout(self.connection_timeout)
+        return self.ssl_contexts.wrap_socket(newsocket)
+
+    def accept_connection(self, handshake=True):
+        """
+        Accept a connection, but don't handle any requests on it yet.  Used
+        when the server is driven by an outside event loop instead of
+        `handle_request` or `serve_forever`.
+
+        :param handshake:
+            If False, the TLS handshake isn't done here, and the socket is
+            left non-blocking.  The event loop then calls
+            `continue_handshake` until it is done, so a slow client can't
+            hold the loop up.
+
+        :returns:
+            A `(request, client_address)` tuple to later pass to
+            `handle_connection`, or None if the connection was refused.
+        """
+        try:
+            if handshake:
+                request, client_address = self.get_request()
+            else:
+                newsocket, client_address = self.socket.accept()
+                request = self.ssl_contexts.wrap_socket(
+                    newsocket, do_handshake_on_connect=False)
+                request.setblocking(False)
+        except (socket.error, ssl.SSLError):
+            return None
+        if not self.verify_request(request, client_address):
+            self.shutdown_request(request)
+            return None
+        return request, client_address
+
+    def continue_handshake(self, request):
+        """
+        Carry on with the TLS handshake of a connection accepted with
+        `accept_connection(handshake=False)`, without blocking.
+
+        :returns:
+            "read" or "write", if the handshake can't go on until the socket
+            is readable or writable, or None once it is done, when the socket
+            is put back into blocking mode with `connection_timeout`, ready
+            for `handle_connection`.  socket.error or ssl.SSLError is raised
+            if the handshake failed.
+        """
+        try:
+            request.do_handshake()
+        except ssl.SSLError as e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                return "read"
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                return "write"
+            raise
+        request.settimeout(self.connection_timeout)
+        return None
+
+    def handle_connection(self, request, client_address):
+        """
+        Handle a request on a connection returned by `accept_connection`.
+
+        If the client keeps the connection alive, it is left open, and True
+        is returned.  The caller should call this again once the next
+        request arrives (`request.pending()` or the socket is readable), or
+        close the connection with `shutdown_request` after `idle_timeout`.
+        Otherwise the connection is closed and False is returned.
+
+        If `defer_request` deferred the request, False is returned, but the
+        connection is left to the function it returned.
+        """
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except socket.error:
+            # The client went away, often by closing a kept connection
+            self.shutdown_request(request)
+            return False
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return False
+        return self._finish_connection(handler)
+
+    def resume_request(self, handler):
+        """
+        Answer a request deferred by `defer_request`, then, like
+        `handle_connection`, return True if the client keeps the connection
+        alive, or close it and return False.
+        """
+        try:
+            handler.resume()
+        except socket.error:
+            self.shutdown_request(handler.request)
+            return False
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+            self.shutdown_request(handler.request)
+            return False
+        return self._finish_connection(handler)
+
+    def _finish_connection(self, handler):
+        deferred = getattr(handler, "deferred", None)
+        if deferred is not None:
+            deferred(handler)
+            return False
+        if getattr(handler, "close_connection", True):
+            self.shutdown_request(handler.request)
+            return False
+        return True
+
+    def process_request(self, request, client_address):
+        """
+        As SimpleXMLRPCServer.process_request, used by `handle_request` and
+        `serve_forever`, but keeps handling requests on the connection while
+        the client keeps it alive, until it is idle for `idle_timeout`.
+        """
+        while self.handle_connection(request, client_address):
+            if not request.pending() and not select.select(
+                    [request], [], [], self.idle_timeout)[0]:
+                self.shutdown_request(request)
+                return
+
+def _is_stale_connection_error(e):
+    """
+    Whether e is what sending on, or reading the response from, a connection
+    the server had already closed fails with.
+    """
+    if isinstance(e, httplib.BadStatusLine):
+        return True
+    if isinstance(e, ssl.SSLError):
+        # Newer OpenSSL versions report a missing close_notify as a protocol
+        # error, not SSL_ERROR_EOF
+        return e.errno in (ssl.SSL_ERROR_EOF, ssl.SSL_ERROR_ZERO_RETURN) or \
+            "unexpected eof" in str(e).lower()
+    return e.errno in (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+
+def _connection_dropped(connection):
+    """
+    Whether the server has closed a kept connection.  Between responses,
+    nothing should arrive on it, so if it is readable, what arrived is the
+    server closing it.
+    """
+    if connection.sock is None:
+        return True
+    return bool(select.select([connection.sock], [], [], 0)[0])
+
 class HTTPSConnection(httplib.HTTPConnection):
     """
     Like httplib.HTTPSConnection, but optionally checks certificate of server.
@@ -160,7 +715,7 @@ class HTTPSConnection(httplib.HTTPConnection):
     def __init__(self, host, port=None, keyfile=None, certfile=None,
                  cert_reqs=ssl.CERT_REQUIRED, ca_certs=None,
                  ssl_version=ssl.PROTOCOL_TLSv1, strict=None,
-                 timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+                 timeout=socket._GLOBAL_DEFAULT_TIMEOUT, ssl_contexts=None):
         """
         The same as httplib.HTTPConnection, but takes some extra arguments
         that allow for certificate checking.  These extra arguments are passed
@@ -184,6 +739,11 @@ class HTTPSConnection(httplib.HTTPConnection):
             SSL protocol version to use.  Must be one of `ssl.PROTOCOL_*`.
             Default `ssl.PROTOCOL_TLSv1`.
 
+        :param ssl_contexts:
+            `SSLContextCache` to wrap the socket with, instead of building
+            a context from the other arguments.  Connections that share one
+            only load the certificate files once.
+
         """
 
         httplib.HTTPConnection.__init__(self, host, port, strict, timeout)
@@ -192,22 +752,24 @@ class HTTPSConnection(httplib.HTTPConnection):
         self.cert_reqs = cert_reqs
         self.ca_certs = ca_certs
         self.ssl_version = ssl_version
+        if ssl_contexts is None:
+            ssl_contexts = SSLContextCache(
+                certfile = certfile,
+                keyfile = keyfile,
+                ca_certs = ca_certs,
+                cert_reqs = cert_reqs,
+                ssl_version = ssl_version,
+            )
+        self.ssl_contexts = ssl_contexts
 
     def connect(self):
         """
-        Same as httplib.HTTPSConnection, but passes extra arguments into
-        ssl.wrap_socket that tell it to check certificates.
+        Same as httplib.HTTPSConnection, but wraps the socket with a
+        context that checks certificates.
         """
 
         sock = socket.create_connection((self.host, self.port), self.timeout)
-        self.sock = ssl.wrap_socket(
-            sock,
-            keyfile = self.keyfile,
-            certfile = self.certfile,
-            cert_reqs = self.cert_reqs,
-            ca_certs = self.ca_certs,
-            ssl_version = self.ssl_version,
-        )
+        self.sock = self.ssl_contexts.wrap_socket(sock)
         if self._tunnel_host:
             self._tunnel()
 
@@ -226,11 +788,17 @@ class HTTPSTransport(xmlrpclib.Transport):
         )
         proxy = xmlrpclib.ServerProxy("https://localhost:10023", transport)
 
+    With a `format` of "json" or "msgpack", requests are sent, and responses
+    read, in that encoding (see `common.rpcformats`) instead of XML.  The
+    server has to accept it, as SecureXMLRPCServer does, and the transport
+    has to be passed to `ServerProxy`, which encodes requests in the
+    transport's format, rather than to xmlrpclib.ServerProxy.
+
     """
 
     def __init__(self, certfile=None, keyfile=None, ca_certs=None,
                  cert_reqs=ssl.CERT_REQUIRED, ssl_version=ssl.PROTOCOL_TLSv1,
-                 use_datetime=0):
+                 use_datetime=0, format="xml"):
         """
         The same as xmlrpclib.SafeTransport, but takes some extra arguments
         that allow for certificate checking.  These extra arguments are passed
@@ -257,20 +825,46 @@ class HTTPSTransport(xmlrpclib.Transport):
         :param use_datetime:
             Same as `httplib.HTTPTransport`.
 
+        :param format:
+            Encoding of requests and responses: "xml", "json" or "msgpack".
+            Default "xml".
+
         """
 
+        if format != "xml" and format not in rpcformats.AVAILABLE_FORMATS:
+            raise ValueError('Unknown or unavailable format "%s".' % format)
         xmlrpclib.Transport.__init__(self, use_datetime)
+        self.format = format
+        self._connection = (None, None)
+        self._reused = False  # Whether the last request used a kept connection
         self.keyfile = keyfile
         self.certfile = certfile
         self.cert_reqs = cert_reqs
         self.ca_certs = ca_certs
         self.ssl_version = ssl_version
+        # Shared by every connection the transport makes
+        self.ssl_contexts = SSLContextCache(
+            certfile = certfile,
+            keyfile = keyfile,
+            ca_certs = ca_certs,
+            cert_reqs = cert_reqs,
+            ssl_version = ssl_version,
+        )
 
     def make_connection(self, host):
         """
         Same as xmlrpclib.Transport.make_connection, but it uses
         HTTPSConnection (which checks certificates).
+
+        The connection is kept, and reused for the next request to the same
+        host, so the TLS handshake is only done once.
         """
+        if self._connection[1] and host == self._connection[0]:
+            if not _connection_dropped(self._connection[1]):
+                self._reused = True
+                return self._connection[1]
+            self.close()
+        self._reused = False
         chost, self._extra_headers, x509 = self.get_host_info(host)
         self._connection = host, HTTPSConnection(
             chost,
@@ -280,19 +874,38 @@ class HTTPSTransport(xmlrpclib.Transport):
             cert_reqs = self.cert_reqs,
             ca_certs = self.ca_certs,
             ssl_version = self.ssl_version,
+            ssl_contexts = self.ssl_contexts,
         )
         return self._connection[1]
 
-    # The following methods were copied from xmlrpclib.Transport in Python
+    def request(self, host, handler, request_body, verbose=0):
+        """
+        Make a request, over the kept connection if there is one.
+
+        The server may have closed a kept connection (after its idle
+        timeout, or because it restarted) since it was last used.  If
+        so, the request is sent again, once, on a new connection.  This
+        only happens when the failure shows the request wasn't handled:
+        the connection failed while sending, or was closed before any of
+        the response arrived.
+        """
+        try:
+            return self.single_request(host, handler, request_body, verbose)
+        except (socket.error, httplib.BadStatusLine) as e:
+            if not self._reused or not _is_stale_connection_error(e):
+                raise
+        return self.single_request(host, handler, request_body, verbose)
+
+    # The following method was copied from xmlrpclib.Transport in Python
     # 2.7.  The underlying problem is that in 2.6, self.make_connection would
     # return a httplib.HTTP object, but in 2.7 it returns an
     # httplib.HTTPConnection object.  The implementation of
     # SecureXMLRPCServer.make_connection has to choose which to return (it
-    # returns an HTTPConnection like object: HTTPSConnection).  So these
-    # methods are copied here to make Python 2.6 work with HTTPConnection like
+    # returns an HTTPConnection like object: HTTPSConnection).  So this
+    # method is copied here to make Python 2.6 work with HTTPConnection like
     # objects.
 
-    def request(self, host, handler, request_body, verbose=0):
+    def single_request(self, host, handler, request_body, verbose=0):
         # issue XML-RPC request
 
         h = self.make_connection(host)
@@ -326,7 +939,440 @@ class HTTPSTransport(xmlrpclib.Transport):
             response.msg,
             )
 
+    def send_content(self, connection, request_body):
+        """
+        Same as xmlrpclib.Transport.send_content, but with the Content-Type
+        of the transport's format.
+        """
+        connection.putheader("Content-Type",
+            rpcformats.CONTENT_TYPES.get(self.format, "text/xml"))
+        if self.encode_threshold is not None and \
+                self.encode_threshold < len(request_body):
+            connection.putheader("Content-Encoding", "gzip")
+            request_body = xmlrpclib.gzip_encode(request_body)
+        connection.putheader("Content-Length", str(len(request_body)))
+        connection.endheaders(request_body)
+
+    def parse_response(self, response):
+        """
+        Same as xmlrpclib.Transport.parse_response, but a gzip response is
+        decompressed as it is read, rather than read whole first, and
+        responses in other formats are decoded.
+        """
+        decoder = None
+        if response.getheader("Content-Encoding", "") == "gzip":
+            decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # Errors from servers that only speak XMLRPC are in XML, whatever
+        # format the request was in
+        format = rpcformats.format_for(response.getheader("Content-Type", ""))
+        if format is None:
+            p, u = self.getparser()
+            feed = p.feed
+        else:
+            pieces = []
+            feed = pieces.append
+        while True:
+            data = response.read(COMPRESS_CHUNK_BYTES)
+            if not data:
+                break
+            if decoder:
+                data = decoder.decompress(data)
+            if self.verbose:
+                print "body:", repr(data)
+            feed(data)
+        if decoder:
+            feed(decoder.flush())
+        if format is not None:
+            return (rpcformats.loads_response("".join(pieces), format),)
+        p.close()
+        return u.close()
+
     def close(self):
         if self._connection[1]:
             self._connection[1].close()
             self._connection = (None, None)
+
+class ServerProxy(xmlrpclib.ServerProxy):
+    """
+    The same as xmlrpclib.ServerProxy, except that if the transport has a
+    `format` other than "xml", like `HTTPSTransport`, requests are encoded
+    in it with `rpcformats.dumps_request`.
+    """
+
+    def _ServerProxy__request(self, methodname, params):
+        transport = self._ServerProxy__transport
+        format = getattr(transport, "format", "xml")
+        if format == "xml":
+            return xmlrpclib.ServerProxy._ServerProxy__request(
+                self, methodname, params)
+        response = transport.request(
+            self._ServerProxy__host,
+            self._ServerProxy__handler,
+            rpcformats.dumps_request(methodname, params, format),
+            verbose=self._ServerProxy__verbose,
+        )
+        if len(response) == 1:
+            response = response[0]
+        return response
+
+def _make_test_cert(directory):
+    """
+    Generate a self signed certificate for localhost in directory, for
+    tests, and return the certificate and key files.  Skips the test if the
+    openssl command isn't installed.
+    """
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    with open(os.devnull, "w") as devnull:
+        try:
+            subprocess.check_call((
+                "openssl", "req", "-new", "-x509", "-nodes",
+                "-newkey", "rsa:2048", "-days", "1",
+                "-subj", "/CN=localhost",
+                "-out", certfile,
+                "-keyout", keyfile), stdout=devnull, stderr=devnull)
+        except OSError:
+            raise unittest.SkipTest("openssl is not installed")
+    return certfile, keyfile
+
+
+class _RetryTransport(HTTPSTransport):
+    """
+    An HTTPSTransport whose requests have the given outcomes, each either a
+    result, or an exception to raise, with whether a kept connection was
+    used for it.
+    """
+
+    def __init__(self, outcomes):
+        HTTPSTransport.__init__(self, cert_reqs=ssl.CERT_NONE)
+        self.outcomes = outcomes
+        self.requests = 0
+
+    def single_request(self, host, handler, request_body, verbose=0):
+        self.requests += 1
+        self._reused, outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+class TestKeepAlive(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        certfile, keyfile = _make_test_cert(self.directory)
+        self.server = SecureXMLRPCServer(
+            ("127.0.0.1", 0),
+            certfile = certfile,
+            keyfile = keyfile,
+            cert_reqs = ssl.CERT_NONE,
+            ssl_version = ssl.PROTOCOL_SSLv23,
+            idle_timeout = 5,
+            logRequests = False,
+        )
+        self.pings = 0
+        def ping():
+            self.pings += 1
+            return self.pings
+        self.server.register_function(ping)
+        self.accepted = 0
+        get_request = self.server.get_request
+        def counted_get_request():
+            self.accepted += 1
+            return get_request()
+        self.server.get_request = counted_get_request
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.transport = HTTPSTransport(cert_reqs=ssl.CERT_NONE,
+                                        ssl_version=ssl.PROTOCOL_SSLv23)
+        self.client = xmlrpclib.ServerProxy(
+            "https://127.0.0.1:%s" % self.server.server_address[1],
+            self.transport)
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.directory)
+
+    def count_requests(self):
+        self.requests = 0
+        single_request = self.transport.single_request
+        def counted_single_request(*args):
+            self.requests += 1
+            return single_request(*args)
+        self.transport.single_request = counted_single_request
+
+    def wait_until_idle_closed(self):
+        self.server.idle_timeout = 0.05
+        self.assertEquals(self.client.ping(), 1)
+        time.sleep(0.3)
+
+    def test_reuse(self):
+        self.assertEquals(self.client.ping(), 1)
+        self.assertFalse(self.transport._reused)
+        self.assertEquals(self.client.ping(), 2)
+        self.assertTrue(self.transport._reused)
+        self.assertEquals(self.accepted, 1)
+
+    def test_dropped(self):
+        self.wait_until_idle_closed()
+        self.count_requests()
+        # Seen before the request is sent, so there is no need to retry
+        self.assertEquals(self.client.ping(), 2)
+        self.assertEquals(self.requests, 1)
+        self.assertEquals(self.accepted, 2)
+
+    def test_formats(self):
+        for format in sorted(rpcformats.AVAILABLE_FORMATS):
+            transport = HTTPSTransport(cert_reqs=ssl.CERT_NONE,
+                                       ssl_version=ssl.PROTOCOL_SSLv23,
+                                       format=format)
+            client = ServerProxy(
+                "https://127.0.0.1:%s" % self.server.server_address[1],
+                transport)
+            pings = self.pings
+            self.assertEquals(client.ping(), pings + 1)
+            # The server handles one connection at a time
+            transport.close()
+
+    def test_retry_stale(self):
+        self.wait_until_idle_closed()
+        self.count_requests()
+        # As if the server closed it just after the client checked
+        dropped = globals()["_connection_dropped"]
+        globals()["_connection_dropped"] = lambda connection: False
+        try:
+            self.assertEquals(self.client.ping(), 2)
+        finally:
+            globals()["_connection_dropped"] = dropped
+        self.assertEquals(self.requests, 2)
+        self.assertEquals(self.accepted, 2)
+
+    def test_compressed(self):
+        self.server.register_function(lambda size: "x" * size, "text")
+        encodings = []
+        parse_response = self.transport.parse_response
+        def noted_parse_response(response):
+            encodings.append((response.getheader("Content-Encoding"),
+                              response.getheader("Transfer-Encoding")))
+            return parse_response(response)
+        self.transport.parse_response = noted_parse_response
+        size = COMPRESS_THRESHOLD + COMPRESS_CHUNK_BYTES * 2
+        self.assertEquals(self.client.text(size), "x" * size)
+        self.assertEquals(self.client.text(10), "x" * 10)
+        self.assertEquals(encodings, [("gzip", "chunked"), (None, None)])
+        self.assertEquals(self.accepted, 1)
+
+    def test_retry_once(self):
+        reset = socket.error(errno.ECONNRESET, "Connection reset by peer")
+        # A stale kept connection is retried, once, on a new one
+        transport = _RetryTransport([(True, reset), (False, ("ok",))])
+        self.assertEquals(transport.request("host", "/", "<body/>"), ("ok",))
+        self.assertEquals(transport.requests, 2)
+        transport = _RetryTransport([(True, reset), (True, reset)])
+        self.assertRaises(socket.error, transport.request, "host", "/",
+                          "<body/>")
+        self.assertEquals(transport.requests, 2)
+
+        # Not if the connection was new, or the error means the request
+        # may have been handled
+        for reused, error in ((False, reset),
+                              (True, socket.timeout("timed out")),
+                              (True, socket.error(errno.ETIMEDOUT, "")),
+                              (True, xmlrpclib.Fault(1, "failed")),
+                              (True, xmlrpclib.ProtocolError(
+                                  "host/", 500, "Error", {}))):
+            transport = _RetryTransport([(reused, error), (False, ("ok",))])
+            self.assertRaises(type(error), transport.request, "host", "/",
+                              "<body/>")
+            self.assertEquals(transport.requests, 1)
+
+def _unchunk(data):
+    """Return the body sent with chunked transfer encoding as data, and
+    the length of each chunk."""
+    body = []
+    lengths = []
+    while True:
+        size, _, data = data.partition("\r\n")
+        length = int(size, 16)
+        lengths.append(length)
+        if not length:
+            assert data == "\r\n"
+            return "".join(body), lengths
+        body.append(data[:length])
+        assert data[length:length + 2] == "\r\n"
+        data = data[length + 2:]
+
+class _Response(object):
+    """Stands in for an httplib.HTTPResponse, noting the reads made."""
+
+    def __init__(self, body, headers):
+        self.body = body
+        self.headers = headers
+        self.reads = []
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def read(self, amount):
+        self.reads.append(amount)
+        data, self.body = self.body[:amount], self.body[amount:]
+        return data
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        # Long enough to be compressed in several pieces
+        self.body = xmlrpclib.dumps((
+            ["event %s" % i for i in xrange(COMPRESS_CHUNK_BYTES // 4)],),
+            methodresponse=True)
+        self.transport = HTTPSTransport(cert_reqs=ssl.CERT_NONE)
+        self.transport.verbose = 0
+
+    def test_accepts_gzip(self):
+        for header in ("gzip", "GZIP", "x-gzip", "*", "deflate, gzip",
+                       "gzip;q=0.5", "gzip; q=1", "*;q=0, gzip",
+                       "gzip, *;q=0"):
+            self.assertTrue(accepts_gzip(header), header)
+        for header in ("", "identity", "deflate", "gzip;q=0", "gzip; q=0.0",
+                       "gzip;q=bad", "*;q=0", "gzip;q=0, *"):
+            self.assertFalse(accepts_gzip(header), header)
+
+    def test_threshold(self):
+        for accept_encoding, threshold in (("gzip", len(self.body) + 1),
+                                           ("gzip", None),
+                                           ("", 0),
+                                           ("gzip;q=0", 0)):
+            headers, pieces = encode_response(self.body, accept_encoding,
+                                              True, threshold)
+            self.assertEquals(headers,
+                              [("Content-Length", str(len(self.body)))])
+            self.assertEquals(list(pieces), [self.body])
+
+    def test_compressed(self):
+        headers, pieces = encode_response(self.body, "gzip", False,
+                                          len(self.body))
+        data = "".join(pieces)
+        self.assertEquals(headers, [("Content-Encoding", "gzip"),
+                                    ("Content-Length", str(len(data)))])
+        self.assertTrue(len(data) < len(self.body) // 4)
+        self.assertEquals(zlib.decompress(data, 16 + zlib.MAX_WBITS),
+                          self.body)
+
+    def test_chunked(self):
+        headers, pieces = encode_response(self.body, "gzip", True)
+        self.assertEquals(headers, [("Content-Encoding", "gzip"),
+                                    ("Transfer-Encoding", "chunked")])
+        data, lengths = _unchunk("".join(pieces))
+        # A chunk per piece compressed, and none empty but the last
+        self.assertTrue(len(lengths) > 2)
+        self.assertEquals(lengths.count(0), 1)
+        self.assertEquals(zlib.decompress(data, 16 + zlib.MAX_WBITS),
+                          self.body)
+
+    def test_parse_response(self):
+        headers, pieces = encode_response(self.body, "gzip", False)
+        response = _Response("".join(pieces), dict(headers))
+        self.assertEquals(self.transport.parse_response(response),
+                          xmlrpclib.loads(self.body)[0])
+        # Read, and decompressed, a piece at a time
+        self.assertEquals(set(response.reads), set([COMPRESS_CHUNK_BYTES]))
+
+        response = _Response(self.body, {})
+        self.assertEquals(self.transport.parse_response(response),
+                          xmlrpclib.loads(self.body)[0])
+
+    def test_parse_response_formats(self):
+        body = rpcformats.dumps_response([(1, ["event"] * 1000)], False,
+                                        "json")
+        headers, pieces = encode_response(body, "gzip", False, 0)
+        headers = dict(headers)
+        headers["Content-Type"] = rpcformats.CONTENT_TYPES["json"]
+        response = _Response("".join(pieces), headers)
+        self.assertEquals(self.transport.parse_response(response),
+                          (["event"] * 1000,))
+
+class TestSSLContextCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.certfile, self.keyfile = _make_test_cert(self.directory)
+        self.cache = SSLContextCache(server_side=True, certfile=self.certfile,
+                                     keyfile=self.keyfile)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check(self):
+        """Get the context, as if CERT_CHECK_INTERVAL had passed."""
+        self.cache._checked = 0
+        return self.cache.get()
+
+    def replace_cert(self):
+        """Replace the certificate and key with new ones."""
+        new_directory = os.path.join(self.directory, "new")
+        os.mkdir(new_directory)
+        certfile, keyfile = _make_test_cert(new_directory)
+        os.rename(certfile, self.certfile)
+        os.rename(keyfile, self.keyfile)
+
+    def test_reused(self):
+        context = self.cache.get()
+        self.assertTrue(self.cache.get() is context)
+        self.assertTrue(self.check() is context)
+        self.assertEquals(self.cache.reloads, 0)
+
+    def test_reload(self):
+        context = self.cache.get()
+        self.replace_cert()
+        # Not until the next check
+        self.assertTrue(self.cache.get() is context)
+        new_context = self.check()
+        self.assertFalse(new_context is context)
+        self.assertEquals(self.cache.reloads, 1)
+        self.assertTrue(self.check() is new_context)
+
+    def test_bad_files(self):
+        context = self.cache.get()
+        with open(self.certfile, "w") as f:
+            f.write("-----BEGIN CERTIFICATE-----\n")  # Half written
+        self.assertTrue(self.check() is context)
+        self.assertEquals(self.cache.reloads, 0)
+        # Tried again at the next check
+        os.remove(self.certfile)
+        self.replace_cert()
+        self.assertFalse(self.check() is context)
+        self.assertEquals(self.cache.reloads, 1)
+
+    def test_missing_files(self):
+        self.assertRaises((IOError, ssl.SSLError), SSLContextCache,
+                          certfile=os.path.join(self.directory, "missing"))
+
+class TestStaleConnectionError(unittest.TestCase):
+
+    def test_stale(self):
+        for e in (httplib.BadStatusLine("''"),
+                  socket.error(errno.ECONNRESET, "Connection reset"),
+                  socket.error(errno.ECONNABORTED, "Connection aborted"),
+                  socket.error(errno.EPIPE, "Broken pipe"),
+                  ssl.SSLError(ssl.SSL_ERROR_EOF, "EOF occurred"),
+                  ssl.SSLError(ssl.SSL_ERROR_ZERO_RETURN, "closed"),
+                  ssl.SSLError(1, "[SSL: UNEXPECTED_EOF_WHILE_READING] "
+                                  "unexpected eof while reading")):
+            self.assertTrue(_is_stale_connection_error(e), e)
+
+    def test_not_stale(self):
+        for e in (socket.timeout("timed out"),
+                  socket.error("no errno"),
+                  socket.error(errno.ETIMEDOUT, "Timed out"),
+                  socket.error(errno.ECONNREFUSED, "Connection refused"),
+                  socket.error(errno.EHOSTUNREACH, "No route to host"),
+                  ssl.SSLError(1, "[SSL: CERTIFICATE_VERIFY_FAILED] "
+                                  "certificate verify failed"),
+                  ssl.SSLError(ssl.SSL_ERROR_WANT_READ, "want read")):
+            self.assertFalse(_is_stale_connection_error(e), e)
+
+if __name__ == '__main__':
+    unittest.main()
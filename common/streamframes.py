@@ -0,0 +1,239 @@
+"""Framing for the proxy's event stream.
+
+The event stream is a TLS connection, with the same certificate checking as
+XMLRPC, on which the proxy pushes events as they happen.  Everything sent
+either way is a frame: a 4 byte, big endian length, then that many bytes of
+an encoded object.
+
+The client starts by sending a hello frame, always encoded as JSON::
+
+    {"format": "json", "cursor": "0"}
+
+`format` is the encoding of every frame after it, "json" or (if the
+msgpack module is installed on both ends) "msgpack".  `cursor` is the same as
+the cursor given to the `get_events_after` XMLRPC method.
+
+The hello may also have a `filter`, the same as the `event_filter` given to
+`get_events_after`, so that only the events it matches are sent::
+
+    {"format": "json", "cursor": "0", "filter": {"channels": {"net": ["#a"]}}}
+
+The proxy then sends frames that are the same as what `get_events_after`
+returns, a map with `events` and `cursor`.  The first is sent straight
+away, even if it has no events.  After that, a frame is sent whenever there
+are new (matching) events.  To resume after reconnecting, a client sends
+the last cursor it got in its hello.
+
+If the hello is bad, the proxy sends a frame with an `error` message and
+closes the connection.  The frame is in the hello's format if that is known,
+and JSON otherwise.
+
+"""
+
+import json
+import struct
+import unittest
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__all__ = [
+    "FRAME_HEADER",
+    "MAX_FRAME_BYTES",
+    "FORMATS",
+    "Fragment",
+    "dumps_array",
+    "pack_frame",
+    "FrameReader",
+]
+
+FRAME_HEADER = struct.Struct("!I")
+
+# Frames longer than this are refused, rather than buffered.
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+
+def _decode_strings(obj):
+    '''Return obj with byte strings decoded as UTF-8, replacing bad bytes.'''
+    if isinstance(obj, str):
+        return obj.decode("utf-8", "replace")
+    if isinstance(obj, dict):
+        return dict((_decode_strings(key), _decode_strings(value))
+                    for key, value in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return [_decode_strings(item) for item in obj]
+    return obj
+
+class Fragment(object):
+    '''A value that encodes itself.
+
+    The dumps functions in `FORMATS` encode a Fragment, wherever it is in
+    the object they are given, as whatever its `encoded` method returns.  So
+    something that is sent over and over can keep its encoding, rather than
+    being encoded again every time.
+
+    '''
+
+    __slots__ = ()
+
+    def encoded(self, format):
+        '''Return the value encoded in format, a key of `FORMATS`.'''
+        raise NotImplementedError
+
+# json.dumps makes a new encoder whenever it is given options
+_json_encode = json.JSONEncoder(separators=(",", ":")).encode
+
+def _json_dumps(obj):
+    try:
+        return _json_encode(obj)
+    except UnicodeDecodeError:
+        # IRC text isn't always valid UTF-8
+        return _json_encode(_decode_strings(obj))
+
+def _msgpack_header(length, small, short, long):
+    if length < 16:
+        return chr(small | length)
+    if length < 0x10000:
+        return short + struct.pack("!H", length)
+    return long + struct.pack("!I", length)
+
+def dumps_array(items, format):
+    '''Return the encoding of a list in format, given its items already
+    encoded.'''
+    if format == "json":
+        return "[%s]" % ",".join(items)
+    return _msgpack_header(len(items), 0x90, "\xdc", "\xdd") + "".join(items)
+
+def _dumps_map(pairs, format):
+    if format == "json":
+        return "{%s}" % ",".join("%s:%s" % pair for pair in pairs)
+    return _msgpack_header(len(pairs), 0x80, "\xde", "\xdf") + \
+        "".join(key + value for key, value in pairs)
+
+# Name -> dumps for each encoding, without Fragments
+_PLAIN_DUMPS = {"json": _json_dumps}
+if msgpack is not None:
+    _PLAIN_DUMPS["msgpack"] = msgpack.packb
+
+def _dumps_parts(obj, format):
+    '''Encode obj, which holds Fragments, a container at a time.'''
+    if isinstance(obj, Fragment):
+        return obj.encoded(format)
+    if isinstance(obj, dict):
+        dumps = _PLAIN_DUMPS[format]
+        pairs = []
+        for key, value in obj.iteritems():
+            if format == "json" and not isinstance(key, basestring):
+                raise TypeError("Key %r is not a string." % (key,))
+            pairs.append((dumps(key), _dumps_parts(value, format)))
+        return _dumps_map(pairs, format)
+    if isinstance(obj, (list, tuple)):
+        return dumps_array([_dumps_parts(item, format) for item in obj],
+                           format)
+    return _PLAIN_DUMPS[format](obj)
+
+def _fragment_dumps(format):
+    plain_dumps = _PLAIN_DUMPS[format]
+    def dumps(obj):
+        try:
+            return plain_dumps(obj)
+        except TypeError:
+            # Either obj holds Fragments, or it really can't be encoded, in
+            # which case encoding its parts raises TypeError again
+            return _dumps_parts(obj, format)
+    return dumps
+
+# Name -> (dumps, loads) for each encoding frames can be in
+FORMATS = {
+    "json": (_fragment_dumps("json"), json.loads),
+}
+if msgpack is not None:
+    FORMATS["msgpack"] = (_fragment_dumps("msgpack"), msgpack.unpackb)
+
+def pack_frame(data):
+    '''Return the frame holding data, an encoded object.'''
+    return FRAME_HEADER.pack(len(data)) + data
+
+class FrameReader(object):
+    '''Splits frames out of data as it is received.'''
+
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, data):
+        '''Add received data, and return a list of any frames completed.
+
+        Raises ValueError if a frame is longer than MAX_FRAME_BYTES.
+
+        '''
+        self._buffer += data
+        frames = []
+        while len(self._buffer) >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(self._buffer)
+            if length > MAX_FRAME_BYTES:
+                raise ValueError("Frame of %s bytes is too long." % length)
+            end = FRAME_HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            frames.append(self._buffer[FRAME_HEADER.size:end])
+            self._buffer = self._buffer[end:]
+        return frames
+
+    def buffered(self):
+        '''Number of bytes received that aren't yet part of a whole frame.'''
+        return len(self._buffer)
+
+
+class TestFrameReader(unittest.TestCase):
+
+    def test_split(self):
+        reader = FrameReader()
+        data = pack_frame("first") + pack_frame("") + pack_frame("second")
+        frames = []
+        for i in xrange(len(data)):
+            frames.extend(reader.feed(data[i]))
+            self.assertTrue(reader.buffered() < FRAME_HEADER.size + 6)
+        self.assertEquals(frames, ["first", "", "second"])
+        self.assertEquals(reader.buffered(), 0)
+
+    def test_several(self):
+        reader = FrameReader()
+        data = pack_frame("a") + pack_frame("bc") + pack_frame("def")
+        self.assertEquals(reader.feed(data[:-1]), ["a", "bc"])
+        self.assertEquals(reader.buffered(), FRAME_HEADER.size + 2)
+        self.assertEquals(reader.feed(data[-1:]), ["def"])
+        self.assertEquals(reader.buffered(), 0)
+
+    def test_too_long(self):
+        reader = FrameReader()
+        self.assertEquals(reader.feed(FRAME_HEADER.pack(MAX_FRAME_BYTES)),
+                          [])
+        reader = FrameReader()
+        header = FRAME_HEADER.pack(MAX_FRAME_BYTES + 1)
+        self.assertEquals(reader.feed(header[:-1]), [])
+        self.assertRaises(ValueError, reader.feed, header[-1:])
+
+class TestFormats(unittest.TestCase):
+
+    class _Fragment(Fragment):
+
+        def encoded(self, format):
+            return FORMATS[format][0]({"encoded": format})
+
+    def test_fragments(self):
+        for format, (dumps, loads) in FORMATS.iteritems():
+            obj = {"events": [self._Fragment(), 1], "cursor": "2"}
+            self.assertEquals(loads(dumps(obj)), {
+                "events": [{"encoded": format}, 1],
+                "cursor": "2",
+            })
+            self.assertEquals(loads(dumps_array([], format)), [])
+
+    def test_bad_utf8(self):
+        dumps, loads = FORMATS["json"]
+        self.assertEquals(loads(dumps({"text": "caf\xe9"})),
+                          {"text": u"caf\ufffd"})
+
+if __name__ == '__main__':
+    unittest.main()
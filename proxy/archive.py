@@ -0,0 +1,243 @@
+
+import time
+import Queue
+import sqlite3
+import marshal
+import os.path
+import tempfile
+import threading
+import shutil
+import unittest
+
+from event import Event
+
+# The most events written in one transaction
+ARCHIVE_BATCH_SIZE = 1000
+
+# Events waiting to be written.  Past this, new events are dropped rather
+# than making IRC processing wait for the disk.
+ARCHIVE_QUEUE_SIZE = 100000
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY,
+        server TEXT NOT NULL,
+        channel TEXT,
+        event BLOB NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS events_by_list ON events (server, channel, id);
+    CREATE VIRTUAL TABLE IF NOT EXISTS events_text USING fts4 (text);
+"""
+
+def _to_unicode(text):
+    if isinstance(text, unicode):
+        return text
+    return text.decode("utf-8", "replace")
+
+class EventArchive(object):
+    '''Keeps every event in an SQLite database, with a full text index.
+
+    Unlike an `EventLog`, nothing is ever evicted from the archive, so it
+    holds the whole history of each server and channel, and it can be
+    searched.
+
+    `add` only queues an event, so it never waits for the disk.  A writer
+    thread takes events off the queue and writes everything that has built
+    up in one transaction, up to `ARCHIVE_BATCH_SIZE` at a time.  Searches
+    use their own connection per thread, and the database is in WAL mode,
+    so they don't wait for the writer either.
+
+    Each archived event gets an id, which is only used for paging through
+    search results.  Sequence numbers start again when the proxy restarts
+    (unless the event log is on disk), so they can't be used for this.
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.dropped = 0  # Events that didn't fit in the queue
+
+        self._queue = Queue.Queue(ARCHIVE_QUEUE_SIZE)
+        self._local = threading.local()
+
+        db = self._connect()
+        db.execute("PRAGMA journal_mode = WAL")
+        db.executescript(SCHEMA)
+        db.close()
+
+        self._writer = threading.Thread(target=self._write_loop,
+                                        name="EventArchive writer")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def add(self, event, server_name, channel_name=None):
+        '''Queue event to be archived.
+
+        :param server_name:
+            Name of the server the event belongs to.
+
+        :param channel_name:
+            Name of the channel the event belongs to, or None if it belongs
+            to the server.
+
+        '''
+        try:
+            self._queue.put_nowait((event, server_name, channel_name))
+        except Queue.Full:
+            #TODO: Log
+            self.dropped += 1
+
+    def flush(self):
+        '''Wait until every event queued so far has been written.'''
+        self._queue.join()
+
+    def close(self):
+        '''Write any queued events and stop the writer thread.'''
+        self._queue.put(None)
+        self._writer.join()
+
+    def _write_loop(self):
+        db = self._connect()
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < ARCHIVE_BATCH_SIZE and batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            try:
+                with db:
+                    self._write(db, batch)
+            except sqlite3.Error:
+                #TODO: Log
+                self.dropped += len(batch)
+            for i in xrange(len(batch) + stop):
+                self._queue.task_done()
+            if stop:
+                break
+        db.close()
+
+    def _write(self, db, batch):
+        for event, server_name, channel_name in batch:
+            cursor = db.execute(
+                "INSERT INTO events (server, channel, event) VALUES (?, ?, ?)",
+                (server_name, channel_name,
+                 buffer(marshal.dumps(event.to_dict(), 2))))
+            if isinstance(event.text, basestring):
+                db.execute("INSERT INTO events_text (docid, text) VALUES (?, ?)",
+                           (cursor.lastrowid, _to_unicode(event.text)))
+
+    def search(self, query, server_name, channel_name=None, limit=100,
+               before=None):
+        '''Search the text of archived events, newest first.
+
+        :param query:
+            An SQLite full text query, such as ``hello`` or ``"hello world"``
+            or ``hello OR hi``.
+
+        :param server_name:
+            Only events from this server are searched.
+
+        :param channel_name:
+            If given, only events in this channel are searched.  Otherwise
+            the server's events, and those of all of its channels, are.
+
+        :param before:
+            Only events archived before the event with this id are searched.
+            Use the id returned with the previous page of results.
+
+        :returns:
+            (events, id), where events are `Event` records, and id is to be
+            passed as `before` to get the next page, or None if there are no
+            more results.
+
+        '''
+        sql = "SELECT events.id, events.event FROM events_text " \
+              "JOIN events ON events.id = events_text.docid " \
+              "WHERE events_text MATCH ? AND events.server = ?"
+        params = [_to_unicode(query), server_name]
+        if channel_name is not None:
+            sql += " AND events.channel = ?"
+            params.append(channel_name)
+        if before is not None:
+            sql += " AND events.id < ?"
+            params.append(before)
+        sql += " ORDER BY events.id DESC LIMIT ?"
+        params.append(limit)
+
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = self._connect()
+        try:
+            rows = db.execute(sql, params).fetchall()
+        except sqlite3.OperationalError as e:
+            raise ValueError(str(e))
+
+        events = [Event.from_dict(marshal.loads(str(data)))
+                  for id, data in rows]
+        next_before = rows[-1][0] if len(rows) == limit else None
+        return events, next_before
+
+
+class TestEventArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = EventArchive(os.path.join(self.directory, "archive"))
+
+    def tearDown(self):
+        self.archive.close()
+        shutil.rmtree(self.directory)
+
+    def add(self, text, channel_name="#chan", server_name="net"):
+        self.archive.add(Event("pubmsg", time.time(), server_name,
+                               target=channel_name, text=text),
+                         server_name, channel_name)
+
+    def texts(self, events):
+        return [event.text for event in events]
+
+    def test_search(self):
+        self.add("hello world")
+        self.add("goodbye world")
+        self.add("hello again", "#other")
+        self.add("hello there", None)
+        self.add("hello elsewhere", "#chan", "othernet")
+        self.archive.flush()
+
+        events, before = self.archive.search("hello", "net", "#chan")
+        self.assertEquals(self.texts(events), ["hello world"])
+        self.assertEquals(before, None)
+        events, before = self.archive.search("hello", "net")
+        self.assertEquals(self.texts(events),
+                          ["hello there", "hello again", "hello world"])
+        events, before = self.archive.search("world NOT goodbye", "net")
+        self.assertEquals(self.texts(events), ["hello world"])
+        self.assertRaises(ValueError, self.archive.search, '"', "net")
+
+    def test_pages(self):
+        for i in xrange(25):
+            self.add("message %d" % i)
+        self.add(u"caf\xe9 message".encode("utf-8"))
+        self.archive.flush()
+
+        pages = []
+        before = None
+        while True:
+            events, before = self.archive.search("message", "net", "#chan",
+                                                 10, before)
+            pages.append(self.texts(events))
+            if before is None:
+                break
+        self.assertEquals(map(len, pages), [10, 10, 6])
+        self.assertEquals(pages[0][1], "message 24")
+        self.assertEquals(pages[2][-1], "message 0")
+
+if __name__ == '__main__':
+    unittest.main()
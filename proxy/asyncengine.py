@@ -0,0 +1,705 @@
+
+import re
+import ssl
+import socket
+import traceback
+import unittest
+import xmlrpclib
+from xmlrpclib import Fault
+
+try:
+    import trollius as asyncio
+    from trollius import From, Return, coroutine
+except ImportError:
+    asyncio = None
+    coroutine = lambda func: func
+
+from proxy import IRCProxyServer, CONNECT_ATTEMPTS, CONNECT_BACKOFF_BASE, \
+                  CONNECT_BACKOFF_MAX, SLOW_METHODS, \
+                  XMLRPC_CONNECTION_TIMEOUT, _multicall_calls, _fault_struct, \
+                  _TestConf
+from common.securexmlrpc import cert_fingerprint, encode_response, \
+                                dumps_response
+from common import rpcformats
+from common.rpcformats import _UNEXPECTED_FAULT
+from eventcache import EventMarshaller
+from tools import backoff_delay
+
+# The subset of irclib's numeric reply names that ircevents knows about.
+# Other numerics are passed on as their number, like irclib does.
+NUMERIC_EVENTS = {
+    "001": "welcome",
+    "002": "yourhost",
+    "003": "created",
+    "004": "myinfo",
+    "005": "featurelist",
+    "221": "umodeis",
+    "250": "luserconns",
+    "251": "luserclient",
+    "252": "luserop",
+    "253": "luserunknown",
+    "254": "luserchannels",
+    "255": "luserme",
+    "265": "n_local",
+    "266": "n_global",
+    "353": "namreply",
+    "366": "endofnames",
+    "372": "motd",
+    "375": "motdstart",
+    "376": "endofmotd",
+    "403": "nosuchchannel",
+}
+
+# Largest XMLRPC request body accepted.  A request claiming a larger one is
+# refused with 413 before any of the body is read.
+XMLRPC_MAX_REQUEST_BYTES = 16*1024*1024
+
+_line_regexp = re.compile(
+    "^(:(?P<prefix>[^ ]+) +)?(?P<command>[^ ]+)( *(?P<argument> .+))?")
+
+def _is_channel(target):
+    return target and target[0] in "#&+!"
+
+class AsyncIRCProxyServer(IRCProxyServer):
+    '''An IRCProxyServer that runs on an asyncio event loop.
+
+    This serves exactly the same XMLRPC methods as `IRCProxyServer`, and
+    reuses its dispatching, `RemoteIRCServer` and `RemoteIRCChannel`.  The
+    difference is in how I/O is done: every IRC connection and every client
+    connection is a coroutine on one event loop, and TLS is done by the event
+    loop.  Nothing ever blocks, so no threads are needed however many
+    networks, channels and clients there are.
+
+    On Python 2 the trollius port of asyncio is used.  Select this engine with
+    ``engine = "asyncio"`` in proxy.conf.
+
+    '''
+
+    def __init__(self, conf):
+        if asyncio is None:
+            raise RuntimeError('The "trollius" module is required by the '
+                               'asyncio engine, but could not be imported.')
+
+        self._init_state(conf)
+        self.conf = conf
+        self.loop = asyncio.get_event_loop()
+        self.reconnector = self._make_reconnector(conf, self.loop.call_later,
+                                                  self._reconnect_attempt)
+
+    def _make_ssl_context(self, conf):
+        '''Build the SSLContext that XMLRPC clients connect with.
+
+        Checks the same things, in the same way, as IRCProxyServer.
+
+        '''
+        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+        context.load_cert_chain(conf.cert_file, conf.key_file or None)
+        if conf.accepted_certs_file:
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.load_verify_locations(conf.accepted_certs_file)
+        else:
+            context.verify_mode = ssl.CERT_NONE
+        return context
+
+    def _run(self):
+        '''Run proxy server forever in a loop.'''
+        if self.stream_server:
+            self.stream_server.start()
+        self.loop.run_until_complete(asyncio.start_server(
+            self._handle_client,
+            self.conf.bind_address,
+            self.conf.bind_port,
+            ssl = self._make_ssl_context(self.conf),
+            loop = self.loop,
+        ))
+        self.loop.run_forever()
+
+    @coroutine
+    def _handle_client(self, reader, writer):
+        '''Serve XMLRPC requests on one client connection.
+
+        Connections are kept open between requests when the client asks for
+        HTTP/1.1 keep-alive, until they are idle for xmlrpc_idle_timeout.
+        Once a request starts, all of it has to arrive within
+        XMLRPC_CONNECTION_TIMEOUT.
+
+        '''
+        idle_timeout = self.conf.xmlrpc_idle_timeout
+        compress_threshold = self.conf.xmlrpc_compress_threshold or None
+        sslsocket = writer.get_extra_info("ssl_object") or \
+            writer.get_extra_info("socket")
+        # Only TLS connections have a certificate
+        client_id = cert_fingerprint(sslsocket) \
+            if hasattr(sslsocket, "getpeercert") else None
+        try:
+            while True:
+                start = yield From(asyncio.wait_for(reader.read(1),
+                    idle_timeout or XMLRPC_CONNECTION_TIMEOUT, loop=self.loop))
+                if not start:
+                    break
+                http_method, version, headers, error, body = yield From(
+                    asyncio.wait_for(self._read_request(reader, start),
+                                     XMLRPC_CONNECTION_TIMEOUT,
+                                     loop=self.loop))
+
+                keep_alive = bool(idle_timeout) and version == "HTTP/1.1" \
+                    and headers.get("connection", "").lower() != "close"
+                format = rpcformats.format_for(
+                    headers.get("content-type", ""))
+                if error is not None:
+                    # The body is still unread, so nothing more can be read
+                    # from the connection
+                    status, response = error, ""
+                    keep_alive = False
+                elif http_method != "POST":
+                    status, response = "501 Not Implemented", ""
+                    keep_alive = False
+                else:
+                    status = "200 OK"
+                    response = yield From(self._marshaled_dispatch(body,
+                        client_id, format))
+
+                response_headers, pieces = encode_response(
+                    response, headers.get("accept-encoding", ""),
+                    version == "HTTP/1.1", compress_threshold)
+                writer.write(
+                    "HTTP/1.1 %s\r\n"
+                    "Content-Type: %s\r\n"
+                    "%s"
+                    "Connection: %s\r\n"
+                    "\r\n" % (status,
+                              rpcformats.CONTENT_TYPES.get(format, "text/xml"),
+                              "".join("%s: %s\r\n" % header
+                                      for header in response_headers),
+                              "keep-alive" if keep_alive else "close"))
+                for piece in pieces:
+                    writer.write(piece)
+                    # Don't compress faster than the client takes it
+                    yield From(writer.drain())
+                if not keep_alive:
+                    break
+
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ValueError, ssl.SSLError, socket.error):
+            pass
+        finally:
+            writer.close()
+
+    @coroutine
+    def _read_request(self, reader, start):
+        '''Read an HTTP request, whose first byte, start, has already been
+        read.
+
+        :returns:
+            (http_method, version, headers, error, body), with header names
+            in lower case.  error is the status to answer with if the
+            request's Content-Length is bad or over XMLRPC_MAX_REQUEST_BYTES,
+            and body is then None, as it hasn't been read.  Otherwise error
+            is None.
+
+        '''
+        request_line = start + (yield From(reader.readline()))
+        http_method, path, version = request_line.split(None, 2)
+        version = version.strip()
+
+        headers = {}
+        while True:
+            line = yield From(reader.readline())
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            error = "400 Bad Request"
+        elif length > XMLRPC_MAX_REQUEST_BYTES:
+            error = "413 Request Entity Too Large"
+        else:
+            body = yield From(reader.readexactly(length))
+            raise Return((http_method, version, headers, None, body))
+        raise Return((http_method, version, headers, error, None))
+
+    @coroutine
+    def _marshaled_dispatch(self, data, client_id=None, format=None):
+        '''Like SimpleXMLRPCDispatcher._marshaled_dispatch.
+
+        :param client_id:
+            Certificate fingerprint of the client the request is from.
+
+        :param format:
+            Encoding of the request and response, from `common.rpcformats`,
+            or None for XMLRPC.
+
+        '''
+        if format is not None:
+            response = yield From(self._format_dispatch(data, client_id,
+                                                        format))
+            raise Return(response)
+        try:
+            params, method = xmlrpclib.loads(data)
+            result = yield From(self._call_any(method, params, client_id))
+            response = dumps_response((result,), EventMarshaller)
+        except Fault as fault:
+            response = xmlrpclib.dumps(fault)
+        except Exception:
+            #TODO: Log
+            traceback.print_exc()
+            response = xmlrpclib.dumps(_UNEXPECTED_FAULT)
+        raise Return(response)
+
+    @coroutine
+    def _format_dispatch(self, data, client_id, format):
+        '''Like `rpcformats.marshaled_dispatch`, but with each call made by
+        `_call_any`.'''
+        try:
+            calls, batch = rpcformats.parse_request(data, format)
+        except Fault as fault:
+            raise Return(rpcformats.dumps_response([(None, fault)], False,
+                                                   format))
+        results = []
+        for request_id, call in calls:
+            try:
+                if isinstance(call, Fault):
+                    raise call
+                result = yield From(self._call_any(call[0], call[1],
+                                                   client_id))
+            except Fault as fault:
+                result = fault
+            except Exception:
+                #TODO: Log
+                traceback.print_exc()
+                result = _UNEXPECTED_FAULT
+            results.append((request_id, result))
+        raise Return(rpcformats.dumps_response(results, batch, format))
+
+    @coroutine
+    def _call_any(self, method, params, client_id):
+        '''Make one call, which may be a system.multicall.'''
+        if method == "system.multicall":
+            result = yield From(self._multicall_async(params, client_id))
+        else:
+            result = yield From(self._call(method, params, client_id))
+        raise Return(result)
+
+    @coroutine
+    def _call(self, method, params, client_id):
+        '''Make one XMLRPC call, and return its result.
+
+        Methods in `SLOW_METHODS` are run in the loop's default executor, so
+        they don't hold up IRC processing.
+
+        '''
+        wait = self._event_wait(method, params, client_id)
+        if wait is not None:
+            yield From(self._park(*wait))
+        if method in SLOW_METHODS:
+            result = yield From(self.loop.run_in_executor(
+                None, self._dispatch, method, params))
+        else:
+            # Other requests run between yields, so this is only set around
+            # the call
+            self._request.client_id = client_id
+            try:
+                result = self._dispatch(method, params)
+            finally:
+                self._request.client_id = None
+        raise Return(result)
+
+    @coroutine
+    def _multicall_async(self, params, client_id):
+        '''Like IRCProxyServer._multicall, but each call is made with
+        `_call`, so slow calls still run in the executor.'''
+        results = []
+        for call in _multicall_calls(params):
+            try:
+                if isinstance(call, Fault):
+                    raise call
+                result = yield From(self._call(call[0], call[1], client_id))
+                results.append([result])
+            except Fault as fault:
+                results.append(_fault_struct(fault))
+        raise Return(results)
+
+    @coroutine
+    def _park(self, seq, timeout):
+        '''Wait for an event after seq, or for timeout seconds, as
+        `_event_wait` says a call should.
+
+        The request waits on a future that the event log resolves, so no
+        thread is tied up.
+
+        '''
+        woken = asyncio.Future(loop=self.loop)
+        def resolve():
+            if not woken.done():
+                woken.set_result(None)
+        def wake():
+            self.loop.call_soon_threadsafe(resolve)
+        self.event_log.add_waiter(wake)
+        try:
+            # Checked again, in case of an event since last_seq was read
+            if seq == self.event_log.last_seq():
+                yield From(asyncio.wait_for(woken, timeout, loop=self.loop))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.event_log.remove_waiter(wake)
+
+    def _new_connection(self):
+        return AsyncIRCConnection(self)
+
+    def _call_soon_threadsafe(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def _call_later_threadsafe(self, delay, callback):
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, callback)
+
+    def _connect_server(self, remote_server):
+        '''Start a task that connects remote_server.'''
+        asyncio.ensure_future(self._connect_task(remote_server),
+                              loop=self.loop)
+
+    @coroutine
+    def _connect_task(self, remote_server):
+        for attempt in xrange(CONNECT_ATTEMPTS):
+            if attempt:
+                yield From(asyncio.sleep(backoff_delay(attempt-1,
+                    CONNECT_BACKOFF_BASE, CONNECT_BACKOFF_MAX), loop=self.loop))
+            if not self._is_current_server(remote_server):
+                return  # Disconnected while waiting to retry
+            self.events.append(type="server_connecting",
+                               server=remote_server.server_name,
+                               attempt=attempt+1)
+            connected = yield From(remote_server.connection.connect(
+                remote_server.uri, remote_server.port, remote_server.nick_name,
+                remote_server.password, remote_server.ssl, remote_server.ipv6))
+            if connected:
+                self._connect_succeeded(remote_server)
+                return
+        self._connect_failed(remote_server)
+
+    def _reconnect_attempt(self, remote_server, attempt):
+        asyncio.ensure_future(self._reconnect_task(remote_server, attempt),
+                              loop=self.loop)
+
+    @coroutine
+    def _reconnect_task(self, remote_server, attempt):
+        self.events.append(type="server_connecting",
+                           server=remote_server.server_name,
+                           attempt=attempt+1)
+        connected = yield From(remote_server.connection.connect(
+            remote_server.uri, remote_server.port, remote_server.nick_name,
+            remote_server.password, remote_server.ssl, remote_server.ipv6))
+        self.reconnector.attempt_finished(remote_server, connected)
+        if connected:
+            self._connect_succeeded(remote_server)
+
+class AsyncIRCConnection(object):
+    '''An IRC server connection on an asyncio event loop.
+
+    Implements the parts of irclib's ServerConnection that the proxy uses.
+    Incoming lines are parsed into irclib style events and given to
+    `IRCProxyServer._handle_irc_event`, so `ircevents` handles them exactly
+    as it handles events from irclib.
+
+    '''
+
+    def __init__(self, proxy_server):
+        self.proxy_server = proxy_server
+        self.loop = proxy_server.loop
+        self.socket = None  # The StreamWriter while connected
+        self.connected = False
+        self.server = None
+
+    @coroutine
+    def connect(self, server, port, nickname, password=None, ssl=False,
+                ipv6=False):
+        '''Connect and log on.  Returns True if a connection was made.'''
+        self.server = server
+        try:
+            reader, writer = yield From(asyncio.open_connection(
+                server, port,
+                ssl = _irc_ssl_context() if ssl else None,
+                family = socket.AF_INET6 if ipv6 else socket.AF_INET,
+                loop = self.loop,
+            ))
+        except (socket.error, OSError):
+            raise Return(False)
+
+        self.socket = writer
+        self.connected = True
+        if password:
+            self.send_raw("PASS " + password)
+        self.send_raw("NICK " + nickname)
+        self.send_raw("USER %s 0 * :%s" % (nickname, nickname))
+        asyncio.ensure_future(self._read_lines(reader), loop=self.loop)
+        raise Return(True)
+
+    @coroutine
+    def _read_lines(self, reader):
+        while self.connected:
+            try:
+                line = yield From(reader.readline())
+            except (socket.error, OSError):
+                line = ""
+            if not line:
+                self._closed("Connection reset by peer")
+                break
+            self._handle_line(line.rstrip("\r\n"))
+
+    def _handle_line(self, line):
+        '''Parse one line from the server, in the same way irclib does.'''
+        match = _line_regexp.match(line)
+        if not match:
+            return
+        prefix = match.group("prefix")
+        command = match.group("command").lower()
+        arguments = []
+        if match.group("argument"):
+            split = match.group("argument").split(" :", 1)
+            arguments = split[0].split()
+            if len(split) == 2:
+                arguments.append(split[1])
+        command = NUMERIC_EVENTS.get(command, command)
+
+        if command == "ping":
+            self.send_raw("PONG " + (arguments[0] if arguments else ""))
+            return
+
+        if command in ("privmsg", "notice"):
+            target, message = arguments[0], arguments[1]
+            if command == "privmsg":
+                if _is_channel(target):
+                    command = "pubmsg"
+            elif _is_channel(target):
+                command = "pubnotice"
+            else:
+                command = "privnotice"
+            self._emit(command, prefix, target, [message])
+        else:
+            target = None
+            if command == "quit":
+                arguments = arguments[:1]
+            elif arguments:
+                target = arguments[0]
+                arguments = arguments[1:]
+            if command == "mode" and not _is_channel(target):
+                command = "umode"
+            self._emit(command, prefix, target, arguments)
+
+    def _emit(self, eventtype, source, target, arguments):
+        self.proxy_server._handle_irc_event(self,
+            _Event(eventtype, source, target, arguments))
+
+    def _closed(self, message):
+        if not self.connected:
+            return
+        self.connected = False
+        self.socket.close()
+        self.socket = None
+        self._emit("disconnect", self.server, "", [message])
+
+    def send_raw(self, string):
+        if self.socket:
+            self.socket.write(string + "\r\n")
+
+    def join(self, channel, key=""):
+        self.send_raw("JOIN %s%s" % (channel, (key and (" " + key))))
+
+    def part(self, channels, message=""):
+        if isinstance(channels, basestring):
+            channels = [channels]
+        self.send_raw("PART " + ",".join(channels) +
+                      (message and (" :" + message)))
+
+    def privmsg(self, target, text):
+        self.send_raw("PRIVMSG %s :%s" % (target, text))
+
+    def quit(self, message=""):
+        self.send_raw("QUIT" + (message and (" :" + message)))
+
+    def disconnect(self, message=""):
+        if self.connected:
+            self.quit(message)
+            self._closed(message)
+
+class _Event(object):
+    '''Stands in for irclib.Event.'''
+
+    def __init__(self, eventtype, source, target, arguments):
+        self._eventtype = eventtype
+        self._source = source
+        self._target = target
+        self._arguments = arguments
+
+def _irc_ssl_context():
+    '''TLS settings for connecting to IRC servers.
+
+    Like irclib, the server certificate is not checked.
+
+    '''
+    #TODO: Check IRC server certificates
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+@unittest.skipIf(asyncio is None, "trollius is not installed")
+class TestAsyncIRCProxyServer(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.proxy = AsyncIRCProxyServer(_TestConf())
+        self.irc_lines = []
+        self.irc_writer = None
+        self.servers = []
+
+    def tearDown(self):
+        for server_name in self.proxy.server_list():
+            self.proxy.server_disconnect(server_name)
+        for server in self.servers:
+            server.close()
+        # Lets the connections see they are closed
+        self.loop.run_until_complete(asyncio.sleep(0.05, loop=self.loop))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def start_server(self, handle):
+        server = self.loop.run_until_complete(asyncio.start_server(
+            handle, "127.0.0.1", 0, loop=self.loop))
+        self.servers.append(server)
+        return server.sockets[0].getsockname()[1]
+
+    @coroutine
+    def handle_irc(self, reader, writer):
+        self.irc_writer = writer
+        writer.write(":irc.test 001 nick :Welcome\r\n")
+        while True:
+            line = yield From(reader.readline())
+            if not line:
+                break
+            self.irc_lines.append(line.rstrip("\r\n"))
+
+    def run_until(self, condition, timeout=5):
+        for i in xrange(int(timeout / 0.01)):
+            if condition():
+                return
+            self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        self.fail("Timed out")
+
+    def call(self, method, *params):
+        response = self.loop.run_until_complete(
+            self.proxy._marshaled_dispatch(xmlrpclib.dumps(params, method)))
+        return xmlrpclib.loads(response)[0][0]
+
+    def test_irc(self):
+        port = self.start_server(self.handle_irc)
+        self.assertEquals(self.call("server_connect", "net", "nick",
+                                    "127.0.0.1", port), "connecting")
+        self.run_until(lambda: self.call("server_state", "net") ==
+                               "connected")
+        self.assertEquals(self.irc_lines, ["NICK nick",
+                                           "USER nick 0 * :nick"])
+
+        self.call("channel_join", "net", "#chan")
+        self.call("channel_message", "net", "#chan", "hi")
+        self.run_until(lambda: len(self.irc_lines) == 4)
+        self.assertEquals(self.irc_lines[2:], ["JOIN #chan",
+                                               "PRIVMSG #chan :hi"])
+
+        self.irc_writer.write(":alice!a@host PRIVMSG #chan :hello\r\n")
+        def received():
+            return [event.get('text') for event in
+                    self.call("get_events_after", "0")['events']
+                    if event['type'] == "pubmsg"]
+        self.run_until(lambda: received() == ["hello"])
+
+    def test_http(self):
+        port = self.start_server(self.proxy._handle_client)
+        body = xmlrpclib.dumps((), "server_list")
+        request = "POST / HTTP/1.1\r\nContent-Length: %s\r\n\r\n%s" % (
+            len(body), body)
+
+        @coroutine
+        def client():
+            reader, writer = yield From(asyncio.open_connection(
+                "127.0.0.1", port, loop=self.loop))
+            responses = []
+            for i in xrange(2):  # Both on one connection
+                writer.write(request)
+                headers = {}
+                status = yield From(reader.readline())
+                while True:
+                    line = yield From(reader.readline())
+                    if line == "\r\n":
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.lower()] = value.strip()
+                body = yield From(reader.readexactly(
+                    int(headers["content-length"])))
+                responses.append((status.split()[1],
+                                  headers["connection"],
+                                  xmlrpclib.loads(body)[0][0]))
+            writer.close()
+            raise Return(responses)
+
+        self.assertEquals(self.loop.run_until_complete(client()),
+                          [("200", "keep-alive", [])] * 2)
+
+    def test_bad_requests(self):
+        port = self.start_server(self.proxy._handle_client)
+
+        @coroutine
+        def request(data):
+            reader, writer = yield From(asyncio.open_connection(
+                "127.0.0.1", port, loop=self.loop))
+            writer.write(data)
+            response = yield From(asyncio.wait_for(reader.read(),
+                                                   2, loop=self.loop))
+            writer.close()
+            raise Return(response)
+        def status(data):
+            response = self.loop.run_until_complete(request(data))
+            return response.split("\r\n", 1)[0]
+
+        self.assertEquals(
+            status("POST / HTTP/1.1\r\nContent-Length: ten\r\n\r\n"),
+            "HTTP/1.1 400 Bad Request")
+        self.assertEquals(
+            status("POST / HTTP/1.1\r\nContent-Length: -1\r\n\r\n"),
+            "HTTP/1.1 400 Bad Request")
+        self.assertEquals(
+            status("POST / HTTP/1.1\r\nContent-Length: %s\r\n\r\n"
+                   % (XMLRPC_MAX_REQUEST_BYTES + 1)),
+            "HTTP/1.1 413 Request Entity Too Large")
+
+        # A request that stalls part way is dropped
+        global XMLRPC_CONNECTION_TIMEOUT
+        timeout, XMLRPC_CONNECTION_TIMEOUT = XMLRPC_CONNECTION_TIMEOUT, 0.1
+        try:
+            self.assertEquals(self.loop.run_until_complete(request(
+                "POST / HTTP/1.1\r\nContent-Length: 10\r\n\r\nabc")), "")
+        finally:
+            XMLRPC_CONNECTION_TIMEOUT = timeout
+
+    def test_wait_for_events(self):
+        cursor = str(self.proxy.event_log.last_seq())
+        body = xmlrpclib.dumps((cursor, 5), "wait_for_events")
+        waiting = asyncio.ensure_future(self.proxy._marshaled_dispatch(body),
+                                        loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0.05, loop=self.loop))
+        self.assertFalse(waiting.done())
+
+        self.proxy.events.append(type="test")
+        self.run_until(waiting.done, 1)
+        result = xmlrpclib.loads(waiting.result())[0][0]
+        self.assertEquals([event['type'] for event in result['events']],
+                          ["test"])
+
+if __name__ == '__main__':
+    unittest.main()
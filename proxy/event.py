@@ -0,0 +1,143 @@
+
+import sys
+import unittest
+
+# Fields that almost every event has get a slot each.  The rest are rare
+# enough to live in a per-event dictionary.
+SLOT_FIELDS = ("type", "time", "server", "source", "target", "text")
+
+def intern_string(string):
+    '''Intern string, so that equal strings share one object.
+
+    Only byte strings can be interned.  Anything else is returned unchanged.
+
+    '''
+    if type(string) is str:
+        return intern(string)
+    return string
+
+class Event(object):
+    '''A compact record of one event.
+
+    Events are stored by the million, so rather than a dictionary each, they
+    are objects with `__slots__`, and the strings that repeat from event to
+    event (type, server, source and target) are interned.  An event is only
+    turned into a dictionary with `to_dict`, when it is sent to a client.
+
+    Fields are read like dictionary items, so code that handled events as
+    dictionaries works unchanged.  A field that is None is missing.
+
+    '''
+
+    __slots__ = SLOT_FIELDS + ("seq", "extra")
+
+    def __init__(self, type, time=None, server=None, source=None, target=None,
+                 text=None, seq=None, **extra):
+        self.type = intern_string(type)
+        self.time = time
+        self.server = intern_string(server)
+        self.source = intern_string(source)
+        self.target = intern_string(target)
+        self.text = text
+        self.seq = seq
+        self.extra = extra or None
+
+    @classmethod
+    def from_dict(cls, fields):
+        fields = dict(fields)
+        if "type" not in fields:
+            raise ValueError("Event must have a type."
+                             "Erronous event: %s" % fields)
+        return cls(**fields)
+
+    def to_dict(self):
+        '''Return the event as a dictionary, without missing fields.
+
+        XMLRPC integers are only 32 bits, so the sequence number is given as a
+        decimal string.
+
+        '''
+        fields = {}
+        for name in SLOT_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                fields[name] = value
+        if self.seq is not None:
+            fields['seq'] = str(self.seq)
+        if self.extra:
+            fields.update(self.extra)
+        return fields
+
+    def __getitem__(self, name):
+        if name in SLOT_FIELDS:
+            value = getattr(self, name)
+        elif self.extra:
+            value = self.extra.get(name)
+        else:
+            value = None
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        if name in SLOT_FIELDS:
+            setattr(self, name, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[name] = value
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __eq__(self, other):
+        if isinstance(other, Event):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Event(%r)" % self.to_dict()
+
+    def approximate_size(self):
+        '''Roughly how many bytes of memory this event takes up.
+
+        Interned strings are shared with other events, so are not counted.
+
+        '''
+        size = sys.getsizeof(self) + sys.getsizeof(self.time)
+        if self.text is not None:
+            size += sys.getsizeof(self.text)
+        if self.extra:
+            size += sys.getsizeof(self.extra)
+            for value in self.extra.itervalues():
+                size += sys.getsizeof(value)
+        return size
+
+
+class TestEvent(unittest.TestCase):
+
+    def test_fields(self):
+        event = Event("pubmsg", 1.0, server="net", text="hi", extra_field=3)
+        self.assertEquals(event.to_dict(), {'type': "pubmsg", 'time': 1.0,
+            'server': "net", 'text': "hi", 'extra_field': 3})
+        self.assertEquals(event['server'], "net")
+        self.assertTrue("extra_field" in event)
+        self.assertFalse("target" in event)
+        self.assertRaises(KeyError, lambda: event['target'])
+
+    def test_interned(self):
+        a = Event("pubmsg", server="".join(["ne", "t"]))
+        b = Event("pubmsg", server="".join(["n", "et"]))
+        self.assertTrue(a.server is b.server)
+
+if __name__ == '__main__':
+    unittest.main()
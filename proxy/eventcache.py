@@ -0,0 +1,203 @@
+
+import threading
+import unittest
+import xmlrpclib
+from collections import OrderedDict
+
+from common.streamframes import FORMATS, Fragment, dumps_array
+from common.securexmlrpc import dumps_response
+from event import Event
+
+# Types of events that are made up for a response, rather than read from the
+# log.  They can have the same sequence number as an event in the log, so
+# aren't cached.
+RESPONSE_ONLY_TYPES = frozenset(["history_truncated",
+                                 "session_backlog_skipped"])
+
+def event_encoder(format):
+    '''Return a function that encodes an event in format: "xml" for an
+    XMLRPC <value>, or a key of `common.streamframes.FORMATS`.'''
+    if format == "xml":
+        marshaller = xmlrpclib.Marshaller("utf-8")
+        def encode(event):
+            out = []
+            marshaller.dump_struct(event.to_dict(), out.append)
+            return "".join(out)
+    else:
+        dumps = FORMATS[format][0]
+        def encode(event):
+            return dumps(event.to_dict())
+    return encode
+
+class EventCache(object):
+    '''The encodings of events that have been sent, so that sending them
+    again is a lookup rather than encoding them again.
+
+    Every client that reads the same events gets the same bytes, so only the
+    first pays to encode an event, once for each format it is sent in.
+    Entries are kept in the order they were added, and the oldest are
+    dropped once they total more than max_bytes, like a ring.  The `EventLog`
+    an EventCache belongs to also drops an event's entries as soon as the
+    event is removed from the log, so nothing is kept for events that
+    retention has evicted.
+
+    Events are looked up by sequence number, as a log kept on disk reads a
+    new `Event` every time.
+
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0  # Bytes of the encodings held
+        self._encodings = OrderedDict()  # (format, seq) -> bytes
+        self._formats = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._encodings)
+
+    def encode(self, events, format):
+        '''Return a list of events encoded in format, as `event_encoder`
+        encodes them.'''
+        encode = event_encoder(format)
+        encodings = self._encodings
+        items = []
+        added = []
+        for event in events:
+            if event.seq is None or event.type in RESPONSE_ONLY_TYPES:
+                items.append(encode(event))
+                continue
+            key = (format, event.seq)
+            data = encodings.get(key)
+            if data is None:
+                data = encode(event)
+                added.append((key, data))
+            items.append(data)
+        if added:
+            self._add(format, added)
+        return items
+
+    def _add(self, format, added):
+        encodings = self._encodings
+        with self._lock:
+            self._formats.add(format)
+            for key, data in added:
+                # Another thread may have encoded it too
+                if key not in encodings and len(data) <= self.max_bytes:
+                    encodings[key] = data
+                    self.size += len(data)
+            while self.size > self.max_bytes:
+                self.size -= len(encodings.popitem(last=False)[1])
+
+    def discard(self, seq):
+        '''Drop the encodings of the event numbered seq.'''
+        with self._lock:
+            for format in self._formats:
+                data = self._encodings.pop((format, seq), None)
+                if data is not None:
+                    self.size -= len(data)
+
+    def wrap(self, events):
+        '''Return events, a list of `Event`s, ready to send in a response.'''
+        return EncodedEvents(events, self)
+
+class EncodedEvents(Fragment):
+    '''A list of events in a response, which is encoded from the encodings of
+    each event in an `EventCache`.
+
+    It takes the place of the list of event dictionaries, for XMLRPC, JSON
+    and msgpack alike.  Iterating over it gives the dictionaries.
+
+    '''
+
+    __slots__ = ("events", "cache")
+
+    def __init__(self, events, cache=None):
+        '''
+        :param cache:
+            The EventCache to encode events with, or None to encode them
+            every time.
+
+        '''
+        self.events = events
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.events)
+
+    def __iter__(self):
+        return (event.to_dict() for event in self.events)
+
+    def encoded(self, format):
+        if self.cache is not None:
+            items = self.cache.encode(self.events, format)
+        else:
+            items = map(event_encoder(format), self.events)
+        if format == "xml":
+            return "<value><array><data>\n%s</data></array></value>\n" % \
+                "".join(items)
+        return dumps_array(items, format)
+
+def _dump_encoded_events(marshaller, value, write):
+    if marshaller.encoding in (None, "utf-8"):
+        write(value.encoded("xml"))
+    else:
+        marshaller.dump_array(list(value), write)
+
+class EventMarshaller(xmlrpclib.Marshaller):
+    '''xmlrpclib's Marshaller, which also marshals `EncodedEvents`.  The
+    proxy encodes its XMLRPC responses with it.  xmlrpclib's own Marshaller
+    is left as it is.'''
+
+    # xmlrpclib looks up how to marshal a value by its exact type
+    dispatch = dict(xmlrpclib.Marshaller.dispatch)
+    dispatch[EncodedEvents] = _dump_encoded_events
+
+
+class TestEventCache(unittest.TestCase):
+
+    def setUp(self):
+        self.events = [Event("pubmsg", 1.0, "net", "nick!u@h", "#chan",
+                             u"h\xe9llo %d" % seq, seq=seq)
+                       for seq in xrange(1, 11)]
+        self.dicts = [event.to_dict() for event in self.events]
+
+    def test_encodings_match(self):
+        cache = EventCache(1024 * 1024)
+        for i in xrange(2):
+            result = {'events': cache.wrap(self.events), 'cursor': "10"}
+            self.assertEquals(
+                xmlrpclib.loads(dumps_response((result,),
+                                               EventMarshaller))[0][0],
+                {'events': self.dicts, 'cursor': "10"})
+            for format, (dumps, loads) in FORMATS.iteritems():
+                self.assertEquals(loads(dumps([result, 1])),
+                                  loads(dumps([{'events': self.dicts,
+                                                'cursor': "10"}, 1])))
+        self.assertEquals(len(cache), 10 * (len(FORMATS) + 1))
+        self.assertEquals(list(EncodedEvents(self.events)), self.dicts)
+        self.assertFalse(EncodedEvents in xmlrpclib.Marshaller.dispatch)
+
+    def test_bounded(self):
+        encode = event_encoder("json")
+        size = max(len(encode(event)) for event in self.events)
+        cache = EventCache(size * 3)
+        cache.encode(self.events, "json")
+        self.assertEquals(len(cache), 3)
+        self.assertTrue(cache.size <= size * 3)
+        self.assertTrue(("json", 10) in cache._encodings)
+        self.assertFalse(("json", 1) in cache._encodings)
+
+        cache.discard(10)
+        self.assertEquals(len(cache), 2)
+
+    def test_response_only(self):
+        cache = EventCache(1024 * 1024)
+        cache.encode(self.events[:1], "json")
+        skipped = Event("session_backlog_skipped", 2.0, seq=1, count=5)
+        data, = cache.encode([skipped], "json")
+        self.assertEquals(FORMATS["json"][1](data), skipped.to_dict())
+        self.assertEquals(len(cache), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,214 @@
+
+import re
+import time
+import unittest
+
+from event import Event
+
+# Characters that can be part of a nick, besides letters and digits.  A
+# mention is the nick with none of these (or a letter or digit) either side.
+_NICK_SPECIALS = r"\w\[\]\\`^{}|-"
+
+_mention_patterns = {}
+
+def _mention_pattern(nick):
+    pattern = _mention_patterns.get(nick)
+    if pattern is None:
+        if len(_mention_patterns) > 1000:
+            _mention_patterns.clear()
+        pattern = _mention_patterns[nick] = re.compile(
+            r"(?<![%s])%s(?![%s])" % (_NICK_SPECIALS, re.escape(nick),
+                                      _NICK_SPECIALS),
+            re.IGNORECASE)
+    return pattern
+
+class EventFilter(object):
+    '''Which events a client wants from the retrieval methods.
+
+    The servers and channels an event can come from are chosen with `servers`
+    and `channels`.  When either is given, the log only reads the event lists
+    of those servers and channels (and the proxy's own list), so the events
+    of other channels are never looked at, let alone sent.  The other
+    conditions are checked event by event, with `matches`.
+
+    "history_truncated" events from the lists read always match, so a
+    client knows when it has missed events, whatever they were.
+
+    '''
+
+    def __init__(self, servers=None, channels=None, types=None,
+                 exclude_types=(), mentions=False, nick_name=None):
+        '''
+        :param servers:
+            Names of servers whose events, and those of their channels, are
+            wanted.  If neither this nor `channels` is given, every server's
+            events are.
+
+        :param channels:
+            {server name: [channel name, ...]} of channels whose events are
+            wanted, without the rest of their server's.
+
+        :param types:
+            Event types wanted.  If None, every type is.
+
+        :param exclude_types:
+            Event types not wanted.
+
+        :param mentions:
+            If True, only events whose text mentions the user's nick, or that
+            are sent to the user's nick, such as private messages, are
+            wanted.
+
+        :param nick_name:
+            Function that takes a server name and returns the user's nick on
+            that server, or None.  Needed for `mentions`.
+
+        '''
+        self.servers = frozenset(servers) if servers is not None else None
+        self.channels = None
+        if channels is not None:
+            self.channels = dict((server_name, frozenset(channel_names))
+                                 for server_name, channel_names
+                                 in channels.iteritems())
+        self.types = frozenset(types) if types is not None else None
+        self.exclude_types = frozenset(exclude_types)
+        self.mentions = mentions
+        self.nick_name = nick_name
+
+    @classmethod
+    def from_dict(cls, spec, nick_name=None):
+        '''Make a filter from a dictionary, as given to the XMLRPC methods.
+
+        The keys are the same as the constructor's arguments, and all are
+        optional.  Raises ValueError if spec isn't a valid filter.
+
+        '''
+        if not isinstance(spec, dict):
+            raise ValueError("filter must be a struct.")
+        unknown = set(spec) - set(["servers", "channels", "types",
+                                   "exclude_types", "mentions"])
+        if unknown:
+            raise ValueError('Unknown filter field "%s".' % sorted(unknown)[0])
+
+        def names(field):
+            value = spec.get(field)
+            if value is None:
+                return None
+            if not isinstance(value, (list, tuple)) or \
+                    not all(isinstance(name, basestring) for name in value):
+                raise ValueError("filter %s must be a list of strings." %
+                                 field)
+            return value
+
+        channels = spec.get("channels")
+        if channels is not None:
+            if not isinstance(channels, dict):
+                raise ValueError("filter channels must be a struct of "
+                                 "server names to lists of channel names.")
+            for channel_names in channels.itervalues():
+                if not isinstance(channel_names, (list, tuple)) or \
+                        not all(isinstance(name, basestring)
+                                for name in channel_names):
+                    raise ValueError("filter channels must be a struct of "
+                                     "server names to lists of channel "
+                                     "names.")
+        mentions = spec.get("mentions", False)
+        if not isinstance(mentions, bool):
+            raise ValueError("filter mentions must be a boolean.")
+
+        return cls(names("servers"), channels, names("types"),
+                   names("exclude_types") or (), mentions, nick_name)
+
+    def selects_lists(self):
+        '''Whether only some servers and channels are wanted.'''
+        return self.servers is not None or self.channels is not None
+
+    def wants_list(self, event_list):
+        '''Whether events from event_list can be wanted.
+
+        Only meaningful if `selects_lists`.  The proxy's own list, which has
+        no server, is always wanted, as `matches` picks its events by server.
+
+        '''
+        server_name = event_list.labels.get("server")
+        if server_name is None:
+            return True
+        if self.servers is not None and server_name in self.servers:
+            return True
+        channel_name = event_list.labels.get("target")
+        return channel_name is not None and self.channels is not None and \
+            channel_name in self.channels.get(server_name, ())
+
+    def matches(self, event):
+        '''Whether event is wanted.'''
+        if event.type == "history_truncated":
+            return True
+        if event.type in self.exclude_types:
+            return False
+        if self.types is not None and event.type not in self.types:
+            return False
+        if self.selects_lists() and event.server is not None:
+            if self.servers is None or event.server not in self.servers:
+                if self.channels is None or event.target not in \
+                        self.channels.get(event.server, ()):
+                    return False
+        if self.mentions:
+            return self._mentions_nick(event)
+        return True
+
+    def _mentions_nick(self, event):
+        nick = self.nick_name(event.server) if self.nick_name else None
+        if not nick:
+            return False
+        if event.target is not None and event.target.lower() == nick.lower():
+            return True
+        return isinstance(event.text, basestring) and \
+            _mention_pattern(nick).search(event.text) is not None
+
+
+class TestEventFilter(unittest.TestCase):
+
+    def event(self, type="pubmsg", server="net", target="#chan", text="hi"):
+        return Event(type, time.time(), server, "someone", target, text)
+
+    def test_channels(self):
+        event_filter = EventFilter(servers=["other"],
+                                   channels={"net": ["#chan"]})
+        self.assertTrue(event_filter.selects_lists())
+        self.assertTrue(event_filter.matches(self.event()))
+        self.assertTrue(event_filter.matches(self.event(server="other")))
+        self.assertFalse(event_filter.matches(self.event(target="#else")))
+        self.assertFalse(event_filter.matches(self.event(target=None)))
+        self.assertTrue(event_filter.matches(self.event(server=None)))
+
+    def test_types(self):
+        event_filter = EventFilter(types=["pubmsg", "join"],
+                                   exclude_types=["join"])
+        self.assertFalse(event_filter.selects_lists())
+        self.assertTrue(event_filter.matches(self.event()))
+        self.assertFalse(event_filter.matches(self.event("join")))
+        self.assertFalse(event_filter.matches(self.event("part")))
+        self.assertTrue(event_filter.matches(self.event("history_truncated")))
+
+    def test_mentions(self):
+        event_filter = EventFilter(mentions=True,
+                                   nick_name={"net": "Me[1]"}.get)
+        matches = lambda **fields: event_filter.matches(self.event(**fields))
+        self.assertTrue(matches(text="hi me[1], how are you"))
+        self.assertTrue(matches(text="ME[1]: hi"))
+        self.assertFalse(matches(text="hi me[1]2"))
+        self.assertFalse(matches(text="hi"))
+        self.assertTrue(matches(target="me[1]"))
+        self.assertFalse(matches(server="other", text="me[1]"))
+
+    def test_from_dict(self):
+        event_filter = EventFilter.from_dict({"channels": {"net": ["#chan"]},
+                                              "exclude_types": ["join"]})
+        self.assertEquals(event_filter.channels, {"net": set(["#chan"])})
+        self.assertEquals(event_filter.exclude_types, set(["join"]))
+        for spec in ([], {"bogus": 1}, {"servers": "net"},
+                     {"channels": {"net": "#chan"}}, {"mentions": 1}):
+            self.assertRaises(ValueError, EventFilter.from_dict, spec)
+
+if __name__ == '__main__':
+    unittest.main()
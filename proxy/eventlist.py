@@ -1,24 +1,739 @@
 
 import time
+import threading
+import unittest
+from operator import attrgetter
+
+from ringbuffer import RingBuffer
+from event import Event
+from eventfilter import EventFilter
+
+RETENTION_LIMITS = ("max_events", "max_age", "max_bytes")
+
+class RetentionPolicy(object):
+    '''Limits on how many events an `EventList` keeps.
+
+    Any limit may be None, meaning there is no limit of that kind.
+
+    :param max_events:
+        Maximum number of events kept.
+
+    :param max_age:
+        Events older than this many seconds are evicted.
+
+    :param max_bytes:
+        Maximum approximate memory used by the events, as measured by
+        `Event.approximate_size`.
+
+    :param sink:
+        Called as sink(event) with each evicted event.  If None, evicted
+        events are dropped.
+
+    '''
+
+    def __init__(self, max_events=None, max_age=None, max_bytes=None,
+                 sink=None):
+        for name, value in (("max_events", max_events), ("max_age", max_age),
+                            ("max_bytes", max_bytes)):
+            if value is not None and \
+                    (not isinstance(value, (int, long, float)) or value <= 0):
+                raise ValueError('Retention limit "%s" must be a positive '
+                                 'number or None, not %r.' % (name, value))
+        if sink is not None and not callable(sink):
+            raise ValueError("Eviction sink must be callable.")
+        self.max_events = max_events
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.sink = sink
+
+    def override(self, limits):
+        '''Return a copy of this policy, with some limits replaced.
+
+        :param limits:
+            A dictionary mapping limit names (as in `RETENTION_LIMITS`) to
+            their new values.
+
+        '''
+        for name in limits:
+            if name not in RETENTION_LIMITS:
+                raise ValueError('Unknown retention limit "%s".' % name)
+        kwargs = dict((name, getattr(self, name)) for name in RETENTION_LIMITS)
+        kwargs.update(limits)
+        return RetentionPolicy(sink=self.sink, **kwargs)
+
+class Retention(object):
+    '''The retention policies configured for the proxy.
+
+    Limits are given as dictionaries with keys from `RETENTION_LIMITS`.  A
+    server's limits override the defaults, and a channel's limits override
+    its server's.
+
+    :param default:
+        Limits for every event list.
+
+    :param servers:
+        Maps server names to limits for that server and its channels.
+
+    :param channels:
+        Maps (server name, channel name) tuples to limits for that channel.
+
+    :param sink:
+        Passed on to every `RetentionPolicy`.
+
+    '''
+
+    def __init__(self, default=None, servers=None, channels=None, sink=None):
+        self.default = RetentionPolicy(sink=sink).override(default or {})
+        self.servers = {}
+        for server_name, limits in (servers or {}).iteritems():
+            self.servers[server_name] = self.default.override(limits)
+        self.channels = {}
+        for (server_name, channel_name), limits in \
+                (channels or {}).iteritems():
+            self.channels[(server_name, channel_name)] = \
+                self.policy(server_name).override(limits)
+
+    def policy(self, server_name=None, channel_name=None):
+        '''Return the RetentionPolicy for a server or channel.
+
+        With no arguments, the default policy is returned.
+
+        '''
+        if channel_name is not None and \
+                (server_name, channel_name) in self.channels:
+            return self.channels[(server_name, channel_name)]
+        return self.servers.get(server_name, self.default)
+
+# Events in each chunk of an EventLog.
+LOG_CHUNK_SIZE = 1024
+
+# Least time, in seconds, between sweeps of every EventList for events past
+# their max_age.
+AGE_SWEEP_INTERVAL = 1
+
+class _Chunk(object):
+    __slots__ = ("events", "live")
+
+    def __init__(self):
+        self.events = [None] * LOG_CHUNK_SIZE
+        self.live = 0  # Events not yet evicted
+
+class EventLog(object):
+    '''All of the proxy's events, in one log, in the order they were recorded.
+
+    Each event is given the next sequence number as it is appended.  Times
+    are never stamped earlier than the event before, so the log is ordered
+    by time as well.  An event's place in the log is worked out from its
+    sequence number.  The log is stored in chunks of LOG_CHUNK_SIZE events,
+    and a chunk is freed once all of its events have been evicted.
+
+    The log's secondary indexes are `EventList`s.  Each one holds the
+    sequence numbers of one server's or channel's events, or the proxy's own
+    events, and applies that list's retention policy.  So reading everything
+    new is a single read from the tail of the log, however many lists there
+    are.  Reading with an `EventFilter` that picks servers or channels reads
+    just their lists instead.
+
+    Lists append and read under the log's lock.  So once `last_seq` returns
+    n, every event numbered n or less is in the log.
+
+    Threads can block in `wait` until something is appended, and event loops
+    can ask to be called back with `add_waiter`.
+
+    If `event_cache` is set to an `EventCache`, events are dropped from it as
+    they are removed from the log.
+
+    If `retention` is set to a `Retention`, events restored from before a
+    restart, for lists that haven't been created again, are evicted by the
+    policy their list would have.  Otherwise they are kept until their list
+    takes them over.
+
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lists = set()
+        # The same lists, by server name and then channel name.  Lists with
+        # no server, and servers' own lists, are under None.
+        self._server_lists = {}
+
+        self._chunks = RingBuffer()  # _Chunk, or None once freed
+        # The latest event time before each chunk was started
+        self._chunk_times = RingBuffer()
+        self._first_seq = 1  # Sequence number of the start of _chunks[0]
+        self._last_seq = 0
+        self._latest_time = None
+        self._evicted_seq = 0  # Newest sequence number evicted from any list
+        # The lists that have evicted events, by the newest sequence number
+        # each has evicted, divided by LOG_CHUNK_SIZE.  So the lists that
+        # have evicted events in a range are found without checking every one.
+        self._truncations = {}
+        self._last_sweep = 0
+        # Events that were in the log before the proxy restarted, that no
+        # list has taken over yet, by list key.  Only persistent logs have any.
+        self._restored = {}
+        # Notified, and the waiters called, whenever an event is appended
+        self._appended = threading.Condition(self.lock)
+        self._waiters = []
+        self.event_cache = None
+        self.retention = None
+
+    def last_seq(self):
+        '''Return the sequence number of the latest event.'''
+        with self.lock:
+            return self._last_seq
+
+    def _append(self, event, event_list):
+        '''Number event and add it to the end of the log.
+
+        If event has no time, it is stamped with the current time, but never
+        earlier than the latest event, even if the clock steps backwards.
+
+        '''
+        if event.time is None:
+            event.time = max(time.time(), self._latest_time)
+        self._last_seq += 1
+        event.seq = self._last_seq
+        self._store(event, event_list)
+        self._latest_time = max(event.time, self._latest_time)
+        self._wake()
+
+    def _wake(self):
+        self._appended.notify_all()
+        if self._waiters:
+            waiters, self._waiters = self._waiters, []
+            for callback in waiters:
+                callback()
+
+    def wait(self, seq, timeout):
+        '''Block until there are events after seq, or for timeout seconds.
+
+        Returns at once if there already are.  A seq newer than the latest
+        event, such as one from before the proxy restarted, counts as having
+        events after it, as `get_events_after` returns everything for it.
+
+        :returns:
+            True if there are events after seq, False if the wait timed out.
+
+        '''
+        deadline = time.time() + timeout
+        with self.lock:
+            while seq == self._last_seq:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._appended.wait(remaining)
+            return True
+
+    def add_waiter(self, callback):
+        '''Call callback() once, when the next event is appended.
+
+        This is for event loops, which can't block in `wait`.  The callback is
+        called from whichever thread appends, with the log's lock held, so it
+        should only schedule work, with something like
+        `call_soon_threadsafe`.
+
+        '''
+        with self.lock:
+            self._waiters.append(callback)
+
+    def remove_waiter(self, callback):
+        '''Cancel a callback added with `add_waiter`, if it hasn't run.'''
+        with self.lock:
+            if callback in self._waiters:
+                self._waiters.remove(callback)
+
+    def _add_list(self, event_list):
+        '''Start indexing event_list.  The lock must be held.'''
+        self.lists.add(event_list)
+        channels = self._server_lists.setdefault(
+            event_list.labels.get("server"), {})
+        channels.setdefault(event_list.labels.get("target"),
+                            set()).add(event_list)
+
+    def _remove_list(self, event_list):
+        '''Stop indexing event_list.  The lock must be held.'''
+        self.lists.discard(event_list)
+        server_name = event_list.labels.get("server")
+        channel_name = event_list.labels.get("target")
+        channels = self._server_lists.get(server_name, {})
+        event_lists = channels.get(channel_name, set())
+        event_lists.discard(event_list)
+        if not event_lists:
+            channels.pop(channel_name, None)
+        if not channels:
+            self._server_lists.pop(server_name, None)
+        self._truncated(event_list, event_list._evicted_seq, 0)
+
+    def _wanted_lists(self, event_filter):
+        '''Return the lists event_filter wants, looking only at lists of
+        the servers it names.'''
+        wanted = set()
+        for event_lists in self._server_lists.get(None, {}).itervalues():
+            wanted.update(event_lists)
+        for server_name in event_filter.servers or ():
+            for event_lists in \
+                    self._server_lists.get(server_name, {}).itervalues():
+                wanted.update(event_lists)
+        for server_name, channel_names in \
+                (event_filter.channels or {}).iteritems():
+            channels = self._server_lists.get(server_name, {})
+            for channel_name in channel_names:
+                wanted.update(channels.get(channel_name, ()))
+        return wanted
+
+    def _truncated(self, event_list, old_seq, new_seq):
+        '''Move event_list in _truncations, now that the newest event it
+        has evicted is numbered new_seq rather than old_seq.  0 means none.
+
+        The lock must be held.
+
+        '''
+        old, new = old_seq // LOG_CHUNK_SIZE, new_seq // LOG_CHUNK_SIZE
+        if old_seq and new_seq and old == new:
+            return
+        if old_seq:
+            event_lists = self._truncations[old]
+            event_lists.discard(event_list)
+            if not event_lists:
+                del self._truncations[old]
+        if new_seq:
+            self._truncations.setdefault(new, set()).add(event_list)
+
+    def _truncated_events(self, first_seq, last_seq):
+        '''Return "history_truncated" events for the lists whose newest
+        evicted event is numbered first_seq to last_seq.
+
+        Costs no more than the number of chunks in the range, or the number
+        of lists that have evicted events, whichever is less.
+
+        '''
+        first, last = first_seq // LOG_CHUNK_SIZE, last_seq // LOG_CHUNK_SIZE
+        if last - first >= len(self._truncations):
+            numbers = [number for number in self._truncations
+                       if first <= number <= last]
+        else:
+            numbers = xrange(first, last + 1)
+        events = []
+        for number in numbers:
+            for event_list in self._truncations.get(number, ()):
+                if first_seq <= event_list._evicted_seq <= last_seq:
+                    events.append(event_list._truncated_event())
+        return events
+
+    def _truncated_events_since(self, start_time):
+        '''Return "history_truncated" events for the lists that have
+        evicted events newer than start_time.'''
+        first_seq = self._first_seq_since(start_time)
+        if first_seq <= self._first_seq:
+            # Events evicted from before the start of the log may be newer
+            first_seq = 0
+        return [event for event in
+                self._truncated_events(first_seq, self._last_seq)
+                if start_time < event.time]
+
+    def _store(self, event, event_list):
+        '''Store an event that has just been numbered.'''
+        position = event.seq - self._first_seq
+        index, offset = divmod(position, LOG_CHUNK_SIZE)
+        if index == len(self._chunks):
+            if index and self._chunks[-1] and not self._chunks[-1].live:
+                self._chunks[-1] = None
+            self._chunks.append(_Chunk())
+            self._chunk_times.append(self._latest_time)
+            self._free_chunks()
+            index = len(self._chunks) - 1
+        chunk = self._chunks[index]
+        chunk.events[offset] = event
+        chunk.live += 1
+
+    def _get(self, seq):
+        position = seq - self._first_seq
+        if position < 0:
+            return None
+        chunk = self._chunks[position // LOG_CHUNK_SIZE]
+        if chunk is None:
+            return None
+        return chunk.events[position % LOG_CHUNK_SIZE]
+
+    def _remove(self, seq, evicted=True):
+        '''Remove and return the event numbered seq.'''
+        index, offset = divmod(seq - self._first_seq, LOG_CHUNK_SIZE)
+        chunk = self._chunks[index]
+        event = chunk.events[offset]
+        chunk.events[offset] = None
+        chunk.live -= 1
+        # The last chunk is kept for appending to
+        if not chunk.live and index < len(self._chunks) - 1:
+            self._chunks[index] = None
+            self._free_chunks()
+        if evicted:
+            self._evicted_seq = max(self._evicted_seq, seq)
+        if self.event_cache is not None:
+            self.event_cache.discard(seq)
+        return event
+
+    def _free_chunks(self):
+        '''Drop freed chunks from the start of the log.'''
+        while self._chunks and self._chunks[0] is None:
+            self._chunks.popleft()
+            self._chunk_times.popleft()
+            self._first_seq += LOG_CHUNK_SIZE
+
+    def _read(self, first_seq, last_seq, limit):
+        '''Return up to limit events, numbered first_seq to last_seq.'''
+        events = []
+        seq = max(first_seq, self._first_seq)
+        while seq <= last_seq and len(events) < limit:
+            index, offset = divmod(seq - self._first_seq, LOG_CHUNK_SIZE)
+            count = min(LOG_CHUNK_SIZE - offset, last_seq - seq + 1)
+            chunk = self._chunks[index]
+            if chunk is not None:
+                events.extend(event for event in
+                              chunk.events[offset:offset+count]
+                              if event is not None)
+            seq += count
+        del events[limit:]
+        return events
+
+    def _first_seq_since(self, start_time):
+        '''Return a sequence number that no event newer than start_time is
+        numbered before.'''
+        # Events before chunk index are no newer than start_time
+        index = max(self._chunk_times.bisect_right(start_time) - 1, 0)
+        return self._first_seq + index * LOG_CHUNK_SIZE
+
+    def _sweep(self):
+        '''Evict events past their max_age from every list, now and then.
+
+        Lists evict old events whenever they are appended to or read, so this
+        only matters for quiet lists, and doesn't need to run on every read.
+
+        '''
+        now = time.time()
+        if now - self._last_sweep < AGE_SWEEP_INTERVAL:
+            return []
+        self._last_sweep = now
+        evicted = []
+        for event_list in self.lists:
+            if event_list.policy.max_age is not None:
+                evicted.extend(event_list._evict())
+        evicted.extend(self._evict_restored())
+        return evicted
+
+    def _evict_restored(self, sizes=False):
+        '''Apply retention to events restored for lists that haven't been
+        created again.
+
+        Those lists don't grow, so max_events and max_bytes only need to be
+        applied once, when the log is opened.  max_bytes is only applied if
+        sizes is True, as it reads every event.  max_age is applied at every
+        sweep.  The lock must be held.  Returns (policy, event) pairs for the
+        evicted events.
+
+        '''
+        if self.retention is None:
+            return []
+        evicted = []
+        now = time.time()
+        for key, restored in self._restored.items():
+            labels = dict(key)
+            policy = self.retention.policy(labels.get("server"),
+                                           labels.get("target"))
+            start = 0
+            if policy.max_events is not None:
+                start = max(len(restored) - policy.max_events, 0)
+            if policy.max_age is not None:
+                oldest_allowed = now - policy.max_age
+                while start < len(restored) and \
+                        restored[start][1] < oldest_allowed:
+                    start += 1
+            if sizes and policy.max_bytes is not None:
+                # Always keep the newest event, however big it is
+                kept, size = len(restored), 0
+                while kept > start:
+                    seq, t = restored[kept - 1]
+                    size += self._get(seq).approximate_size()
+                    if size > policy.max_bytes and kept < len(restored):
+                        break
+                    kept -= 1
+                start = kept
+            if not start:
+                continue
+            for seq, t in restored[:start]:
+                evicted.append((policy, self._remove(seq)))
+            if start < len(restored):
+                self._restored[key] = restored[start:]
+            else:
+                del self._restored[key]
+        return evicted
+
+    def _sink(self, evicted):
+        '''Hand (policy, event) pairs to each policy's eviction sink.'''
+        for policy, event in evicted:
+            if policy.sink:
+                policy.sink(event)
+
+    def get_events_after(self, seq, limit, event_filter=None):
+        '''Return up to limit events numbered after seq, and the next cursor.
+
+        Events are in sequence order.  For every list that has evicted events
+        numbered after seq, a "history_truncated" event is included, in order.
+
+        If seq is newer than any event, it can only come from before the
+        proxy restarted, so events are returned from the start.
+
+        :param event_filter:
+            If given, an `EventFilter`, and only the events it matches are
+            returned.  The cursor still moves past the events it doesn't,
+            so fewer than limit events doesn't mean there are no more.
+
+        '''
+        with self.lock:
+            evicted = self._sweep()
+            if seq > self._last_seq:
+                seq = 0
+            if event_filter is not None and event_filter.selects_lists():
+                events, cursor = self._read_lists(
+                    self._wanted_lists(event_filter), seq, limit)
+            else:
+                events = self._read(seq + 1, self._last_seq, limit)
+                if seq < self._evicted_seq:
+                    # Lists truncated after the last event read would be
+                    # cut off by the limit anyway
+                    last_seq = events[-1].seq if len(events) == limit \
+                               else self._last_seq
+                    events.extend(self._truncated_events(seq + 1, last_seq))
+                    events.sort(key=attrgetter("seq"))
+                    del events[limit:]
+                if len(events) == limit:
+                    cursor = events[-1].seq
+                else:
+                    cursor = self._last_seq
+        self._sink(evicted)
+        if event_filter is not None:
+            events = [event for event in events if event_filter.matches(event)]
+        return events, cursor
+
+    def _read_lists(self, event_lists, seq, limit):
+        '''Like get_events_after, but only reading event_lists.
+
+        Each list is read separately, so the cost depends on how many events
+        the lists have after seq, not on how many the whole log has.
+
+        '''
+        events = []
+        cursor = self._last_seq
+        for event_list in event_lists:
+            list_events = event_list._after(seq, limit)
+            # The list may have more events, so the merged events are only
+            # complete up to its last one
+            if len(list_events) == limit:
+                cursor = min(cursor, list_events[-1].seq)
+            events.extend(list_events)
+        events = [event for event in events if event.seq <= cursor]
+        events.sort(key=attrgetter("seq"))
+        if len(events) > limit:
+            del events[limit:]
+            cursor = events[-1].seq
+        return events, cursor
+
+    def get_events_since(self, start_time, event_filter=None):
+        '''Return events newer than start_time, in sequence order.
+
+        For every list that has evicted events newer than start_time, a
+        "history_truncated" event is included, in order.
+
+        :param event_filter:
+            If given, an `EventFilter`, and only the events it matches are
+            returned.
+
+        '''
+        with self.lock:
+            evicted = self._sweep()
+            if event_filter is not None and event_filter.selects_lists():
+                events = []
+                for event_list in self._wanted_lists(event_filter):
+                    events.extend(event_list._since(start_time))
+                events.sort(key=attrgetter("seq"))
+            else:
+                events = [event for event in
+                          self._read(self._first_seq_since(start_time),
+                                     self._last_seq, self._last_seq)
+                          if event.time > start_time]
+                truncated = self._truncated_events_since(start_time)
+                if truncated:
+                    events.extend(truncated)
+                    events.sort(key=attrgetter("seq"))
+        self._sink(evicted)
+        if event_filter is not None:
+            events = [event for event in events if event_filter.matches(event)]
+        return events
 
 class EventList(object):
     """
+    One server's or channel's events (or the proxy's own) in an `EventLog`.
+
+    The list holds the sequence numbers of its events in a ring buffer, and
+    their times (each raised to at least the time before it, so they are
+    sorted) in a parallel ring buffer.  So `get_events_after` and
+    `get_events_since` are a binary search followed by a slice of just the
+    matching events.
+
+    Old events are evicted, from the list and the log, according to a
+    `RetentionPolicy`.  When asked for events older than the ones it still
+    has, the list says so with a "history_truncated" event.
+
+    Events may be read from any thread while another thread appends.
+
     .. todo:: Rename EventList to EventContainer
     """
 
-    def __init__(self):
-        self.events = []
+    def __init__(self, policy=None, log=None, **labels):
+        '''
+        :param policy:
+            A `RetentionPolicy`.  If None, events are kept forever.
+
+        :param log:
+            The proxy's `EventLog`.  If None, the list gets a log of its own.
+
+        :param labels:
+            Extra fields for the "history_truncated" event, such as which
+            server and channel this list belongs to.
+
+        '''
+        self.policy = policy or RetentionPolicy()
+        self.log = log or EventLog()
+        self.labels = labels
+        # Identifies the list's events in a persistent log, across restarts
+        self.key = tuple(sorted(labels.items()))
+
+        self._seqs = RingBuffer(self.policy.max_events)
+        self._times = RingBuffer(self.policy.max_events)
+        self._bytes = 0
+        # Sequence number and time of the newest event evicted so far
+        self._evicted_seq = 0
+        self._evicted_until = None
+        self._lock = self.log.lock
+        with self._lock:
+            self.log._add_list(self)
+            evicted = self._restore(self.log._restored.pop(self.key, ()))
+        self.log._sink(evicted)
+
+    def __len__(self):
+        return len(self._seqs)
 
     def append(self, event=None, **kwargs):
+        '''Append an event to the log and this list.
+
+        event may be an `Event` or a dictionary of fields.  Otherwise the
+        event's fields are given as keyword arguments.  Returns the `Event`
+        appended.
+
+        '''
         if not event:
             event = kwargs
+        if not isinstance(event, Event):
+            event = Event.from_dict(event)
+
+        with self._lock:
+            evicted = []
+            if self._seqs.is_full():
+                evicted.append(self._evict_oldest())
+
+            self.log._append(event, self)
+            self._seqs.append(event.seq)
+            self._times.append(self.log._latest_time)
+            if self.policy.max_bytes is not None:
+                self._bytes += event.approximate_size()
+
+            evicted.extend(self._evict())
+        self.log._sink(evicted)
+        return event
+
+    def _restore(self, restored):
+        '''Take over events left in the log from before the proxy restarted.
+
+        :param restored:
+            (sequence number, time) pairs, oldest first.
+
+        '''
+        evicted = []
+        for seq, t in restored:
+            if self._seqs.is_full():
+                evicted.append(self._evict_oldest())
+            self._seqs.append(seq)
+            self._times.append(t)
+            if self.policy.max_bytes is not None:
+                self._bytes += self.log._get(seq).approximate_size()
+        evicted.extend(self._evict())
+        return evicted
+
+    def discard(self):
+        '''Remove all of this list's events from the log, and stop using it.
+
+        Discarded events are not given to the eviction sink.
+
+        '''
+        with self._lock:
+            for seq in self._seqs.slice(0, len(self._seqs)):
+                self.log._remove(seq, evicted=False)
+            self._seqs = RingBuffer(self.policy.max_events)
+            self._times = RingBuffer(self.policy.max_events)
+            self._bytes = 0
+            self.log._remove_list(self)
+
+    def _forget_before(self, seq):
+        '''Drop events numbered before seq, which the log is deleting.
+
+        The lock must be held.
+
+        '''
+        old_seq = self._evicted_seq
+        while self._seqs and self._seqs[0] < seq:
+            self._evicted_seq = self._seqs.popleft()
+            self._evicted_until = max(self._evicted_until,
+                                      self._times.popleft())
+            if self.policy.max_bytes is not None:
+                self._bytes -= \
+                    self.log._get(self._evicted_seq).approximate_size()
+        self.log._truncated(self, old_seq, self._evicted_seq)
+
+    def _evict_oldest(self):
+        seq = self._seqs.popleft()
+        event = self.log._remove(seq)
+        self.log._truncated(self, self._evicted_seq, seq)
+        self._evicted_seq = seq
+        self._evicted_until = max(self._evicted_until, self._times.popleft())
+        if self.policy.max_bytes is not None:
+            self._bytes -= event.approximate_size()
+        return self.policy, event
+
+    def _evict(self):
+        '''Evict events until the retention policy is met.
 
-        if "type" not in event:
-            raise ValueError("Event must have a type."
-                             "Erronous event: %s" % event)
-        if "time" not in event:
-            event['time'] = time.time()
-        self.events.append(event)
+        The lock must be held.  Returns (policy, event) pairs for the evicted
+        events, oldest first.
+
+        '''
+        evicted = []
+        policy = self.policy
+        if policy.max_bytes is not None:
+            # Always keep the newest event, however big it is
+            while self._bytes > policy.max_bytes and len(self._seqs) > 1:
+                evicted.append(self._evict_oldest())
+        if policy.max_age is not None:
+            oldest_allowed = time.time() - policy.max_age
+            while self._times and self._times[0] < oldest_allowed:
+                evicted.append(self._evict_oldest())
+        return evicted
+
+    def _truncated_event(self):
+        return Event("history_truncated", self._evicted_until,
+                     seq=self._evicted_seq, **self.labels)
+
+    def _events(self, start, end):
+        return [self.log._get(seq) for seq in self._seqs.slice(start, end)]
 
     def get_event_slice(self, start_index, end_index):
         '''Get a slice of events.
@@ -29,14 +744,322 @@ class EventList(object):
         Example: This will get the latest 10 events:
         >>> channel.get_event_slice("irc.example.com", 0, 10)
 
+        Only the events returned are copied.
+
         '''
-        return self.events[::-1][start_index:end_index][::-1]
+        with self._lock:
+            count = len(self._seqs)
+            start, end, step = slice(start_index, end_index).indices(count)
+            return self._events(count - end, count - start)
 
     def get_events_since(self, start_time):
-        event_list = []
-        for event in self.events[::-1]:
-            if event["time"] <= start_time:
-                return event_list
-            else:
-                event_list.append(event)
-        return event_list
+        '''Return events newer than start_time, in sequence order.
+
+        If events newer than start_time have been evicted, the returned list
+        starts with a "history_truncated" event, whose time is that of the
+        newest evicted event.
+
+        '''
+        with self._lock:
+            evicted = self._evict()
+            events = self._since(start_time)
+        self.log._sink(evicted)
+        return events
+
+    def _since(self, start_time):
+        index = self._times.bisect_right(start_time)
+        events = [event for event in self._events(index, len(self._seqs))
+                  if event.time > start_time]
+        if start_time < self._evicted_until:
+            events.insert(0, self._truncated_event())
+        return events
+
+    def get_events_before(self, seq, limit):
+        '''Return the newest limit events numbered before seq, in sequence
+        order.
+
+        Costs O(limit), however many events the list holds.  If the events
+        run out because older ones have been evicted, the returned list
+        starts with a "history_truncated" event, as long as there is room
+        for it.
+
+        :param seq:
+            Only events numbered before this are returned.  If None, the
+            newest events are.
+
+        '''
+        with self._lock:
+            evicted = self._evict()
+            end = len(self._seqs)
+            if seq is not None:
+                end = self._seqs.bisect_right(seq - 1)
+            start = max(end - limit, 0)
+            events = self._events(start, end)
+            if start == 0 and len(events) < limit and \
+                    0 < self._evicted_seq and \
+                    (seq is None or self._evicted_seq < seq):
+                events.insert(0, self._truncated_event())
+        self.log._sink(evicted)
+        return events
+
+    def get_events_after(self, seq, limit, last_seq=None):
+        '''Return up to limit events numbered after seq, in sequence order.
+
+        If events numbered after seq have been evicted, the returned list
+        starts with a "history_truncated" event, numbered as the newest
+        evicted event.
+
+        :param last_seq:
+            If given, events numbered after this are left out.
+
+        '''
+        with self._lock:
+            evicted = self._evict()
+            events = self._after(seq, limit, last_seq)
+        self.log._sink(evicted)
+        return events
+
+    def _after(self, seq, limit, last_seq=None):
+        start = self._seqs.bisect_right(seq)
+        end = len(self._seqs)
+        if last_seq is not None:
+            end = self._seqs.bisect_right(last_seq)
+        events = self._events(start, min(end, start + limit))
+        if seq < self._evicted_seq:
+            events.insert(0, self._truncated_event())
+            del events[limit:]
+        return events
+
+
+class TestEventList(unittest.TestCase):
+
+    def test_since(self):
+        events = EventList()
+        for t in (1, 2, 2, 3):
+            events.append(type="test", time=t)
+        self.assertEquals([e['time'] for e in events.get_events_since(0)],
+                          [1, 2, 2, 3])
+        self.assertEquals([e['time'] for e in events.get_events_since(2)],
+                          [3])
+        self.assertEquals(events.get_events_since(3), [])
+
+    def test_out_of_order_time(self):
+        events = EventList()
+        for t in (1, 3, 2):
+            events.append(type="test", time=t)
+        self.assertEquals(
+            sorted(e['time'] for e in events.get_events_since(1.5)), [2, 3])
+
+    def test_stamped_times_never_decrease(self):
+        events = EventList()
+        events.append(type="test", time=time.time() + 100)
+        events.append(type="test")
+        times = [e['time'] for e in events.get_events_since(0)]
+        self.assertEquals(times, sorted(times))
+
+    def test_max_events(self):
+        evicted = []
+        events = EventList(RetentionPolicy(max_events=3, sink=evicted.append),
+                           server="irc.example.com")
+        for t in xrange(1, 41):
+            events.append(type="test", time=t)
+        self.assertEquals([e['time'] for e in evicted], range(1, 38))
+        self.assertEquals([e['time'] for e in events.get_events_since(37)],
+                          [38, 39, 40])
+        self.assertEquals(events.get_events_since(36)[0].to_dict(), {
+            'type': "history_truncated",
+            'time': 37,
+            'seq': "37",
+            'server': "irc.example.com",
+        })
+
+    def test_max_age(self):
+        events = EventList(RetentionPolicy(max_age=60))
+        now = time.time()
+        events.append(type="test", time=now - 120)
+        events.append(type="test", time=now)
+        self.assertEquals([e['type'] for e in events.get_events_since(0)],
+                          ["history_truncated", "test"])
+
+    def test_max_bytes(self):
+        size = Event("test", 1.0).approximate_size()
+        events = EventList(RetentionPolicy(max_bytes=size * 2))
+        for t in xrange(1, 6):
+            events.append(type="test", time=float(t))
+        self.assertEquals([e['time'] for e in events.get_events_since(3)],
+                          [4, 5])
+
+    def test_slice(self):
+        events = EventList()
+        for i in xrange(5):
+            events.append(type="test", text=str(i))
+        self.assertEquals([e.text for e in events.get_event_slice(0, 2)],
+                          ["3", "4"])
+        self.assertEquals([e.text for e in events.get_event_slice(1, None)],
+                          ["0", "1", "2", "3"])
+        self.assertEquals(events.get_event_slice(5, 10), [])
+
+    def test_before(self):
+        events = EventList(RetentionPolicy(max_events=5))
+        for i in xrange(8):
+            events.append(type="test")
+        seqs = lambda seq, limit: [e.seq for e in
+                                   events.get_events_before(seq, limit)]
+        self.assertEquals(seqs(None, 2), [7, 8])
+        self.assertEquals(seqs(7, 2), [5, 6])
+        self.assertEquals(seqs(5, 2), [3, 4])
+        self.assertEquals(events.get_events_before(5, 2)[0].type,
+                          "history_truncated")
+        self.assertEquals(seqs(5, 1), [4])
+        self.assertEquals(seqs(4, 1), [3])
+        self.assertEquals(seqs(3, 2), [])
+
+        # The first page is truncated too, once it reaches evicted events
+        self.assertEquals([(e.type, e.seq) for e in
+                           events.get_events_before(None, 10)],
+                          [("history_truncated", 3), ("test", 4), ("test", 5),
+                           ("test", 6), ("test", 7), ("test", 8)])
+        self.assertEquals(len(EventList().get_events_before(None, 10)), 0)
+
+    def test_after(self):
+        log = EventLog()
+        a = EventList(log=log)
+        b = EventList(log=log)
+        for i in xrange(5):
+            a.append(type="a", time=1)
+            b.append(type="b", time=1)
+        self.assertEquals([e.seq for e in a.get_events_after(0, 100)],
+                          [1, 3, 5, 7, 9])
+        self.assertEquals([e.seq for e in b.get_events_after(4, 2)], [6, 8])
+        self.assertEquals([e.seq for e in b.get_events_after(4, 10, 8)],
+                          [6, 8])
+        self.assertEquals(b.get_events_after(10, 10), [])
+
+    def test_wait(self):
+        log = EventLog()
+        events = EventList(log=log)
+        events.append(type="test")
+        self.assertTrue(log.wait(0, 10))
+        self.assertFalse(log.wait(1, 0.01))
+        self.assertTrue(log.wait(5, 10))
+
+        woken = []
+        log.add_waiter(lambda: woken.append(True))
+        timer = threading.Timer(0.05, events.append, kwargs={'type': "test"})
+        timer.start()
+        self.assertTrue(log.wait(1, 10))
+        timer.join()
+        self.assertEquals(len(woken), 1)
+
+    def test_after_truncated(self):
+        events = EventList(RetentionPolicy(max_events=2))
+        for i in xrange(5):
+            events.append(type="test")
+        self.assertEquals([(e.type, e.seq) for e in
+                           events.get_events_after(2, 2)],
+                          [("history_truncated", 3), ("test", 4)])
+        self.assertEquals([e.seq for e in events.get_events_after(3, 5)],
+                          [4, 5])
+
+    def test_log_tail(self):
+        log = EventLog()
+        a = EventList(RetentionPolicy(max_events=2), log, target="#a")
+        b = EventList(None, log, target="#b")
+        for i in xrange(3):
+            a.append(type="a", time=1)
+            b.append(type="b", time=1)
+        events, cursor = log.get_events_after(0, 100)
+        self.assertEquals([(e.type, e.seq) for e in events],
+                          [("history_truncated", 1), ("b", 2), ("a", 3),
+                           ("b", 4), ("a", 5), ("b", 6)])
+        self.assertEquals(cursor, 6)
+        events, cursor = log.get_events_after(1, 2)
+        self.assertEquals([e.seq for e in events], [2, 3])
+        self.assertEquals(cursor, 3)
+        self.assertEquals(log.get_events_after(6, 100), ([], 6))
+        self.assertEquals([e.seq for e in log.get_events_since(0)],
+                          [1, 2, 3, 4, 5, 6])
+
+    def test_log_filter(self):
+        log = EventLog()
+        a = EventList(RetentionPolicy(max_events=2), log,
+                      server="net", target="#a")
+        b = EventList(None, log, server="net", target="#b")
+        proxy = EventList(None, log)
+        for i in xrange(3):
+            a.append(type="a", time=1, server="net", target="#a")
+            b.append(type="b", time=1, server="net", target="#b")
+        proxy.append(type="server_connected", time=1, server="other")
+        proxy.append(type="server_connected", time=1, server="net")
+
+        only_a = EventFilter(channels={"net": ["#a"]})
+        events, cursor = log.get_events_after(0, 100, only_a)
+        self.assertEquals([(e.type, e.seq) for e in events],
+                          [("history_truncated", 1), ("a", 3), ("a", 5)])
+        self.assertEquals(cursor, 8)
+        events, cursor = log.get_events_after(0, 2, only_a)
+        self.assertEquals([e.seq for e in events], [1, 3])
+        self.assertEquals(cursor, 3)
+        self.assertEquals([e.seq for e in log.get_events_since(0, only_a)],
+                          [1, 3, 5])
+
+        no_b = EventFilter(servers=["net"], exclude_types=["b"])
+        events, cursor = log.get_events_after(0, 3, no_b)
+        self.assertEquals([e.seq for e in events], [1, 3])
+        self.assertEquals(cursor, 3)
+        events, cursor = log.get_events_after(3, 100, no_b)
+        self.assertEquals([e.seq for e in events], [5, 8])
+        self.assertEquals(cursor, 8)
+        events, cursor = log.get_events_after(0, 3, EventFilter(types=["b"]))
+        self.assertEquals([e.seq for e in events], [1, 2])
+        self.assertEquals(cursor, 3)
+
+    def test_log_chunks_freed(self):
+        log = EventLog()
+        events = EventList(RetentionPolicy(max_events=10), log)
+        for i in xrange(LOG_CHUNK_SIZE * 5):
+            events.append(type="test")
+        self.assertEquals(len(log._chunks), 1)
+        self.assertEquals([e.seq for e in log.get_events_after(0, 100)[0]
+                           if e.type == "test"],
+                          range(LOG_CHUNK_SIZE * 5 - 9, LOG_CHUNK_SIZE * 5 + 1))
+        events.discard()
+        self.assertEquals(log.get_events_after(0, 100), ([], LOG_CHUNK_SIZE * 5))
+
+    def test_log_truncation_index(self):
+        log = EventLog()
+        quiet = EventList(RetentionPolicy(max_events=1), log, target="#q")
+        busy = EventList(RetentionPolicy(max_events=10), log, target="#b")
+        quiet.append(type="q", time=1)
+        quiet.append(type="q", time=1)
+        for i in xrange(LOG_CHUNK_SIZE * 2):
+            busy.append(type="b", time=2 + i)
+        # Only the newest evicted event of each list is indexed
+        self.assertEquals(sorted(log._truncations), [0, 1])
+        truncated = lambda seq: [
+            (e.target, e.seq) for e in log.get_events_after(seq, 100)[0]
+            if e.type == "history_truncated"]
+        self.assertEquals(truncated(0), [("#q", 1), ("#b", 2040)])
+        self.assertEquals(truncated(1), [("#b", 2040)])
+        self.assertEquals(truncated(2040), [])
+        self.assertEquals(
+            [e.target for e in log.get_events_since(1)
+             if e.type == "history_truncated"], ["#b"])
+
+        busy.discard()
+        self.assertEquals(sorted(log._truncations), [0])
+        self.assertEquals(log._server_lists, {None: {"#q": set([quiet])}})
+
+    def test_retention_overrides(self):
+        retention = Retention({"max_events": 10}, {"net": {"max_age": 60}},
+                              {("net", "#chan"): {"max_events": 5}})
+        self.assertEquals(retention.policy().max_events, 10)
+        self.assertEquals(retention.policy("other", "#chan").max_events, 10)
+        server = retention.policy("net")
+        self.assertEquals((server.max_events, server.max_age), (10, 60))
+        channel = retention.policy("net", "#chan")
+        self.assertEquals((channel.max_events, channel.max_age), (5, 60))
+        self.assertRaises(ValueError, Retention, {"max_lines": 10})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,6 @@
 
-import time
-
 from common import ircutil
+from event import Event, intern_string
 
 def format_irc_event(irc_event, proxy_client):
 
@@ -28,44 +27,44 @@ def format_irc_event(irc_event, proxy_client):
 
 
 def format_error(irc_event, proxy_client):
-    return {
-        'type': 'irc_error',
-        'server': get_server(irc_event, proxy_client).server_name,
-        'text': u' '.join(irc_event._arguments),
-    }
+    return Event(
+        type = 'irc_error',
+        server = get_server(irc_event, proxy_client).server_name,
+        text = u' '.join(irc_event._arguments),
+    )
 
 def format_msg(irc_event, proxy_client):
-    return {
-        'type': irc_event._eventtype,
-        'server': get_server(irc_event, proxy_client).server_name,
-        'source': irc_event._source,
-        'target': irc_event._target,
-        'text': irc_event._arguments[0],
-    }
+    return Event(
+        type = irc_event._eventtype,
+        server = get_server(irc_event, proxy_client).server_name,
+        source = irc_event._source,
+        target = irc_event._target,
+        text = irc_event._arguments[0],
+    )
 
 def format_server_message(irc_event, proxy_client):
-    return {
-        'type': irc_event._eventtype,
-        'server': get_server(irc_event, proxy_client).server_name,
-        'text': irc_event._arguments[0],
-    }
+    return Event(
+        type = irc_event._eventtype,
+        server = get_server(irc_event, proxy_client).server_name,
+        text = irc_event._arguments[0],
+    )
 
 def format_server_join(irc_event, proxy_client):
-    return {
-        'type': 'server_connect',
-        'server': get_server(irc_event, proxy_client).server_name,
-    }
+    return Event(
+        type = 'server_connect',
+        server = get_server(irc_event, proxy_client).server_name,
+    )
 
 def format_channel_join_part(irc_event, proxy_client):
     server = get_server(irc_event, proxy_client)
     user, location = ircutil.nick_split(irc_event._source)
-    return {
-        'type': 'channel_%s' % irc_event._eventtype,
-        'server': server.server_name,
-        'target': irc_event._target,
-        'user': irc_event._source,
-        'this_user': server.nick_name == user,
-    }
+    return Event(
+        type = 'channel_%s' % irc_event._eventtype,
+        server = server.server_name,
+        target = irc_event._target,
+        user = intern_string(irc_event._source),
+        this_user = server.nick_name == user,
+    )
 
 def get_server(irc_event, proxy_client):
     connection = irc_event.connection
@@ -2,19 +2,161 @@
 import time
 import traceback
 import os.path
+import threading
+import socket
+import shutil
+import tempfile
+import unittest
+from functools import partial
+from Queue import Queue, Empty
 from SimpleXMLRPCServer import SimpleXMLRPCServer
+import xmlrpclib
 from xmlrpclib import Fault
 import ssl
 
-#TODO: Catch an import error from this library
-import irclib
+try:
+    import irclib
+except ImportError:
+    # Only needed by IRCProxyServer itself.  The asyncio engine doesn't use it.
+    irclib = None
 
-from remoteircserver import RemoteIRCServer
+from remoteircserver import RemoteIRCServer, RemoteIRCChannel, \
+                            _valid_channel_name
 from errors import ServerError
-from eventlist import EventList
-from ircevents import format_irc_event
-from tools import type_check
-from common import securexmlrpc
+from event import Event
+from eventlist import EventList, EventLog, Retention
+from eventcache import EventCache, EncodedEvents, EventMarshaller
+from sendqueue import FloodControl, SendQueue
+from eventfilter import EventFilter
+from segmentlog import SegmentedEventLog
+from archive import EventArchive
+from stream import StreamServer
+from session import SessionTable
+from routing import RoutingTable
+from reactor import Reactor
+from workerpool import WorkerPool
+from reconnect import ReconnectSupervisor
+from ircevents import format_irc_event, get_server
+from tools import type_check, parse_cursor, backoff_delay
+from common import securexmlrpc, rpcformats
+from common.rpcformats import _UNEXPECTED_FAULT
+
+# XMLRPC methods that only read proxy state.  When requests are handled by
+# worker threads, these run without taking IRCProxyServer.lock, so they never
+# wait behind IRC processing or other requests.
+LOCK_FREE_METHODS = frozenset([
+    "get_events_since",
+    "get_events_after",
+    "wait_for_events",
+    "channel_search",
+    "server_search",
+    "server_list",
+    "channel_list",
+    "channel_history",
+    "server_state",
+    "server_history",
+    "session_fetch",
+    "session_subscribe",
+    "session_seek",
+    "session_state",
+    "session_list",
+])
+
+# XMLRPC methods that can take a while, without touching IRC state.  Both
+# engines run them in a thread, rather than in their event loop.
+SLOW_METHODS = frozenset([
+    "channel_search",
+    "server_search",
+])
+
+# XMLRPC methods that can wait for events.  Both engines park the request,
+# without tying up a thread, until there are events for it.
+WAITING_METHODS = frozenset([
+    "wait_for_events",
+    "session_fetch",
+])
+
+# Threads that run requests calling SLOW_METHODS, when there are no
+# xmlrpc_workers to run them, and the most such requests waiting for one.
+SLOW_REQUEST_THREADS = 2
+SLOW_REQUEST_QUEUE_DEPTH = 32
+
+# The longest wait_for_events waits, in seconds
+MAX_EVENT_WAIT = 120
+
+# The most results channel_search and server_search return at once
+MAX_SEARCH_LIMIT = 1000
+
+# Seconds a client has to finish the TLS handshake, and to send a request
+# once it starts, and to send its first request if keep-alive is off.
+XMLRPC_CONNECTION_TIMEOUT = 10
+
+# Connection attempts made by server_connect before giving up, and the
+# exponential backoff between them, in seconds.
+CONNECT_ATTEMPTS = 5
+CONNECT_BACKOFF_BASE = 1
+CONNECT_BACKOFF_MAX = 30
+
+def _multicall_calls(params):
+    '''Return the (method, params) of each call in system.multicall params.
+
+    A call that isn't valid is given as a `Fault` instead, to be returned in
+    its place.  Raises a Fault if params isn't a list of calls at all.
+
+    '''
+    if len(params) != 1 or not isinstance(params[0], list):
+        raise Fault(2, "system.multicall takes one argument, a list of "
+                       "calls.")
+    calls = []
+    for call in params[0]:
+        if not isinstance(call, dict) or \
+                not isinstance(call.get("methodName"), basestring) or \
+                not isinstance(call.get("params"), list):
+            calls.append(Fault(2, "Each call must be a struct with a "
+                                  "methodName and params."))
+        elif call["methodName"] == "system.multicall":
+            calls.append(Fault(2, "system.multicall can't be called by "
+                                  "system.multicall."))
+        else:
+            calls.append((call["methodName"], tuple(call["params"])))
+    return calls
+
+def _request_calls(data, format):
+    '''Return the (method, params) of each call in an RPC request body.
+
+    :param format:
+        The request's encoding, from `common.rpcformats`, or None for XMLRPC.
+
+    The calls of a system.multicall are given in its place.  Calls that
+    aren't valid are left out, as they are reported when the request is
+    dispatched.
+
+    '''
+    try:
+        if format is None:
+            params, method = xmlrpclib.loads(data)
+            calls = [(method, params)]
+        else:
+            calls = [call for request_id, call
+                     in rpcformats.parse_request(data, format)[0]
+                     if not isinstance(call, Fault)]
+    except Exception:
+        return []
+    expanded = []
+    for method, params in calls:
+        if method != "system.multicall":
+            expanded.append((method, params))
+            continue
+        try:
+            expanded.extend(call for call in _multicall_calls(params)
+                            if not isinstance(call, Fault))
+        except Fault:
+            pass
+    return expanded
+
+def _fault_struct(fault):
+    '''Return fault as a system.multicall result.'''
+    return {'faultCode': fault.faultCode, 'faultString': fault.faultString}
 
 class IRCProxyServer(object):
     '''The XMLRPC interface that proxy clients use.
@@ -25,12 +167,29 @@ class IRCProxyServer(object):
 
     When an event is received from an IRC server, _handle_irc_event is called.
 
+    All I/O is driven by a single `Reactor`.  The XMLRPC listening socket,
+    accepted XMLRPC connections and every IRC connection socket are all
+    watched by the same epoll (or select) set, so each is handled as soon as
+    it is readable, and an idle proxy sleeps until something happens.
+
+    If `conf.xmlrpc_workers` is non-zero, XMLRPC requests (including the TLS
+    handshake) are instead handled on a bounded pool of worker threads, so a
+    slow client can't stall other clients or IRC processing.  Anything that
+    changes proxy or irclib state then holds `self.lock`, while the methods in
+    `LOCK_FREE_METHODS` read concurrently with the reactor thread.
+
+    When an IRC connection drops, `self.reconnector` reconnects it and the
+    server's channels are rejoined.
+
     '''
 
     def __init__(self, conf):
         '''Starts the irc client library and XMLRPC Server.'''
-        self.remote_irc_servers = {}
-        self.events = EventList()
+        if irclib is None:
+            raise RuntimeError('The "irclib" module is required by the '
+                               'reactor engine, but could not be imported.')
+
+        self._init_state(conf)
 
         # Makes sure files exist
         #TODO: Reference documentation on how to generate these files.
@@ -45,9 +204,16 @@ class IRCProxyServer(object):
         else:
             certs_required = ssl.CERT_REQUIRED
 
-        self.irc_client = irclib.IRC()
+        self.reactor = Reactor()
+        self._irc_sockets = {}  # connection -> registered socket
+
+        self.irc_client = irclib.IRC(fn_to_add_timeout=self._irc_timeout_added)
         self.irc_client.add_global_handler("all_events", self._handle_irc_event)
 
+        self.reconnector = self._make_reconnector(conf,
+                                                  self.reactor.call_later,
+                                                  self._connect_attempt)
+
         # Start xmlrpc server
         self.xmlrpc_server = securexmlrpc.SecureXMLRPCServer(
             (conf.bind_address, conf.bind_port),
@@ -55,39 +221,350 @@ class IRCProxyServer(object):
             keyfile = conf.key_file,
             ca_certs = conf.accepted_certs_file,
             cert_reqs = certs_required,
+            connection_timeout = XMLRPC_CONNECTION_TIMEOUT,
+            idle_timeout = conf.xmlrpc_idle_timeout or None,
+            compress_threshold = conf.xmlrpc_compress_threshold or None,
+            defer_request = self._defer_request,
+            marshaller = EventMarshaller,
         )
+        self.xmlrpc_idle_timeout = conf.xmlrpc_idle_timeout
         self.xmlrpc_server.register_instance(self)
-        self.xmlrpc_server.timeout = 0.1 # Make handle_request() non-blocking
+        self.worker_pool = self._make_worker_pool(conf)
+        # Without workers, slow requests need threads of their own
+        self.slow_pool = None
+        if not self.worker_pool:
+            self.slow_pool = WorkerPool(SLOW_REQUEST_THREADS,
+                                        SLOW_REQUEST_QUEUE_DEPTH)
+        if self.worker_pool:
+            self.reactor.add_reader(self.xmlrpc_server,
+                                    self._xmlrpc_accept_to_pool)
+        else:
+            self.reactor.add_reader(self.xmlrpc_server, self._xmlrpc_accept)
+
+    def _init_state(self, conf):
+        '''Set up everything the proxy keeps that doesn't depend on how it
+        does I/O: servers, event storage, sessions and routing.  Each engine
+        calls this first, then sets up its own I/O.'''
+        self.remote_irc_servers = {}
+        self.retention = self._make_retention(conf)
+        self.flood_control = self._make_flood_control(conf)
+        self.event_log = self._make_event_log(conf)
+        self.archive = self._make_archive(conf)
+        self.events = EventList(self.retention.policy(), self.event_log)
+        self.sessions = SessionTable(self.event_log, conf.session_max_backlog,
+                                     conf.session_idle_timeout)
+        self._request = threading.local()
+        self.lock = threading.RLock()
+        self.routes = self._make_routes()
+        self.stream_server = self._make_stream_server(conf)
 
     def _run(self):
         '''Run proxy server forever in a loop.'''
+        if self.stream_server:
+            self.stream_server.start()
         while True:
             self._loop_iteration()
 
-    def _loop_iteration(self):
+    def _loop_iteration(self, timeout=None):
         '''A single iteration of the _run()'s main loop.
 
-        Handles one xmlrpc request if available and pending IRC events.
+        Blocks until an XMLRPC connection or IRC socket is readable, or an
+        IRC timeout is due, then handles whatever is ready.
+
+        '''
+        self.reactor.run_once(timeout)
+        self._sync_irc_sockets()
+
+    def _xmlrpc_accept(self):
+        '''Reactor callback for when the XMLRPC listening socket is readable.
+
+        The TLS handshake is done a step at a time, whenever the socket is
+        ready, so a client that stalls in it doesn't hold up IRC.
+
+        '''
+        connection = self.xmlrpc_server.accept_connection(handshake=False)
+        if connection:
+            request, client_address = connection
+            timer = self.reactor.call_later(XMLRPC_CONNECTION_TIMEOUT,
+                                            self._xmlrpc_close, request)
+            self._xmlrpc_handshake(request, client_address, timer)
+
+    def _xmlrpc_handshake(self, request, client_address, timer):
+        '''Reactor callback that carries on with an XMLRPC connection's TLS
+        handshake.'''
+        try:
+            wanted = self.xmlrpc_server.continue_handshake(request)
+        except (socket.error, ssl.SSLError):
+            timer.cancel()
+            self._xmlrpc_close(request)
+            return
+        if wanted == "read":
+            self.reactor.remove_writer(request)
+            self.reactor.add_reader(request, self._xmlrpc_handshake, request,
+                                    client_address, timer)
+        elif wanted == "write":
+            self.reactor.remove_reader(request)
+            self.reactor.add_writer(request, self._xmlrpc_handshake, request,
+                                    client_address, timer)
+        else:
+            timer.cancel()
+            self.reactor.remove_reader(request)
+            self.reactor.remove_writer(request)
+            self._xmlrpc_wait(request, client_address)
+
+    def _xmlrpc_close(self, request):
+        '''Close an XMLRPC connection that the reactor may be watching.'''
+        self.reactor.remove_reader(request)
+        self.reactor.remove_writer(request)
+        self.xmlrpc_server.shutdown_request(request)
+
+    def _xmlrpc_wait(self, request, client_address):
+        '''Wait, in the reactor, for the next request on an XMLRPC
+        connection.
+
+        Clients that use HTTP/1.1 keep-alive send any number of requests on
+        one connection, so they only do the TLS handshake once.  Between
+        requests the connection costs nothing but a registered socket, and
+        it is closed once idle for xmlrpc_idle_timeout.
+
+        '''
+        if request.pending():
+            # Already arrived, with the end of the handshake
+            self._xmlrpc_readable(request, client_address)
+            return
+        timer = self.reactor.call_later(
+            self.xmlrpc_idle_timeout or XMLRPC_CONNECTION_TIMEOUT,
+            self._xmlrpc_close, request)
+        self.reactor.add_reader(request, self._xmlrpc_readable, request,
+                                client_address, timer)
+
+    def _xmlrpc_readable(self, request, client_address, timer=None):
+        '''Reactor callback for when an accepted XMLRPC connection has data.
+
+        The request is handled here, or by a worker if there are workers.
+
+        '''
+        if timer:
+            timer.cancel()
+        self.reactor.remove_reader(request)
+        if self.worker_pool:
+            if not self.worker_pool.submit(self._xmlrpc_worker_request,
+                                           request, client_address):
+                #TODO: Log
+                self.xmlrpc_server.shutdown_request(request)
+        elif self._handle_connection(request, client_address):
+            self._xmlrpc_wait(request, client_address)
+
+    def _xmlrpc_accept_to_pool(self):
+        '''Like _xmlrpc_accept, but hands the connection to a worker.
+
+        Only the accept is done in the reactor thread.  If every worker is
+        busy and the queue is full, the connection is closed right away
+        instead of making the reactor wait.
+
+        '''
+        try:
+            sock, client_address = self.xmlrpc_server.socket.accept()
+        except socket.error:
+            return
+        if not self.worker_pool.submit(self._xmlrpc_worker_job, sock,
+                                       client_address):
+            #TODO: Log
+            sock.close()
+
+    def _xmlrpc_worker_job(self, sock, client_address):
+        '''Handshake and handle one XMLRPC connection in a worker thread.'''
+        try:
+            request = self.xmlrpc_server.wrap_request(sock)
+        except (socket.error, ssl.SSLError):
+            sock.close()
+            return
+        self._xmlrpc_worker_request(request, client_address)
+
+    def _xmlrpc_worker_request(self, request, client_address):
+        '''Handle one request on an XMLRPC connection in a worker thread.
+
+        If the client keeps the connection alive, it goes back to the reactor
+        to wait for the next request, rather than tying up the worker.
+
+        '''
+        if self._handle_connection(request, client_address):
+            self.reactor.call_soon_threadsafe(self._xmlrpc_wait, request,
+                                              client_address)
+
+        # The request may have opened or closed IRC sockets
+        self.reactor.call_soon_threadsafe(self._sync_irc_sockets)
+
+    def _handle_connection(self, request, client_address):
+        '''Handle a request on an XMLRPC connection, noting which client
+        it is from for `_client_id`.
+
+        :returns:
+            True if the client kept the connection open for another request.
+
+        '''
+        self._request.client_id = securexmlrpc.cert_fingerprint(request)
+        try:
+            return self.xmlrpc_server.handle_connection(request,
+                                                        client_address)
+        finally:
+            self._request.client_id = None
+
+    def _defer_request(self, handler, data, format):
+        '''Decide whether an XMLRPC request is answered later, for
+        SecureXMLRPCServer's defer_request.
+
+        A request with a call that would wait for events (see `_event_wait`)
+        is parked in the reactor until there are some, or the wait times
+        out, so waiting ties up no thread, worker or otherwise.
+
+        Without workers, requests are handled in the reactor thread, so a
+        request that calls any of `SLOW_METHODS` is handed to `slow_pool`
+        instead, where it doesn't hold up IRC.
+
+        :returns:
+            None to answer the request now, or the function that takes it
+            over.
+
+        '''
+        # Checked first, so that most requests aren't parsed twice
+        if not any(method in data
+                   for method in WAITING_METHODS | SLOW_METHODS):
+            return None
+        calls = _request_calls(data, format)
+        slow = self.slow_pool is not None and \
+            any(method in SLOW_METHODS for method, params in calls)
+        client_id = securexmlrpc.cert_fingerprint(handler.request)
+        for method, params in calls:
+            wait = self._event_wait(method, params, client_id)
+            if wait is not None:
+                seq, timeout = wait
+                return partial(self.reactor.call_soon_threadsafe,
+                               self._park_request, seq, timeout, slow)
+        if slow:
+            return partial(self._answer_deferred, True)
+        return None
+
+    def _park_request(self, seq, timeout, slow, handler):
+        '''Wait, in the reactor, until there is an event after seq, or for
+        timeout seconds, then answer handler's request.'''
+        waiting = [True]
+        def wake():
+            if waiting:
+                del waiting[:]
+                timer.cancel()
+                self.event_log.remove_waiter(appended)
+                self._answer_deferred(slow, handler)
+        def appended():
+            # Called with the log's lock held, by whichever thread appended
+            self.reactor.call_soon_threadsafe(wake)
+        timer = self.reactor.call_later(timeout, wake)
+        self.event_log.add_waiter(appended)
+        # Checked again, in case of an event since the request was read
+        if seq != self.event_log.last_seq():
+            wake()
+
+    def _answer_deferred(self, slow, handler):
+        '''Answer a deferred XMLRPC request where it would have been
+        answered: by a worker, if there are workers, otherwise in
+        `slow_pool` if it is slow, or else in the reactor thread.'''
+        if self.worker_pool:
+            pool = self.worker_pool
+        elif slow:
+            pool = self.slow_pool
+        else:
+            self._resume_request(handler)
+            return
+        if not pool.submit(self._resume_request, handler):
+            #TODO: Log
+            self.xmlrpc_server.shutdown_request(handler.request)
+
+    def _resume_request(self, handler):
+        '''Answer a deferred XMLRPC request in this thread, noting which
+        client it is from, like `_handle_connection`.
+
+        If the client keeps the connection alive, it goes back to the reactor
+        to wait for the next request.
+
+        '''
+        request = handler.request
+        self._request.client_id = securexmlrpc.cert_fingerprint(request)
+        try:
+            kept = self.xmlrpc_server.resume_request(handler)
+        finally:
+            self._request.client_id = None
+        if kept:
+            self.reactor.call_soon_threadsafe(self._xmlrpc_wait, request,
+                                              handler.client_address)
+        self.reactor.call_soon_threadsafe(self._sync_irc_sockets)
+
+    def _client_id(self):
+        '''Return the certificate fingerprint of the client whose request
+        is being handled in this thread, or None.'''
+        return getattr(self._request, "client_id", None)
+
+    def _irc_readable(self, connection):
+        '''Reactor callback for when an IRC connection socket is readable.'''
+        with self.lock:
+            connection.process_data()
+        self._sync_irc_sockets()
+
+    def _call_soon_threadsafe(self, callback, *args):
+        '''Call callback(*args) soon, in the main loop's thread.'''
+        self.reactor.call_soon_threadsafe(callback, *args)
+
+    def _call_later_threadsafe(self, delay, callback):
+        '''Call callback() after delay seconds, in the main loop's thread.
+        This may be called from any thread.'''
+        self._call_soon_threadsafe(self.reactor.call_later, delay, callback)
+
+    def _irc_timeout_added(self, delay):
+        '''Called by irclib when it schedules a delayed command.'''
+        self.reactor.call_later(delay, self._irc_process_timeout)
+
+    def _irc_process_timeout(self):
+        with self.lock:
+            self.irc_client.process_timeout()
+
+    def _sync_irc_sockets(self):
+        '''Make the reactor watch exactly the sockets of connected servers.
+
+        irclib replaces or drops a connection's socket when it connects or
+        disconnects, without always telling us, so the registered sockets are
+        compared against the current ones after anything that could change
+        them.
+
+        irclib sets a connection's socket before connecting it, and before
+        the TLS handshake, which a connect thread does without the lock.  So
+        a socket is only watched once its server is "connected", which the
+        reactor thread sets when the connect thread has finished with it.
 
         '''
-        self.xmlrpc_server.handle_request()
-        self.irc_client.process_once(0.1)
+        current = {}
+        with self.lock:
+            for server in self.remote_irc_servers.itervalues():
+                sock = server.connection.socket
+                if sock is not None and server.connection_state == "connected":
+                    current[server.connection] = sock
+
+        for connection, sock in self._irc_sockets.items():
+            if current.get(connection) is not sock:
+                self.reactor.remove_reader(sock)
+                del self._irc_sockets[connection]
+
+        for connection, sock in current.iteritems():
+            if connection not in self._irc_sockets:
+                self.reactor.add_reader(sock, self._irc_readable, connection)
+                self._irc_sockets[connection] = sock
 
     def _dispatch(self, method, params):
         '''Delegate XMLRPC requests to the appropriate method.
 
-        The method could be in a few different places.  Here are the places
-        that are checked, in order:
-            # IRCProxyServer.<method>
-            # If the method name starts with "server_", that prefix is taken
-              off and RemoteIRCServer.<method_stripped> is searched.  The first
-              argument is assumed to be the server name, and the method inside
-              the appropriate server is called.
-            # If the method name starts with "channel_", that prefix is taken
-              off and RemoteIRCChannel.<method_stripped> is searched.  The
-              first two arguments are assumed to be server name and channel
-              name, and server._dispatch_channel_method is called for the
-              appropriate server.
+        The method is found in `self.routes`, which says whether it is an
+        IRCProxyServer, RemoteIRCServer or RemoteIRCChannel method (see
+        `RoutingTable`).  For RemoteIRCServer methods, the first argument is
+        the server name, and for RemoteIRCChannel methods, the first two are
+        the server and channel names.
 
         :param method:
             Name of the XMLRPC method requested.
@@ -102,25 +579,18 @@ class IRCProxyServer(object):
         '''
         #TODO: Double check typechecking in all _dispatch methods.
 
-        try:
-
-            # Method inside IRCProxyServer (this instance)
-            func = getattr(self, method, None)
-            if func != None and callable(func):
-                return func(*params)
-
-            # Look for method inside a RemoteIRCServer instance
-            # Prefix of server_
-            elif method.startswith("server_"):
-                return self._dispatch_server(method, params)
+        if method == "system.multicall":
+            return self._multicall(params)
 
-            # Look for method inside a RemoteIRCChannel instance
-            # Prefix of channel_
-            elif method.startswith("channel_") and len(params) > 0:
-                return self._dispatch_channel(method, params)
+        try:
 
-            # Method not found!
-            raise ServerError('Method "%s" not found.' % method)
+            route = self.routes.get(method)
+            if route is None:
+                raise ServerError('Method "%s" not found.' % method)
+            if route.lock_free:
+                return route.call(self, params)
+            with self.lock:
+                return route.call(self, params)
 
         except ServerError as e:
             #TODO: Log
@@ -129,48 +599,29 @@ class IRCProxyServer(object):
         except Exception as e:
             #TODO: Log
             traceback.print_exc()
-            raise Fault(3, "Proxy server received an unexpected error.  See log file for details.")
-
-    def _dispatch_server(self, method, params):
-        '''Dispatch for xmlrpc methods starting with _server.'''
-
-        # Check for method existence and callability
-        server_method = method[len("server_"):]
-        if not server_method.startswith("_") and \
-                callable(getattr(RemoteIRCServer, server_method, None)):
-
-            # Get server
-            if len(params) <= 0:
-                raise ServerError('Not enough arguments for method "%s".' % method)
-            server_name = params[0]
-            type_check("server_name", server_name, basestring)
-            if server_name not in self.remote_irc_servers:
-                raise ServerError('Server with name "%s" was not found' % server_name)
-            server = self.remote_irc_servers[server_name]
+            raise _UNEXPECTED_FAULT
 
-            # Call server method
-            func = getattr(server, server_method)
-            return func(*params[1:])
+    def _multicall(self, params):
+        '''Make each call in a system.multicall request, through _dispatch.
 
-        raise ServerError('Method "%s" not found.' % method)
+        Each call takes the lock, or not, as it would on its own, so calls
+        that don't need it never wait for it.
 
-    def _dispatch_channel(self, method, params):
-        '''Dispatch for xmlrpc methods starting with _channel.'''
-
-        # Checks for methods existance an non-privacy are done in
-        # RemoteIRCServer._dispatch_channel_method
-
-        # Get server
-        if len(params) <= 0:
-            raise ServerError('Not enough arguments for method "%s".' % method)
-        server_name = params[0]
-        type_check("server_name", server_name, basestring)
-        if server_name not in self.remote_irc_servers:
-            raise ServerError('Server with name "%s" was not found' % server_name)
-        server = self.remote_irc_servers[server_name]
+        :returns:
+            A list with, for each call, either a list holding its result, or
+            a fault struct, as system.multicall specifies.
 
-        # Dispatch to corresponding server
-        return server._dispatch_channel_method(method, params[1:])
+        '''
+        results = []
+        for call in _multicall_calls(params):
+            try:
+                if isinstance(call, Fault):
+                    raise call
+                method, call_params = call
+                results.append([self._dispatch(method, call_params)])
+            except Fault as fault:
+                results.append(_fault_struct(fault))
+        return results
 
     def _handle_irc_event(self, connection, irc_event):
         '''Callback for any events from irclib.
@@ -195,9 +646,18 @@ class IRCProxyServer(object):
                 return
 
             irc_event.connection = connection
+            if irc_event._eventtype == "disconnect":
+                server = get_server(irc_event, self)
+                if server:
+                    # Deferred, since the disconnect may have come from a
+                    # worker thread whose send failed.
+                    self._call_soon_threadsafe(self._connection_lost, server,
+                                               ' '.join(irc_event._arguments))
+                return
+
             event = format_irc_event(irc_event, self)
             if not event: return
-            server = self.remote_irc_servers[event['server']]
+            server = self.remote_irc_servers[event.server]
             server._handle_irc_event(event)
 
         except ServerError as e:
@@ -208,15 +668,225 @@ class IRCProxyServer(object):
             #TODO: Log
             traceback.print_exc()
 
-    def get_events_since(self, start_time):
+    def get_events_since(self, start_time, event_filter=None):
+        '''Return events newer than start_time.
+
+        :param event_filter:
+            Optionally, which events to return.  See `_make_event_filter`.
+
+        '''
         type_check("start_time", start_time, int, float)
         if start_time < 0:
             raise ServerError("start_time must be a positive number.")
+        event_filter = self._make_event_filter(event_filter)
+
+        events = self.event_log.get_events_since(start_time, event_filter)
+        return EncodedEvents(events, self.event_log.event_cache)
+
+    def get_events_after(self, cursor, limit=1000, event_filter=None):
+        seq = parse_cursor("cursor", cursor)
+        type_check("limit", limit, int)
+        if limit < 1:
+            raise ServerError("limit must be at least 1.")
+        event_filter = self._make_event_filter(event_filter)
+
+        events, next_seq = self.event_log.get_events_after(seq, limit,
+                                                           event_filter)
+        return {
+            'events': EncodedEvents(events, self.event_log.event_cache),
+            'cursor': str(next_seq),
+        }
+
+    def wait_for_events(self, cursor, timeout=30, limit=1000,
+                        event_filter=None):
+        '''Like get_events_after, but waits for events if there are none.
+
+        Returns as soon as there are events after cursor, or after timeout
+        seconds with no events.  With an event_filter, the events may all
+        have been filtered out, so this can return no events, but a newer
+        cursor, before the timeout.
+
+        '''
+        parse_cursor("cursor", cursor)
+        type_check("timeout", timeout, int, float)
+        if timeout < 0:
+            raise ServerError("timeout must not be negative.")
+        # The engine has already waited, before making the call
+        return self.get_events_after(cursor, limit, event_filter)
+
+    def _make_event_filter(self, spec):
+        '''Turn the event_filter argument of the event methods into an
+        `EventFilter`.
+
+        The argument is a struct, with any of these keys:
+
+        servers
+            List of server names, whose events (including their channels')
+            are wanted.
+        channels
+            Struct of server names to lists of channel names, whose events
+            are wanted.  If neither this nor servers is given, all servers
+            and channels are.
+        types
+            List of event types wanted.
+        exclude_types
+            List of event types not wanted.
+        mentions
+            If true, only events that mention our nick, or are sent to it,
+            are wanted.
+
+        '''
+        if spec is None:
+            return None
+        try:
+            return EventFilter.from_dict(spec, self._nick_name)
+        except ValueError as e:
+            raise ServerError(str(e))
+
+    def _nick_name(self, server_name):
+        server = self.remote_irc_servers.get(server_name)
+        return server.nick_name if server is not None else None
+
+    def _event_wait(self, method, params, client_id):
+        '''Return how long a call waits for events, as (seq, timeout): it
+        waits until there is an event after seq, or for timeout seconds.
+        Return None if it doesn't wait.
+
+        wait_for_events and session_fetch don't wait themselves.  Each
+        engine waits before making the call, without tying up a thread.
+        Invalid arguments don't wait, and are reported by the call.
+
+        :param client_id:
+            Certificate fingerprint of the client making the call.
+
+        '''
+        def wait_for_events(cursor=None, timeout=30, *args):
+            return cursor, timeout
+        def session_fetch(limit=1000, timeout=0, *args):
+            session = self.sessions.find(client_id)
+            return (session.cursor if session else None), timeout
+        get_args = {
+            "wait_for_events": wait_for_events,
+            "session_fetch": session_fetch,
+        }.get(method)
+        if get_args is None:
+            return None
+        try:
+            cursor, timeout = get_args(*params)
+            seq = int(cursor)
+            timeout = min(float(timeout), MAX_EVENT_WAIT)
+        except (TypeError, ValueError):
+            return None
+        if timeout <= 0 or seq != self.event_log.last_seq():
+            return None
+        return seq, timeout
+
+    def session_fetch(self, limit=1000, timeout=0):
+        '''Return the events this client hasn't fetched yet.
+
+        The proxy keeps a session for each client certificate, with a cursor
+        that each fetch moves on, so the client doesn't have to keep one.
+        Like wait_for_events, this waits up to timeout seconds if there are
+        no events yet.
+
+        :returns:
+            A dictionary of 'events', and the session's new 'cursor', which
+            can be passed to get_events_after as well.
+
+        '''
+        type_check("limit", limit, int)
+        type_check("timeout", timeout, int, float)
+        if limit < 1:
+            raise ServerError("limit must be at least 1.")
+        if timeout < 0:
+            raise ServerError("timeout must not be negative.")
+        session = self._session()
+        events, cursor = session.fetch(limit)
+        return {
+            'events': EncodedEvents(events, self.event_log.event_cache),
+            'cursor': str(cursor),
+        }
 
-        events = self.events.get_events_since(start_time)
-        for server in self.remote_irc_servers.itervalues():
-            events.extend(server._get_events_since(start_time))
-        return events
+    def session_subscribe(self, event_filter):
+        '''Only fetch events matching event_filter from now on.  An empty
+        filter matches every event.'''
+        type_check("event_filter", event_filter, dict)
+        self._session().subscribe(self._make_event_filter(event_filter or None),
+                                  event_filter)
+        return True
+
+    def session_seek(self, cursor):
+        '''Make the next session_fetch return events after cursor.'''
+        seq = parse_cursor("cursor", cursor)
+        self._session().seek(seq)
+        return True
+
+    def session_state(self):
+        '''Return this client's session: its 'client_id', 'cursor', how many
+        events it is 'behind', its 'filter' and the 'last_fetch' time.'''
+        return self._session().state()
+
+    def session_list(self):
+        '''Return the state of every client's session, as in
+        session_state.'''
+        return [session.state() for session in self.sessions.sessions()]
+
+    def _session(self):
+        client_id = self._client_id()
+        if client_id is None:
+            raise ServerError("Sessions need a client certificate.")
+        return self.sessions.get(client_id)
+
+    def channel_search(self, server_name, channel_name, query, limit=100,
+                       before=""):
+        '''Search the archived text of a channel, newest first.
+
+        The channel doesn't have to be joined, or its server connected.
+
+        :param query:
+            A full text query, like ``hello``, ``"hello world"`` or
+            ``hello OR hi``.
+
+        :param before:
+            "" for the newest results, or the cursor returned with the
+            previous page.
+
+        :returns:
+            A dictionary of 'events', and a 'cursor' to pass as `before` to
+            get the next (older) page, which is "" when there are no more.
+
+        '''
+        # The archive has channel names as channels keep them, in lower case
+        channel_name = _valid_channel_name(channel_name)
+        return self._search(server_name, channel_name, query, limit, before)
+
+    def server_search(self, server_name, query, limit=100, before=""):
+        '''Like `channel_search`, for a server and all of its channels.'''
+        return self._search(server_name, None, query, limit, before)
+
+    def _search(self, server_name, channel_name, query, limit, before):
+        type_check("server_name", server_name, basestring)
+        type_check("query", query, basestring)
+        type_check("limit", limit, int)
+        type_check("before", before, basestring)
+        if not self.archive:
+            raise ServerError("The event archive is not enabled.")
+        if limit < 1 or limit > MAX_SEARCH_LIMIT:
+            raise ServerError("limit must be from 1 to %s." % MAX_SEARCH_LIMIT)
+        try:
+            before = int(before) if before else None
+        except ValueError:
+            raise ServerError('Invalid cursor "%s".' % before)
+
+        try:
+            events, before = self.archive.search(query, server_name,
+                                                 channel_name, limit, before)
+        except ValueError as e:
+            raise ServerError('Invalid search query "%s": %s' % (query, e))
+        return {
+            'events': [event.to_dict() for event in events],
+            'cursor': str(before) if before is not None else "",
+        }
 
     def server_list(self):
         return self.remote_irc_servers.keys()
@@ -238,12 +908,195 @@ class IRCProxyServer(object):
         if server_name in self.server_list():
             raise ServerError("Server with that name is already connected!")
 
-        connection = self.irc_client.server()
+        connection = self._new_connection()
+        send_queue = SendQueue(connection, self._call_later_threadsafe,
+                               **self.flood_control.limits(server_name))
         remote_server = RemoteIRCServer(connection, server_name, nick_name,
-                                        uri, port, password, ssl, ipv6)
+                                        uri, port, password, ssl, ipv6,
+                                        self.retention, self.event_log,
+                                        self.archive, send_queue)
         self.remote_irc_servers[server_name] = remote_server
-        self.events.append(type="server_connect", server=server_name)
-        return True
+        self._connect_server(remote_server)
+        return remote_server.connection_state
+
+    def _make_routes(self):
+        '''Build the RoutingTable of the methods this proxy serves.'''
+        return RoutingTable(type(self), RemoteIRCServer, RemoteIRCChannel,
+                            LOCK_FREE_METHODS)
+
+    def _make_reconnector(self, conf, call_later, connect_attempt):
+        '''Build the ReconnectSupervisor, with the limits configured in
+        conf.'''
+        return ReconnectSupervisor(call_later, connect_attempt,
+                                   conf.reconnect_max_concurrent,
+                                   conf.reconnect_max_per_second)
+
+    def _make_retention(self, conf):
+        '''Build the event Retention policies configured in conf.'''
+        try:
+            return Retention(conf.event_retention, conf.server_event_retention,
+                             conf.channel_event_retention,
+                             conf.event_eviction_sink)
+        except ValueError as e:
+            raise RuntimeError("Invalid event retention configuration: %s" % e)
+
+    def _make_flood_control(self, conf):
+        '''Build the FloodControl limits configured in conf.'''
+        try:
+            return FloodControl(conf.flood_control, conf.server_flood_control)
+        except ValueError as e:
+            raise RuntimeError("Invalid flood control configuration: %s" % e)
+
+    def _make_worker_pool(self, conf):
+        '''Build the WorkerPool, or return None if xmlrpc_workers is 0.'''
+        if not conf.xmlrpc_workers:
+            return None
+        try:
+            return WorkerPool(conf.xmlrpc_workers, conf.xmlrpc_queue_depth)
+        except ValueError as e:
+            raise RuntimeError("Invalid worker pool configuration: %s" % e)
+
+    def _make_stream_server(self, conf):
+        '''Build the StreamServer, or return None if stream_port isn't set.
+
+        It checks certificates the same way as the XMLRPC server.
+
+        '''
+        if conf.stream_port is None:
+            return None
+        try:
+            return StreamServer(
+                self.event_log,
+                (conf.bind_address, conf.stream_port),
+                certfile = conf.cert_file,
+                keyfile = conf.key_file or None,
+                ca_certs = conf.accepted_certs_file or None,
+                cert_reqs = ssl.CERT_REQUIRED if conf.accepted_certs_file
+                            else ssl.CERT_NONE,
+                buffer_bytes = conf.stream_buffer_bytes,
+                slow_consumer = conf.stream_slow_consumer,
+                stall_timeout = conf.stream_stall_timeout,
+                make_filter = self._make_event_filter,
+            )
+        except ValueError as e:
+            raise RuntimeError("Invalid event stream configuration: %s" % e)
+
+    def _make_archive(self, conf):
+        '''Build the EventArchive, or return None if archive_file isn't set.'''
+        if not conf.archive_file:
+            return None
+        return EventArchive(conf.archive_file)
+
+    def _make_event_log(self, conf):
+        '''Build the EventLog, kept on disk if event_log_dir is set, with an
+        EventCache unless event_cache_bytes is 0.'''
+        if not conf.event_log_dir:
+            event_log = EventLog()
+        else:
+            event_log = SegmentedEventLog(conf.event_log_dir,
+                                          conf.event_log_segment_bytes,
+                                          conf.event_log_max_bytes,
+                                          self.retention)
+        if conf.event_cache_bytes:
+            event_log.event_cache = EventCache(conf.event_cache_bytes)
+        return event_log
+
+    def _new_connection(self):
+        '''Return a new, unconnected, IRC connection object.'''
+        return self.irc_client.server()
+
+    def _connect_server(self, remote_server):
+        '''Start connecting remote_server in the background.
+
+        irclib's connect blocks, so each attempt is made on its own short
+        lived thread.  The result is handed back to the reactor thread, which
+        schedules any retry with `backoff_delay`.
+
+        '''
+        self._connect_attempt(remote_server, 0)
+
+    def _connect_attempt(self, remote_server, attempt):
+        with self.lock:
+            if not self._is_current_server(remote_server):
+                return  # Disconnected while waiting to retry
+            self.events.append(type="server_connecting",
+                               server=remote_server.server_name,
+                               attempt=attempt+1)
+        thread = threading.Thread(target=self._connect_thread,
+                                  args=(remote_server, attempt))
+        thread.daemon = True
+        thread.start()
+
+    def _connect_thread(self, remote_server, attempt):
+        error = None
+        try:
+            connected = remote_server._connect()
+        except (irclib.ServerConnectionError, socket.error) as e:
+            connected = False
+            error = str(e)
+        self.reactor.call_soon_threadsafe(self._connect_attempt_finished,
+                                          remote_server, attempt, connected,
+                                          error)
+
+    def _connect_attempt_finished(self, remote_server, attempt, connected,
+                                  error):
+        with self.lock:
+            reconnecting = remote_server.connection_state == "reconnecting"
+            if reconnecting:
+                self.reconnector.attempt_finished(remote_server, connected)
+
+            if connected:
+                self._connect_succeeded(remote_server)
+            elif reconnecting or not self._is_current_server(remote_server):
+                pass  # The reconnector retries, if still wanted
+            elif attempt + 1 < CONNECT_ATTEMPTS:
+                delay = backoff_delay(attempt, CONNECT_BACKOFF_BASE,
+                                      CONNECT_BACKOFF_MAX)
+                self.reactor.call_later(delay, self._connect_attempt,
+                                        remote_server, attempt+1)
+            else:
+                self._connect_failed(remote_server, error)
+        self._sync_irc_sockets()
+
+    def _is_current_server(self, remote_server):
+        '''False if remote_server has been disconnected (or replaced).'''
+        name = remote_server.server_name
+        return self.remote_irc_servers.get(name) is remote_server
+
+    def _connect_succeeded(self, remote_server):
+        if not self._is_current_server(remote_server):
+            # server_disconnect was called while connecting
+            remote_server.connection.disconnect()
+            return
+        remote_server.connection_state = "connected"
+        remote_server._join_channels()
+        self.events.append(type="server_connect",
+                           server=remote_server.server_name)
+
+    def _connect_failed(self, remote_server, error=None):
+        '''Give up connecting remote_server.'''
+        if not self._is_current_server(remote_server):
+            return
+        remote_server.connection_state = "failed"
+        del self.remote_irc_servers[remote_server.server_name]
+        remote_server._discard_events()
+        if not error:
+            error = 'Could not connect to server with uri="%s", port=%s.' % \
+                    (remote_server.uri, remote_server.port)
+        self.events.append(type="server_connect_failed",
+                           server=remote_server.server_name, text=error)
+
+    def _connection_lost(self, remote_server, message):
+        '''Start reconnecting a server whose connection dropped.'''
+        with self.lock:
+            if not self._is_current_server(remote_server) or \
+                    remote_server.connection_state != "connected":
+                return  # Expected, or already being handled
+            remote_server.connection_state = "reconnecting"
+            remote_server._clear_send_queue()
+            self.events.append(type="server_connection_lost",
+                               server=remote_server.server_name, text=message)
+            self.reconnector.reconnect(remote_server)
 
     def server_disconnect(self, server_name, part_message=""):
         type_check("server_name", server_name, basestring)
@@ -252,8 +1105,298 @@ class IRCProxyServer(object):
             raise ServerError('Server with name="%s" does not exist' % server_name)
 
         server = self.remote_irc_servers[server_name]
+        self.reconnector.cancel(server)
         server._disconnect(part_message)
         del self.remote_irc_servers[server_name]
+        server._discard_events()
         self.events.append(type="server_disconnect", server=server_name)
         return True
 
+
+class _TestConf(object):
+    '''The defaults of run_proxy.py's options, without certificates, for
+    tests.'''
+    cert_file = None
+    key_file = None
+    accepted_certs_file = None
+    bind_address = "127.0.0.1"
+    bind_port = 0
+    xmlrpc_workers = 0
+    xmlrpc_queue_depth = 16
+    xmlrpc_idle_timeout = 60
+    xmlrpc_compress_threshold = 4096
+    reconnect_max_concurrent = 4
+    reconnect_max_per_second = 2
+    flood_control = {"burst": 5, "rate": 0.5}
+    server_flood_control = {}
+    event_retention = {"max_events": 10000}
+    server_event_retention = {}
+    channel_event_retention = {}
+    event_eviction_sink = None
+    event_log_dir = None
+    event_log_segment_bytes = 16*1024*1024
+    event_log_max_bytes = None
+    event_cache_bytes = 32*1024*1024
+    archive_file = None
+    stream_port = None
+    stream_buffer_bytes = 1024*1024
+    stream_slow_consumer = "drop"
+    stream_stall_timeout = 30
+    session_max_backlog = None
+    session_idle_timeout = 7*24*60*60
+
+class _Connection(object):
+    '''Stands in for an irclib connection, noting the channels joined.'''
+    def __init__(self):
+        self.socket = None
+        self.joined = []
+
+    def join(self, channels):
+        self.joined.append(channels)
+
+class _CountingLock(object):
+    '''Stands in for IRCProxyServer.lock, counting the times it is taken.'''
+    def __init__(self):
+        self.taken = 0
+
+    def __enter__(self):
+        self.taken += 1
+
+    def __exit__(self, *exc_info):
+        pass
+
+class _Request(object):
+    '''Stands in for an XMLRPC connection, with no client certificate.'''
+    def getpeercert(self, binary_form=False):
+        return None
+
+class _Handler(object):
+    '''Stands in for a KeepAliveRequestHandler.'''
+    def __init__(self):
+        self.request = _Request()
+        self.client_address = ("127.0.0.1", 1)
+
+class _XMLRPCServer(object):
+    '''Stands in for a SecureXMLRPCServer, noting the deferred requests
+    it is asked to answer.'''
+    def __init__(self):
+        self.answered = []
+
+    def resume_request(self, handler):
+        self.answered.append(handler)
+        return False
+
+def _test_proxy(conf=None):
+    '''Return an IRCProxyServer with its state and a `Reactor`, but no
+    XMLRPC server or IRC library, so it needs neither irclib nor
+    certificates.'''
+    proxy = IRCProxyServer.__new__(IRCProxyServer)
+    proxy._init_state(conf or _TestConf())
+    proxy.reactor = Reactor()
+    proxy._irc_sockets = {}
+    proxy.worker_pool = None
+    proxy.slow_pool = None
+    return proxy
+
+class TestIRCProxyServer(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = _test_proxy()
+
+    def test_lock_free(self):
+        pool = WorkerPool(2, 2)
+        results = Queue()
+        def call(method, *params):
+            try:
+                results.put((method, self.proxy._dispatch(method, params)))
+            except Fault as fault:
+                results.put((method, fault.faultCode))
+
+        with self.proxy.lock:  # As if the reactor were handling IRC
+            pool.submit(call, "server_disconnect", "net")
+            pool.submit(call, "get_events_after", "0")
+            method, result = results.get(timeout=5)
+            self.assertEquals((method, result['cursor']),
+                              ("get_events_after", "0"))
+            self.assertRaises(Empty, results.get, timeout=0.05)
+        self.assertEquals(results.get(timeout=5), ("server_disconnect", 2))
+        pool.shutdown()
+
+    def test_multicall(self):
+        server = RemoteIRCServer(_Connection(), "net", "nick", "localhost",
+                                 6667, retention=self.proxy.retention,
+                                 event_log=self.proxy.event_log)
+        server.connection_state = "connected"
+        self.proxy.remote_irc_servers["net"] = server
+        lock = self.proxy.lock = _CountingLock()
+        call = lambda method, *params: {'methodName': method,
+                                        'params': list(params)}
+
+        # Results in order, one list each, and lock free calls don't lock
+        results = self.proxy._dispatch("system.multicall", ([
+            call("server_list"),
+            call("get_events_after", "0"),
+        ],))
+        self.assertEquals(results[0], [["net"]])
+        self.assertEquals(results[1][0]['cursor'], "0")
+        self.assertEquals(lock.taken, 0)
+
+        # A batch method takes the lock once, and sends one JOIN
+        results = self.proxy._dispatch("system.multicall", ([
+            call("channel_join_many", "net", ["#one", "#two", "#six"]),
+        ],))
+        self.assertEquals(results, [[True]])
+        self.assertEquals(lock.taken, 1)
+        self.assertEquals(server.connection.joined, ["#one,#two,#six"])
+        self.assertEquals(sorted(server.channels), ["#one", "#six", "#two"])
+
+        # A call that fails gets a fault struct, and the rest still run
+        results = self.proxy._dispatch("system.multicall", ([
+            call("no_such_method"),
+            call("channel_join_many", "net", ["bad"]),
+            "not a call",
+            {'methodName': "server_list"},
+            call("system.multicall", []),
+            call("channel_join", "net", "#ten"),
+        ],))
+        self.assertEquals([result['faultCode'] for result in results[:-1]],
+                          [2, 2, 2, 2, 2])
+        self.assertEquals(results[-1], [True])
+        self.assertEquals(server.connection.joined[-1], "#ten")
+        self.assertEquals(lock.taken, 3)
+
+        self.assertRaises(Fault, self.proxy._dispatch, "system.multicall",
+                          ())
+        self.assertRaises(Fault, self.proxy._dispatch, "system.multicall",
+                          ("not a list",))
+
+    def test_rpc_formats(self):
+        for format in rpcformats.AVAILABLE_FORMATS:
+            dispatch = lambda method, *params: rpcformats.loads_response(
+                rpcformats.marshaled_dispatch(
+                    rpcformats.dumps_request(method, params, format),
+                    format, self.proxy._dispatch),
+                format)
+            self.assertEquals(dispatch("system.multicall", [
+                {'methodName': "server_list", 'params': []},
+                {'methodName': "server_disconnect", 'params': ["net"]},
+            ]), [[[]], {
+                'faultCode': 2,
+                'faultString': 'Server with name="net" does not exist',
+            }])
+            # ServerError is fault 2, as over XMLRPC
+            try:
+                dispatch("server_disconnect", "net")
+            except Fault as fault:
+                self.assertEquals(fault.faultCode, 2)
+            else:
+                self.fail("No fault")
+
+    def test_defer_slow_requests(self):
+        self.proxy.slow_pool = WorkerPool(1, 1)
+        self.addCleanup(self.proxy.slow_pool.shutdown)
+        defer = lambda data, format=None: \
+            self.proxy._defer_request(_Handler(), data, format)
+        search = xmlrpclib.dumps(("net", "hello"), "server_search")
+        self.assertTrue(defer(search))
+        self.assertEquals(defer(xmlrpclib.dumps(("0",), "get_events_after")),
+                          None)
+        multicall = xmlrpclib.dumps(([
+            {'methodName': "server_list", 'params': []},
+            {'methodName': "channel_search", 'params': ["net", "#a", "b"]},
+        ],), "system.multicall")
+        self.assertTrue(defer(multicall))
+        self.assertEquals(
+            defer('{"method": "server_list", "params": ["server_search"]}',
+                  "json"), None)
+        self.assertTrue(
+            defer('[{"method": "server_search", "params": []}]', "json"))
+
+        # With workers, every request is already in a thread
+        self.proxy.slow_pool = None
+        self.assertEquals(defer(search), None)
+
+    def test_park_request(self):
+        answered = self.proxy.xmlrpc_server = _XMLRPCServer()
+        reactor = self.proxy.reactor
+        def request(method, *params):
+            handler = _Handler()
+            deferred = self.proxy._defer_request(
+                handler, xmlrpclib.dumps(params, method), None)
+            if deferred:
+                deferred(handler)
+            return handler, deferred
+        def run_until(handler, timeout=5):
+            deadline = time.time() + timeout
+            while handler not in answered.answered and \
+                    time.time() < deadline:
+                reactor.run_once(deadline - time.time())
+
+        # Returns when an event is added, from another thread
+        handler, deferred = request("wait_for_events", "0", 10)
+        self.assertTrue(deferred)
+        reactor.run_once(0.05)
+        self.assertEquals(answered.answered, [])
+        start = time.time()
+        timer = threading.Timer(0.05, self.proxy.events.append,
+                                kwargs={'type': "test"})
+        timer.start()
+        run_until(handler)
+        timer.join()
+        self.assertEquals(answered.answered, [handler])
+        self.assertTrue(time.time() - start < 1)
+        self.assertEquals(self.proxy.event_log._waiters, [])
+
+        # Or when it times out
+        handler, deferred = request("wait_for_events", "1", 0.05)
+        run_until(handler)
+        self.assertEquals(answered.answered[-1], handler)
+
+        # Calls with events already, no timeout, or bad arguments don't wait
+        self.assertEquals(request("wait_for_events", "0", 10)[1], None)
+        self.assertEquals(request("wait_for_events", "1", 0)[1], None)
+        self.assertEquals(request("wait_for_events", "x", 10)[1], None)
+        # No session without a client certificate
+        self.assertEquals(request("session_fetch", 10, 10)[1], None)
+
+    def test_channel_search_case(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        conf = _TestConf()
+        conf.archive_file = os.path.join(directory, "archive")
+        proxy = _test_proxy(conf)
+        self.addCleanup(proxy.archive.close)
+        # As archived by the channel joined as "#Chan"
+        proxy.archive.add(Event("pubmsg", 1, "net", target="#chan",
+                                text="hello"), "net", "#chan")
+        proxy.archive.flush()
+        result = proxy.channel_search("net", "#CHAN", "hello")
+        self.assertEquals([e['text'] for e in result['events']], ["hello"])
+        self.assertRaises(ServerError, proxy.channel_search, "net", "chan",
+                          "hello")
+
+    def test_sync_irc_sockets(self):
+        server = RemoteIRCServer(_Connection(), "net", "nick", "localhost",
+                                 6667, retention=self.proxy.retention,
+                                 event_log=self.proxy.event_log)
+        self.proxy.remote_irc_servers["net"] = server
+        sock, other = socket.socketpair()
+        try:
+            # Set by irclib before connecting
+            server.connection.socket = sock
+            self.proxy._sync_irc_sockets()
+            self.assertFalse(self.proxy.reactor.has_reader(sock))
+
+            server.connection_state = "connected"
+            self.proxy._sync_irc_sockets()
+            self.assertTrue(self.proxy.reactor.has_reader(sock))
+
+            server.connection_state = "reconnecting"
+            self.proxy._sync_irc_sockets()
+            self.assertFalse(self.proxy.reactor.has_reader(sock))
+        finally:
+            sock.close()
+            other.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,373 @@
+
+import select
+import time
+import heapq
+import errno
+import math
+import sys
+import socket
+import threading
+import traceback
+import unittest
+from collections import deque
+from StringIO import StringIO
+
+# Events a file is watched for, as a bit mask
+READ = 1
+WRITE = 2
+
+class Reactor(object):
+    '''A small event loop built on epoll (or select where epoll is missing).
+
+    File-like objects (anything with a fileno() method) are registered with
+    `add_reader` and their callback is called whenever they become readable.
+    Likewise for `add_writer` and writable.
+    Timers are registered with `call_later`.  `run_once` blocks until either
+    a registered file is readable or the next timer is due, so a reactor with
+    nothing to do makes no syscalls until something happens.
+
+    The reactor is not thread safe, except for `call_soon_threadsafe`, which
+    other threads use to hand work to the reactor's thread.
+
+    An exception raised by a callback is printed, and the reactor carries on
+    with the next one, so one bad callback can't stop the loop.
+
+    '''
+
+    def __init__(self):
+        self._readers = {}  # fileno -> (fileobj, callback, args)
+        self._writers = {}
+        # id(fileobj) -> fileno, which works after close()
+        self._fds = {}  # For readers
+        self._writer_fds = {}
+        self._timers = []  # heap of _Timer objects
+        self._running = False
+        if hasattr(select, "epoll"):
+            self._poller = _EpollPoller()
+        else:
+            self._poller = _SelectPoller()
+
+        # Other threads wake the reactor by writing to _waker_write
+        self._threadsafe_calls = deque()
+        self._threadsafe_lock = threading.Lock()
+        self._waker_read, self._waker_write = socket.socketpair()
+        self._waker_read.setblocking(False)
+        self.add_reader(self._waker_read, self._run_threadsafe_calls)
+
+    def add_reader(self, fileobj, callback, *args):
+        '''Call callback(*args) whenever fileobj is readable.
+
+        Registering a file that is already registered replaces its callback.
+
+        '''
+        self.remove_reader(fileobj)
+        fd = fileobj.fileno()
+        if fd in self._readers:
+            # fileno was reused after a close we weren't told about
+            self.remove_reader(self._readers[fd][0])
+        self._readers[fd] = (fileobj, callback, args)
+        self._fds[id(fileobj)] = fd
+        self._update(fd)
+
+    def remove_reader(self, fileobj):
+        '''Stop watching fileobj.  It may already be closed.'''
+        fd = self._fds.pop(id(fileobj), None)
+        if fd is not None:
+            del self._readers[fd]
+            self._update(fd)
+
+    def has_reader(self, fileobj):
+        return id(fileobj) in self._fds
+
+    def add_writer(self, fileobj, callback, *args):
+        '''Call callback(*args) whenever fileobj is writable.
+
+        Sockets are almost always writable, so a writer should only be
+        registered while there is data waiting that couldn't be sent.
+
+        '''
+        self.remove_writer(fileobj)
+        fd = fileobj.fileno()
+        if fd in self._writers:
+            self.remove_writer(self._writers[fd][0])
+        self._writers[fd] = (fileobj, callback, args)
+        self._writer_fds[id(fileobj)] = fd
+        self._update(fd)
+
+    def remove_writer(self, fileobj):
+        '''Stop watching fileobj for writability.  It may already be closed.'''
+        fd = self._writer_fds.pop(id(fileobj), None)
+        if fd is not None:
+            del self._writers[fd]
+            self._update(fd)
+
+    def has_writer(self, fileobj):
+        return id(fileobj) in self._writer_fds
+
+    def _update(self, fd):
+        '''Tell the poller what fd is now watched for.'''
+        events = (READ if fd in self._readers else 0) | \
+                 (WRITE if fd in self._writers else 0)
+        self._poller.modify(fd, events)
+
+    def call_later(self, delay, callback, *args):
+        '''Call callback(*args) after delay seconds.
+
+        :returns:
+            A timer object with a cancel() method.
+
+        '''
+        timer = _Timer(time.time() + delay, callback, args)
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def call_soon_threadsafe(self, callback, *args):
+        '''Call callback(*args) in the reactor's thread as soon as possible.
+
+        This may be called from any thread.
+
+        '''
+        with self._threadsafe_lock:
+            wake = not self._threadsafe_calls
+            self._threadsafe_calls.append((callback, args))
+        if wake:
+            self._waker_write.send("x")
+
+    def _run_threadsafe_calls(self):
+        with self._threadsafe_lock:
+            calls = list(self._threadsafe_calls)
+            self._threadsafe_calls.clear()
+            try:
+                while self._waker_read.recv(4096):
+                    pass
+            except socket.error:
+                pass
+        for callback, args in calls:
+            self._call(callback, args)
+
+    def _call(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            #TODO: Log
+            traceback.print_exc()
+
+    def run(self):
+        '''Run the reactor until `stop` is called.'''
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def stop(self):
+        self._running = False
+
+    def run_once(self, timeout=None):
+        '''Wait for, then handle, any ready files and due timers.
+
+        :param timeout:
+            Maximum number of seconds to wait.  None means wait until there is
+            something to do.
+
+        '''
+
+        # Wait no longer than the next timer
+        while self._timers and self._timers[0].cancelled:
+            heapq.heappop(self._timers)
+        if self._timers:
+            until_timer = max(0, self._timers[0].when - time.time())
+            if timeout is None or until_timer < timeout:
+                timeout = until_timer
+
+        for fd, events in self._poller.poll(timeout):
+            # A previous callback in this iteration may have unregistered it
+            if events & READ and fd in self._readers:
+                fileobj, callback, args = self._readers[fd]
+                self._call(callback, args)
+            if events & WRITE and fd in self._writers:
+                fileobj, callback, args = self._writers[fd]
+                self._call(callback, args)
+
+        self._run_due_timers()
+
+    def _run_due_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0].when <= now:
+            timer = heapq.heappop(self._timers)
+            if not timer.cancelled:
+                self._call(timer.callback, timer.args)
+
+class _Timer(object):
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        self.cancelled = True
+
+class _EpollPoller(object):
+
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._registered = set()
+
+    def modify(self, fd, events):
+        '''Watch fd for events, a mask of READ and WRITE.  0 stops watching.'''
+        mask = (select.EPOLLIN if events & READ else 0) | \
+               (select.EPOLLOUT if events & WRITE else 0)
+        try:
+            if not mask:
+                if fd in self._registered:
+                    self._registered.remove(fd)
+                    self._epoll.unregister(fd)
+            elif fd in self._registered:
+                try:
+                    self._epoll.modify(fd, mask)
+                except (IOError, OSError) as e:
+                    # Closed and reused since it was registered
+                    if e.errno != errno.ENOENT:
+                        raise
+                    self._epoll.register(fd, mask)
+            else:
+                self._epoll.register(fd, mask)
+                self._registered.add(fd)
+        except (IOError, OSError):
+            # Already closed, which removes it from the epoll set anyway.
+            pass
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        else:
+            # epoll truncates to milliseconds.  Round up instead, so we don't
+            # wake just before a timer is due and spin.
+            timeout = math.ceil(timeout * 1000) / 1000.0
+        while True:
+            try:
+                ready = self._epoll.poll(timeout)
+            except IOError as e:
+                if e.errno != errno.EINTR:
+                    raise
+            else:
+                break
+        results = []
+        for fd, mask in ready:
+            # Errors and hangups are reported to both, so they find out
+            events = 0
+            if mask & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+                events |= READ
+            if mask & (select.EPOLLOUT | select.EPOLLERR | select.EPOLLHUP):
+                events |= WRITE
+            results.append((fd, events))
+        return results
+
+class _SelectPoller(object):
+
+    def __init__(self):
+        self._readers = set()
+        self._writers = set()
+
+    def modify(self, fd, events):
+        for fds, event in ((self._readers, READ), (self._writers, WRITE)):
+            if events & event:
+                fds.add(fd)
+            else:
+                fds.discard(fd)
+
+    def poll(self, timeout):
+        if not self._readers and not self._writers:
+            if timeout is not None:
+                time.sleep(timeout)
+            return []
+        while True:
+            try:
+                readable, writable, _ = select.select(
+                    list(self._readers), list(self._writers), [], timeout)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+            else:
+                break
+        events = dict.fromkeys(readable, READ)
+        for fd in writable:
+            events[fd] = events.get(fd, 0) | WRITE
+        return events.items()
+
+
+class TestReactor(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = Reactor()
+        self.calls = []
+        self.a, self.b = socket.socketpair()
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_timers(self):
+        self.reactor.call_later(0.02, self.calls.append, 2)
+        self.reactor.call_later(0.01, self.calls.append, 1)
+        self.reactor.call_later(0.01, self.calls.append, 3).cancel()
+        start = time.time()
+        while len(self.calls) < 2 and time.time() - start < 1:
+            self.reactor.run_once()
+        self.assertEquals(self.calls, [1, 2])
+        self.assertTrue(time.time() - start >= 0.02)
+
+    def test_call_soon_threadsafe(self):
+        thread = threading.Thread(target=self.reactor.call_soon_threadsafe,
+                                  args=(self.calls.append, "woken"))
+        start = time.time()
+        thread.start()
+        self.reactor.run_once(5)
+        thread.join()
+        self.assertEquals(self.calls, ["woken"])
+        self.assertTrue(time.time() - start < 1)
+
+    def test_readers(self):
+        self.reactor.add_reader(self.a, lambda: self.calls.append(
+            self.a.recv(10)))
+        self.b.send("x")
+        self.reactor.run_once(1)
+        self.assertEquals(self.calls, ["x"])
+        self.assertTrue(self.reactor.has_reader(self.a))
+
+        self.reactor.remove_reader(self.a)
+        self.assertFalse(self.reactor.has_reader(self.a))
+        self.b.send("y")
+        self.reactor.run_once(0.01)
+        self.assertEquals(self.calls, ["x"])
+
+    def test_writers(self):
+        self.reactor.add_writer(self.a, self.calls.append, "writable")
+        self.reactor.run_once(1)
+        self.assertEquals(self.calls, ["writable"])
+        self.reactor.remove_writer(self.a)
+        self.reactor.run_once(0.01)
+        self.assertEquals(self.calls, ["writable"])
+
+    def test_callback_error(self):
+        def fail():
+            raise ValueError("callback failed")
+        self.reactor.call_later(0, fail)
+        self.reactor.call_later(0, self.calls.append, "timer")
+        self.reactor.add_reader(self.a, fail)
+        self.reactor.add_writer(self.b, self.calls.append, "writer")
+        self.b.send("x")
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            self.reactor.run_once(1)
+            output = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertEquals(sorted(self.calls), ["timer", "writer"])
+        self.assertEquals(output.count("ValueError: callback failed"), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+
+import unittest
+from collections import deque
+
+from tools import backoff_delay, TokenBucket
+
+# Backoff between reconnect attempts for one server, in seconds.
+RECONNECT_BACKOFF_BASE = 2
+RECONNECT_BACKOFF_MAX = 300
+
+class ReconnectSupervisor(object):
+    '''Reconnects servers whose connection dropped.
+
+    Each server waits out a capped exponential backoff (with jitter) between
+    attempts, and keeps trying until it reconnects or is cancelled.  Servers
+    whose wait is over queue up for an attempt, and attempts are started
+    under two global limits: how many may be in flight at once, and how many
+    may start per second.  So when a netsplit drops many servers at once,
+    they reconnect gradually instead of all at the same moment.
+
+    The supervisor only decides *when* to attempt.  The engine makes the
+    attempt and reports back with `attempt_finished`.
+
+    '''
+
+    def __init__(self, call_later, start_attempt, max_concurrent,
+                 max_per_second):
+        '''
+        :param call_later:
+            call_later(delay, callback, *args), returning an object with a
+            cancel() method.  Both `Reactor.call_later` and asyncio's
+            `loop.call_later` work.
+
+        :param start_attempt:
+            Called as start_attempt(server, attempt) to begin a reconnect
+            attempt.  It must not block.
+
+        :param max_concurrent:
+            Maximum number of attempts in flight at once.
+
+        :param max_per_second:
+            Maximum number of attempts started per second.
+
+        '''
+        self.call_later = call_later
+        self.start_attempt = start_attempt
+        self.max_concurrent = max_concurrent
+        self.rate_limit = TokenBucket(max_per_second, max(1, max_per_second))
+
+        self._attempts = {}  # server -> failed attempts so far
+        self._timers = {}  # server -> backoff timer
+        self._ready = deque()  # servers waiting for an attempt
+        self._active = set()  # servers with an attempt in flight
+        self._pump_timer = None
+
+    def reconnect(self, server):
+        '''Start reconnecting server, after the first backoff delay.'''
+        self._attempts[server] = 0
+        self._wait(server)
+
+    def cancel(self, server):
+        '''Stop reconnecting server.'''
+        self._attempts.pop(server, None)
+        timer = self._timers.pop(server, None)
+        if timer:
+            timer.cancel()
+        if server in self._ready:
+            self._ready.remove(server)
+
+    def attempt_finished(self, server, connected):
+        '''Called by the engine when an attempt succeeds or fails.'''
+        self._active.discard(server)
+        if server in self._attempts:
+            if connected:
+                del self._attempts[server]
+            else:
+                self._attempts[server] += 1
+                self._wait(server)
+        self._pump()
+
+    def is_reconnecting(self, server):
+        return server in self._attempts
+
+    def _wait(self, server):
+        delay = backoff_delay(self._attempts[server], RECONNECT_BACKOFF_BASE,
+                              RECONNECT_BACKOFF_MAX)
+        self._timers[server] = self.call_later(delay, self._backoff_done,
+                                               server)
+
+    def _backoff_done(self, server):
+        self._timers.pop(server, None)
+        if server in self._attempts:
+            self._ready.append(server)
+            self._pump()
+
+    def _pump(self):
+        '''Start as many queued attempts as the limits allow.'''
+        while self._ready and len(self._active) < self.max_concurrent:
+            if not self.rate_limit.consume():
+                if not self._pump_timer:
+                    self._pump_timer = self.call_later(
+                        self.rate_limit.delay(), self._pump_timer_done)
+                return
+            server = self._ready.popleft()
+            self._active.add(server)
+            self.start_attempt(server, self._attempts[server])
+
+    def _pump_timer_done(self):
+        self._pump_timer = None
+        self._pump()
+
+
+class _Timer(object):
+    def __init__(self, delay, callback, args):
+        self.delay = delay
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+    def cancel(self):
+        self.cancelled = True
+
+class TestReconnectSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.timers = []
+        self.started = []
+
+    def call_later(self, delay, callback, *args):
+        self.timers.append(_Timer(delay, callback, args))
+        return self.timers[-1]
+
+    def run_timers(self):
+        timers, self.timers = self.timers, []
+        for timer in timers:
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+    def supervisor(self, max_concurrent, max_per_second):
+        return ReconnectSupervisor(self.call_later,
+            lambda server, attempt: self.started.append((server, attempt)),
+            max_concurrent, max_per_second)
+
+    def test_max_concurrent(self):
+        supervisor = self.supervisor(2, 100)
+        for server in "abcd":
+            supervisor.reconnect(server)
+        self.assertEquals(self.started, [])
+        self.run_timers()
+        self.assertEquals(self.started, [("a", 0), ("b", 0)])
+
+        supervisor.attempt_finished("a", True)
+        self.assertEquals(self.started[2:], [("c", 0)])
+        self.assertFalse(supervisor.is_reconnecting("a"))
+
+        # A failure waits out a longer backoff, then queues behind "d"
+        supervisor.attempt_finished("b", False)
+        self.assertEquals(self.started[3:], [("d", 0)])
+        supervisor.attempt_finished("c", True)
+        supervisor.attempt_finished("d", True)
+        self.run_timers()
+        self.assertEquals(self.started[4:], [("b", 1)])
+
+    def test_max_per_second(self):
+        supervisor = self.supervisor(10, 1)
+        for server in "abc":
+            supervisor.reconnect(server)
+        self.run_timers()
+        self.assertEquals(self.started, [("a", 0)])
+        pump, = self.timers
+        self.assertTrue(0 < pump.delay <= 1)
+
+        supervisor.rate_limit.tokens = 1  # As if a second had passed
+        self.run_timers()
+        self.assertEquals(self.started[1:], [("b", 0)])
+        self.assertEquals(len(self.timers), 1)
+
+    def test_cancel(self):
+        supervisor = self.supervisor(1, 100)
+        for server in "ab":
+            supervisor.reconnect(server)
+        supervisor.cancel("a")
+        self.run_timers()
+        self.assertEquals(self.started, [("b", 0)])
+        supervisor.cancel("b")
+        supervisor.attempt_finished("b", False)
+        self.assertFalse(supervisor.is_reconnecting("b"))
+        self.assertEquals(self.timers, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,10 @@
 
-import time
 from itertools import imap
 
-from .eventlist import EventList
+from .eventlist import EventList, EventLog, Retention
+from .eventcache import EncodedEvents
 from .errors import ServerError
-from .tools import type_check
+from .tools import type_check, parse_cursor
 from common import ircutil
 
 SERVER_COMMANDS = [
@@ -49,38 +49,96 @@ SERVER_COMMANDS = [
     "whowas",
 ]
 
+# The most events server_history and channel_history return at once
+MAX_HISTORY_LIMIT = 1000
+
+def _history(event_list, before_cursor, limit):
+    '''Return a page of event_list's history, for the history methods.'''
+    seq = parse_cursor("before_cursor", before_cursor) \
+          if before_cursor != "" else None
+    type_check("limit", limit, int)
+    if limit < 1 or limit > MAX_HISTORY_LIMIT:
+        raise ServerError("limit must be from 1 to %s." % MAX_HISTORY_LIMIT)
+
+    events = event_list.get_events_before(seq, limit)
+    more = len(events) == limit and events[0].type != "history_truncated"
+    return {
+        'events': EncodedEvents(events, event_list.log.event_cache),
+        'cursor': str(events[0].seq) if more else "",
+    }
+
+def _valid_channel_name(channel_name):
+    '''Return channel_name, checked with `ircutil.chan_validate`.'''
+    type_check("channel_name", channel_name, basestring)
+    try:
+        return ircutil.chan_validate(channel_name)
+    except ValueError as e:
+        raise ServerError('Invalid channel name: "%s".' % channel_name)
+
 class RemoteIRCServer(object):
     '''Represents an IRC Server that the client has connected to.
 
     Any method that does not start with an underscore is served via XMLRPC
     under the name server_<method>.
 
+    `connection_state` is "connecting" until the proxy has connected
+    `connection`, then "connected".  It becomes "failed" if the proxy gives up
+    connecting, "reconnecting" while the proxy recovers a dropped connection,
+    and "disconnected" once the client disconnects it.
+
+    `send_queue` is the connection's `SendQueue`, if it has one.
+
     .. todo:: Rename to IRCServeServer
 
     '''
 
     def __init__(self, connection, server_name, nick_name, uri, port, password=None,
-        ssl=False, ipv6=False):
+        ssl=False, ipv6=False, retention=None, event_log=None, archive=None,
+        send_queue=None):
 
         self.connection = connection
         self.server_name = server_name
         self.nick_name = nick_name
         self.uri = uri
         self.port = port
+        self.password = password
+        self.ssl = ssl
+        self.ipv6 = ipv6
+        self.connection_state = "connecting"
+        self.retention = retention or Retention()
+        self.event_log = event_log or EventLog()
+        self.archive = archive
+        self.send_queue = send_queue
 
-        for i in xrange(5):
-            self.connection.connect(uri, port, nick_name, password,
-                ssl, ipv6)
-            if self.connection.socket:
-                break
-            time.sleep(2)
+        self.channels = {}
+        self.events = EventList(self.retention.policy(server_name),
+                                self.event_log, server=server_name)
 
-        if not self.connection.socket:
-            raise ServerError('Could not connect to server with ' \
-                              'uri="%s", port=%s.' % (uri, port))
+    def _connect(self):
+        '''Make one attempt to connect self.connection to the server.
 
-        self.channels = {}
-        self.events = EventList()
+        This blocks until the attempt succeeds or fails, so it is called
+        outside of the proxy's main loop.  Returns True on success.
+
+        '''
+        self.connection.connect(self.uri, self.port, self.nick_name,
+            self.password, ssl=self.ssl, ipv6=self.ipv6)
+        return bool(self.connection.socket)
+
+    def _is_connected(self):
+        return self.connection_state == "connected"
+
+    def _join_channels(self):
+        '''Join every channel in self.channels.
+
+        Channels can be joined while still connecting, and need rejoining
+        after a reconnect, so this is called whenever the connection is made.
+        Channels are joined several per JOIN line.
+
+        '''
+        names = [channel.channel_name for channel in self.channels.values()]
+        for targets in ircutil.join_batches(names):
+            self.connection.join(targets)
 
     def _handle_irc_event(self, event):
         '''Callback for events from IRC belonging to this server.
@@ -95,58 +153,28 @@ class RemoteIRCServer(object):
         '''
 
         # Hand event to channel, if applicable
-        if "target" in event and event["target"][0] in "#&+!":
-            channel_name = event["target"]
+        if event.target and event.target[0] in "#&+!":
+            channel_name = event.target
             if channel_name in self.channels:
                 channel = self.channels[channel_name]
                 channel._handle_irc_event(event)
                 return
 
         # Event has no channel
-        self.events.append(event)
-
-    def _dispatch_channel_method(self, method, params):
-        '''Dispatch XMLRPC methods that start with "channel_".
-
-        First, this server instance is searched for the method name including
-        the "channel_" prefix.  If that isn't found, the a method name
-        (excluding the "channel_") is looked for in RemoteIRCChannel.
-
-        :param method:
-            Name of the XMLRPC method requested.
-
-        :param params:
-            A tuple of the parameters given in the XMLRPC call.
-
-        :returns:
-            The return value of the method that was called.
-
-        '''
-
-        # Look for method inside this instance
-        func = getattr(self, method, None)
-        if callable(func):
-            return func(*params)
-
-        # Look for method inside channel object
-        channel_method = method[len("channel_"):]
-        if not channel_method.startswith("_") and \
-            hasattr(RemoteIRCChannel, channel_method):
-
-            # Get channel
-            if len(params) <= 0:
-                raise ServerError('Not enough arguments for method "%s".' % method)
-            channel_name = params[0]
-            if channel_name not in self.channels:
-                raise ServerError('Could not find channel "%s" in server "%s".' % (channel_name, self.server_name))
-            channel = self.channels[channel_name]
-
-            # Call channel method
-            func = getattr(channel, channel_method, None)
-            if callable(func):
-                return func(*params[1:])
-
-        raise ServerError('Method "%s" not found.' % method)
+        self._archive(self.events.append(event))
+
+    def _archive(self, event, channel_name=None):
+        '''Add event to the proxy's `EventArchive`, if it has one.'''
+        if self.archive:
+            self.archive.add(event, self.server_name, channel_name)
+
+    def _get_channel(self, channel_name):
+        '''Return the channel called channel_name, raising ServerError if
+        the server has none.'''
+        channel = self.channels.get(channel_name)
+        if channel is None:
+            raise ServerError('Could not find channel "%s" in server "%s".' % (channel_name, self.server_name))
+        return channel
 
     def _disconnect(self, part_message=""):
         '''Disconnect from this server.
@@ -158,17 +186,79 @@ class RemoteIRCServer(object):
         '''
         for channel_name in self.channels.keys():
             self.channel_part(channel_name, part_message)
-        self.connection.disconnect(part_message)
+        was_connected = self._is_connected()
+        # Set first, so the disconnect event isn't taken for a dropped link
+        self.connection_state = "disconnected"
+        if was_connected:
+            self.connection.disconnect(part_message)
+        self._clear_send_queue()
+
+    def _clear_send_queue(self):
+        '''Drop lines queued to send, once the connection is closed.'''
+        if self.send_queue:
+            self.send_queue.clear()
 
     def channel_join(self, channel_name):
 
         channel = RemoteIRCChannel(self, channel_name)
-        self.channels[channel_name] = channel
+        self._add_channel(channel_name, channel)
+        if self._is_connected():
+            self.connection.join(channel.channel_name)
+        return True
+
+    def channel_join_many(self, channel_names):
+        '''Join several channels, with as few JOIN lines as they fit in.
+
+        Every name is checked before any channel is joined, so either all of
+        them are joined or, if one is invalid, none are.
+
+        '''
+        type_check("channel_names", channel_names, list)
+        for channel_name in channel_names:
+            _valid_channel_name(channel_name)
+        channels = []
+        for channel_name in channel_names:
+            if channel_name not in [name for name, channel in channels]:
+                channels.append((channel_name,
+                                 RemoteIRCChannel(self, channel_name)))
+        for channel_name, channel in channels:
+            self._add_channel(channel_name, channel)
+        if self._is_connected():
+            names = [channel.channel_name for name, channel in channels]
+            for targets in ircutil.join_batches(names):
+                self.connection.join(targets)
         return True
 
+    def _add_channel(self, channel_name, channel):
+        if channel_name in self.channels:
+            self.channels[channel_name].events.discard()
+        self.channels[channel_name] = channel
+
     def channel_list(self):
         return self.channels.keys()
 
+    def state(self):
+        return self.connection_state
+
+    def send_queue_state(self):
+        '''Return the lines queued to send to the server, because of its
+        flood control limits: the number in each lane ('normal' and 'bulk'),
+        their total 'depth', and the estimated 'delay', in seconds, until the
+        last is sent.'''
+        if not self.send_queue:
+            raise ServerError('Server "%s" has no send queue.' %
+                              self.server_name)
+        return self.send_queue.state()
+
+    def history(self, before_cursor="", limit=100):
+        '''Return the newest limit server events before before_cursor.
+
+        For paging back through history: the cursor returned is passed as
+        before_cursor to get the page before.
+
+        '''
+        return _history(self.events, before_cursor, limit)
+
     def channel_part(self, channel_name, message=""):
         type_check("channel_name", channel_name, basestring)
         if channel_name not in self.channels:
@@ -178,15 +268,16 @@ class RemoteIRCServer(object):
         channel = self.channels[channel_name]
         channel._part(message)
         del self.channels[channel_name]
+        channel.events.discard()
         #self.events.append(type="channel_part", server=self.server_name,
         #                   channel=channel_name, text=message)
         return True
 
-    def _get_events_since(self, start_time):
-        events = self.events.get_events_since(start_time)
-        for channel in self.channels.itervalues():
-            events.extend(channel._get_events_since(start_time))
-        return events
+    def _discard_events(self):
+        '''Drop the events of this server and its channels.'''
+        self.events.discard()
+        for channel in self.channels.values():
+            channel.events.discard()
 
 class RemoteIRCChannel(object):
     '''Represents a channel on an RemoteIRCServer.
@@ -200,35 +291,61 @@ class RemoteIRCChannel(object):
 
     def __init__(self, server, channel_name):
 
-        type_check("channel_name", channel_name, basestring)
-        try:
-            channel_name = ircutil.chan_validate(channel_name)
-        except ValueError as e:
-            raise ServerError('Invalid channel name: "%s".' % channel_name)
+        channel_name = _valid_channel_name(channel_name)
 
         self.server = server
         self.channel_name = channel_name
 
-        self.server.connection.join(self.channel_name)
-        self.events = EventList()
+        # Joined by the server, now if it is connected, otherwise once it is
+        self.events = EventList(
+            server.retention.policy(server.server_name, channel_name),
+            server.event_log,
+            server = server.server_name,
+            target = channel_name,
+        )
 
     def _handle_irc_event(self, event):
-        self.events.append(event)
+        self.server._archive(self.events.append(event), self.channel_name)
 
-    def _part(self, message):
-        self.server.connection.part(self.channel_name, message)
+    def history(self, before_cursor="", limit=100):
+        '''Return the newest limit channel events before before_cursor.'''
+        return _history(self.events, before_cursor, limit)
 
-    def _get_events_since(self, start_time):
-        return self.events.get_events_since(start_time)
+    def _part(self, message):
+        if self.server._is_connected():
+            self.server.connection.part(self.channel_name, message)
 
     def message(self, message):
         type_check("message", message, basestring)
-        self.events.append(
-            type = "privmsg",
-            server = self.server.server_name,
-            source = self.server.nick_name,
-            target = self.channel_name,
-            text = message,
-        )
-        self.server.connection.privmsg(self.channel_name, message)
+        if not self.server._is_connected():
+            raise ServerError('Server "%s" is not connected.' %
+                              self.server.server_name)
+        self._send_message(message)
         return True
+
+    def message_many(self, messages):
+        '''Send several messages, in order, in one request.'''
+        type_check("messages", messages, list)
+        for message in messages:
+            type_check("message", message, basestring)
+        if not self.server._is_connected():
+            raise ServerError('Server "%s" is not connected.' %
+                              self.server.server_name)
+        for message in messages:
+            self._send_message(message)
+        return True
+
+    def _send_message(self, message):
+        '''Send message, split into as many PRIVMSGs as it needs.'''
+        max_bytes = ircutil.max_message_bytes(self.server.nick_name,
+                                              self.channel_name)
+        for text in ircutil.split_message(message, max_bytes):
+            event = self.events.append(
+                type = "privmsg",
+                server = self.server.server_name,
+                source = self.server.nick_name,
+                target = self.channel_name,
+                text = text,
+            )
+            self.server._archive(event, self.channel_name)
+            self.server.connection.privmsg(self.channel_name, text)
@@ -0,0 +1,93 @@
+
+from bisect import bisect_right
+
+class RingBuffer(object):
+    '''A list-like sequence that is cheap to append to and pop from the front.
+
+    Items live in a list used circularly, with the oldest item at
+    `self._head`.  The list doubles in size whenever it fills up, but never
+    beyond `capacity` if one is given.  It is up to the caller to `popleft`
+    before appending to a full buffer.
+
+    Indexes are logical: 0 is the oldest item, -1 the newest.
+
+    '''
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self._items = [None] * min(capacity or 16, 16)
+        self._head = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def is_full(self):
+        return self.capacity is not None and self._size >= self.capacity
+
+    def _physical(self, index):
+        if index < 0:
+            index += self._size
+        if index < 0 or index >= self._size:
+            raise IndexError("RingBuffer index out of range")
+        return (self._head + index) % len(self._items)
+
+    def __getitem__(self, index):
+        return self._items[self._physical(index)]
+
+    def __setitem__(self, index, item):
+        self._items[self._physical(index)] = item
+
+    def append(self, item):
+        if self._size == len(self._items):
+            if self.is_full():
+                raise IndexError("append to a full RingBuffer")
+            self._grow()
+        self._items[(self._head + self._size) % len(self._items)] = item
+        self._size += 1
+
+    def popleft(self):
+        if not self._size:
+            raise IndexError("popleft from an empty RingBuffer")
+        item = self._items[self._head]
+        self._items[self._head] = None
+        self._head = (self._head + 1) % len(self._items)
+        self._size -= 1
+        return item
+
+    def slice(self, start, end):
+        '''Return items start through end-1 as a list, like list[start:end].
+
+        Copies only the items returned.
+
+        '''
+        start, end, step = slice(start, end).indices(self._size)
+        if start >= end:
+            return []
+        length = len(self._items)
+        first = (self._head + start) % length
+        last = (self._head + end) % length
+        if first < last:
+            return self._items[first:last]
+        return self._items[first:] + self._items[:last]
+
+    def bisect_right(self, value):
+        '''Like bisect.bisect_right, for a buffer of sorted items.'''
+        length = len(self._items)
+        end = self._head + self._size
+        if end <= length:
+            return bisect_right(self._items, value, self._head, end) - \
+                   self._head
+        # The items wrap around, continuing from the start of self._items
+        if value < self._items[0]:
+            return bisect_right(self._items, value, self._head, length) - \
+                   self._head
+        return bisect_right(self._items, value, 0, end - length) + \
+               length - self._head
+
+    def _grow(self):
+        size = 2 * len(self._items)
+        if self.capacity is not None:
+            size = min(size, self.capacity)
+        self._items = self.slice(0, self._size) + [None] * (size - self._size)
+        self._head = 0
@@ -0,0 +1,281 @@
+
+import sys
+import inspect
+import unittest
+
+from errors import ServerError
+
+# What each kind of route calls its method on, and how many of the call's
+# arguments are used to find it
+PROXY, SERVER, CHANNEL, TABLE = "proxy", "server", "channel", "table"
+_LOOKUP_ARGS = {PROXY: 0, SERVER: 1, CHANNEL: 2, TABLE: 0}
+
+def _public_methods(cls):
+    '''Yield (name, function) for each method of cls, including inherited
+    ones, that doesn't start with an underscore.'''
+    for name, func in inspect.getmembers(cls, inspect.ismethod):
+        if not name.startswith("_"):
+            yield name, func.im_func
+
+def _bad_name(name, value):
+    return ServerError('Expected a string for "%s".  Got "%s" instead.' %
+                       (name, type(value)))
+
+class Route(object):
+    '''One RPC method: what it calls, and the arguments it takes.
+
+    The argument schema is read from the function's signature when the route
+    is made, and compiled, with the lookup of the server or channel the
+    method is called on, into `call`.  So a call is one function call, that
+    compares the number of arguments and finds the object, before the
+    method's own.  The types of the arguments are checked by the methods
+    themselves, except for the server and channel names.
+
+    '''
+
+    __slots__ = ("name", "kind", "func", "arg_names", "defaults", "min_args",
+                 "max_args", "lock_free", "call")
+
+    def __init__(self, name, kind, func, lock_free=False):
+        '''
+        :param kind:
+            PROXY for IRCProxyServer methods, called with the arguments.
+            SERVER for RemoteIRCServer methods, whose first argument is a
+            server name.  CHANNEL for RemoteIRCChannel methods, whose first
+            two are a server name and a channel name.  TABLE for
+            `RoutingTable` methods, for introspection.
+
+        :param func:
+            The method's function, taking the object it is called on (or for
+            TABLE, the bound method), then the call's remaining arguments.
+
+        '''
+        args, varargs, keywords, defaults = inspect.getargspec(func)
+        self.name = name
+        self.kind = kind
+        self.func = func
+        self.arg_names = ("server_name", "channel_name")[:_LOOKUP_ARGS[kind]] \
+            + tuple(args[1:])
+        self.defaults = defaults or ()
+        self.min_args = len(self.arg_names) - len(self.defaults)
+        self.max_args = sys.maxint if varargs else len(self.arg_names)
+        self.lock_free = lock_free
+        self.call = self._compile()
+
+    def _compile(self):
+        '''Return a function that takes an IRCProxyServer and a call's
+        arguments, and makes the call.'''
+        func, kind = self.func, self.kind
+        min_args, max_args = self.min_args, self.max_args
+        bad_count = self._bad_count
+
+        if kind == PROXY:
+            def call(proxy, params):
+                if not min_args <= len(params) <= max_args:
+                    raise bad_count(params)
+                return func(proxy, *params)
+        elif kind == TABLE:
+            def call(proxy, params):
+                if not min_args <= len(params) <= max_args:
+                    raise bad_count(params)
+                return func(*params)
+        elif kind == SERVER:
+            def call(proxy, params):
+                if not min_args <= len(params) <= max_args:
+                    raise bad_count(params)
+                return func(_find_server(proxy, params[0]), *params[1:])
+        else:
+            def call(proxy, params):
+                if not min_args <= len(params) <= max_args:
+                    raise bad_count(params)
+                channel_name = params[1]
+                if not isinstance(channel_name, basestring):
+                    raise _bad_name("channel_name", channel_name)
+                server = _find_server(proxy, params[0])
+                return func(server._get_channel(channel_name), *params[2:])
+        return call
+
+    def _bad_count(self, params):
+        if self.max_args == sys.maxint:
+            expected = "at least %d" % self.min_args
+        elif self.min_args == self.max_args:
+            expected = "%d" % self.min_args
+        else:
+            expected = "%d to %d" % (self.min_args, self.max_args)
+        return ServerError('Method "%s" takes %s argument%s, not %d.' %
+                           (self.name, expected,
+                            "" if expected == "1" else "s", len(params)))
+
+    def signature(self):
+        '''Return the method's arguments, like "name(a, b=1)".'''
+        required = len(self.arg_names) - len(self.defaults)
+        args = list(self.arg_names[:required])
+        for name, default in zip(self.arg_names[required:], self.defaults):
+            args.append("%s=%r" % (name, default))
+        if self.max_args == sys.maxint:
+            args.append("...")
+        return "%s(%s)" % (self.name, ", ".join(args))
+
+def _find_server(proxy, server_name):
+    if not isinstance(server_name, basestring):
+        raise _bad_name("server_name", server_name)
+    server = proxy.remote_irc_servers.get(server_name)
+    if server is None:
+        raise ServerError('Server with name "%s" was not found' % server_name)
+    return server
+
+class RoutingTable(dict):
+    '''Every RPC method's `Route`, by method name.
+
+    Built once, from the classes whose methods are served, rather than
+    searching them with getattr on every call.  Public methods are served
+    as:
+
+        * `<method>` for IRCProxyServer methods.
+        * `server_<method>` for RemoteIRCServer methods.  RemoteIRCServer
+          methods that start with "channel_" are also served without the
+          "server_".
+        * `channel_<method>` for RemoteIRCChannel methods.
+
+    Where two would have the same name, the IRCProxyServer method is used,
+    then the RemoteIRCServer one.  The table also serves the XMLRPC
+    introspection methods, `system.listMethods`, `system.methodHelp` and
+    `system.methodSignature`.
+
+    '''
+
+    def __init__(self, proxy_class, server_class, channel_class,
+                 lock_free=()):
+        '''
+        :param lock_free:
+            Names of methods that don't need IRCProxyServer.lock.
+
+        '''
+        dict.__init__(self)
+        lock_free = frozenset(lock_free)
+
+        def add(name, kind, func):
+            self[name] = Route(name, kind, func, name in lock_free)
+
+        for name, func in _public_methods(channel_class):
+            add("channel_" + name, CHANNEL, func)
+        for name, func in _public_methods(server_class):
+            add("server_" + name, SERVER, func)
+            if name.startswith("channel_"):
+                add(name, SERVER, func)
+        for name, func in _public_methods(proxy_class):
+            add(name, PROXY, func)
+        for name, func in (("system.listMethods", self._list_methods),
+                           ("system.methodHelp", self._method_help),
+                           ("system.methodSignature",
+                            self._method_signature)):
+            self[name] = Route(name, TABLE, func, True)
+
+    def route(self, name):
+        '''Return the route for the method called name, raising ServerError if
+        there isn't one.'''
+        route = self.get(name)
+        if route is None:
+            raise ServerError('Method "%s" not found.' % name)
+        return route
+
+    def names(self):
+        return sorted(self) + ["system.multicall"]
+
+    def _list_methods(self):
+        return self.names()
+
+    def _method_help(self, name):
+        if name == "system.multicall":
+            return "system.multicall(calls)\n\nMake several calls at once."
+        route = self.route(name)
+        doc = inspect.getdoc(route.func)
+        return route.signature() + ("\n\n" + doc if doc else "")
+
+    def _method_signature(self, name):
+        # Arguments aren't declared with types, so there is nothing to give
+        # but the conventional answer
+        self.route(name)
+        return "signatures not supported"
+
+
+class _Channel(object):
+    def message(self, message):
+        '''Send message.'''
+        return ("message", message)
+    def history(self, before_cursor="", limit=100):
+        return ("history", before_cursor, limit)
+
+class _Server(object):
+    def __init__(self):
+        self.channels = {"#chan": _Channel()}
+    def state(self):
+        return "connected"
+    def channel_join(self, channel_name):
+        return ("join", channel_name)
+    def _private(self):
+        pass
+    def _get_channel(self, channel_name):
+        if channel_name not in self.channels:
+            raise ServerError("No channel.")
+        return self.channels[channel_name]
+
+class _Proxy(object):
+    def __init__(self):
+        self.remote_irc_servers = {"net": _Server()}
+    def server_list(self):
+        return ["net"]
+    def get_events(self, cursor, *rest):
+        return (cursor,) + rest
+
+class TestRoutingTable(unittest.TestCase):
+
+    def setUp(self):
+        self.table = RoutingTable(_Proxy, _Server, _Channel, ["server_list"])
+        self.proxy = _Proxy()
+
+    def call(self, method, *params):
+        return self.table.route(method).call(self.proxy, params)
+
+    def test_names(self):
+        self.assertEquals(self.table.names(), [
+            "channel_history", "channel_join", "channel_message",
+            "get_events", "server_channel_join", "server_list",
+            "server_state", "system.listMethods", "system.methodHelp",
+            "system.methodSignature", "system.multicall",
+        ])
+        self.assertTrue(self.table["server_list"].lock_free)
+        self.assertFalse(self.table["server_state"].lock_free)
+        self.assertRaises(ServerError, self.table.route, "server__private")
+
+    def test_call(self):
+        self.assertEquals(self.call("server_list"), ["net"])
+        self.assertEquals(self.call("get_events", 1, 2, 3), (1, 2, 3))
+        self.assertEquals(self.call("server_state", "net"), "connected")
+        self.assertEquals(self.call("channel_join", "net", "#new"),
+                          ("join", "#new"))
+        self.assertEquals(self.call("channel_history", "net", "#chan", "5"),
+                          ("history", "5", 100))
+        self.assertEquals(self.call("system.listMethods"),
+                          self.table.names())
+
+    def test_bad_args(self):
+        for params in [("net",), ("net", 1), ("a",) * 5, ("other", "#chan"),
+                       ("net", "#other"), (["net"], "#chan")]:
+            self.assertRaises(ServerError, self.call, "channel_history",
+                              *params)
+        self.assertRaises(ServerError, self.call, "get_events")
+        self.assertRaises(ServerError, self.call, "server_list", 1)
+
+    def test_help(self):
+        self.assertEquals(self.call("system.methodHelp", "channel_message"),
+            "channel_message(server_name, channel_name, message)\n\n"
+            "Send message.")
+        self.assertEquals(self.table["channel_history"].signature(),
+            "channel_history(server_name, channel_name, before_cursor='', "
+            "limit=100)")
+        self.assertEquals(self.table["get_events"].signature(),
+                          "get_events(cursor, ...)")
+
+if __name__ == '__main__':
+    unittest.main()
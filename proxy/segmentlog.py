@@ -0,0 +1,428 @@
+
+import os
+import mmap
+import time
+import struct
+import marshal
+import zlib
+import shutil
+import tempfile
+import unittest
+from array import array
+from bisect import bisect_right
+
+from eventlist import EventLog, EventList, Retention, RetentionPolicy
+from event import Event
+
+# Each record is a header, then the event's fields and the key of the list
+# it belongs to, marshalled.  The header is the length of the marshalled
+# data, a CRC-32 of everything after the CRC, and the event's sequence number
+# and time.
+RECORD_HEADER = struct.Struct("<IIqd")
+
+SEGMENT_SUFFIX = ".seg"
+
+# A sparse index entry is kept for a record at least this many bytes after
+# the last one indexed.
+INDEX_INTERVAL = 4096
+
+class _Segment(object):
+    '''One segment file of a `SegmentedEventLog`.
+
+    Holds the segment's sparse index, and which of its events are still live,
+    but none of the events themselves.
+
+    '''
+
+    def __init__(self, path, first_seq):
+        self.path = path
+        self.first_seq = first_seq
+        self.last_seq = first_seq - 1
+        self.size = 0
+
+        # Sparse index: sequence number, file offset, and the latest event
+        # time in the log so far, for a record every INDEX_INTERVAL bytes.
+        self.index_seqs = array('l')
+        self.index_offsets = array('l')
+        self.index_times = array('d')
+
+        # One byte per event, 1 until the event is evicted
+        self.live = bytearray()
+        self.live_count = 0
+
+        self._map = None
+        self._map_size = 0
+
+    def add(self, seq, offset, latest_time, record_size):
+        '''Account for a record written (or found) at offset.'''
+        if not self.index_offsets or \
+                offset - self.index_offsets[-1] >= INDEX_INTERVAL:
+            self.index_seqs.append(seq)
+            self.index_offsets.append(offset)
+            self.index_times.append(latest_time)
+        self.last_seq = seq
+        self.size = offset + record_size
+        self.live.append(1)
+        self.live_count += 1
+
+    def is_live(self, seq):
+        return self.live[seq - self.first_seq]
+
+    def map(self):
+        '''Return a read only mmap of the segment file.
+
+        The segment may have grown since it was last mapped, so it is mapped
+        again if need be.
+
+        '''
+        if self._map_size < self.size:
+            self.close()
+            with open(self.path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._map_size = len(self._map)
+        return self._map
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._map_size = 0
+
+    def offset_of(self, seq):
+        '''Return the offset of the indexed record at or before seq.'''
+        i = bisect_right(self.index_seqs, seq) - 1
+        return self.index_offsets[max(i, 0)]
+
+    def records(self, seq):
+        '''Yield (seq, time, data) for records from seq on.'''
+        data = self.map()
+        offset = self.offset_of(seq)
+        while offset < self.size:
+            length, crc, record_seq, t = \
+                RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            offset = start + length
+            if record_seq >= seq:
+                yield record_seq, t, data[start:offset]
+
+def decode_record(seq, t, data):
+    '''Return the (list key, Event) marshalled in a record.'''
+    key, fields = marshal.loads(data)
+    return key, Event(seq=seq, time=t, **fields)
+
+def encode_record(event, key):
+    fields = event.to_dict()
+    del fields['seq'], fields['time']
+    data = marshal.dumps((key, fields), 2)
+    crc = zlib.crc32(struct.pack("<qd", event.seq, event.time) + data)
+    return RECORD_HEADER.pack(len(data), crc & 0xffffffff, event.seq,
+                              event.time) + data
+
+class SegmentedEventLog(EventLog):
+    '''An `EventLog` that keeps events on disk, so they survive a restart.
+
+    Events are appended to segment files in `directory`, and a new segment
+    is started once the current one reaches `segment_bytes`.  Only a sparse
+    index of each segment, and one byte per event recording whether it has
+    been evicted, is kept in memory.  Events are read back through an mmap of
+    their segment, so history doesn't sit in the Python heap.  A segment file
+    is deleted once every event in it has been evicted, or once the log is
+    bigger than `max_bytes`, oldest first.
+
+    When the log is opened, the segments are scanned to rebuild the sparse
+    index.  A record that was only partly written when the proxy stopped,
+    or that is corrupt, is cut off the end of its segment along with anything
+    after it.  Sequence numbers carry on from the last event, and each list
+    takes over its own events when it is created again (for example, when a
+    channel is joined).  If `retention` is given, the events of lists that
+    aren't created again are evicted by the policies those lists would have,
+    as soon as the log is opened and then as they age, so they don't stay
+    on disk for ever when there is no `max_bytes`.
+
+    '''
+
+    def __init__(self, directory, segment_bytes, max_bytes=None,
+                 retention=None):
+        EventLog.__init__(self)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.retention = retention
+
+        self._segments = []
+        self._segment_starts = []  # first_seq of each segment
+        self._file = None  # The last segment, open for appending
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._recover()
+        self._sink(self._evict_restored(sizes=True))
+
+    def _recover(self):
+        '''Scan existing segments, truncating any partly written record.'''
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.endswith(SEGMENT_SUFFIX))
+        for name in names:
+            path = os.path.join(self.directory, name)
+            segment = _Segment(path, int(name[:-len(SEGMENT_SUFFIX)]))
+            if segment.first_seq <= self._last_seq:
+                raise RuntimeError('Event log segment "%s" overlaps the one '
+                                   'before it.' % path)
+            self._scan(segment)
+            if segment.live_count:
+                self._add_segment(segment)
+                self._last_seq = segment.last_seq
+            else:
+                os.remove(path)
+        self._first_seq = self._segments[0].first_seq if self._segments \
+                          else self._last_seq + 1
+        if self._segments:
+            self._file = open(self._segments[-1].path, "ab", 0)
+
+    def _scan(self, segment):
+        with open(segment.path, "r+b") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            data = mmap.mmap(f.fileno(), 0) if size else ""
+            offset = 0
+            while offset + RECORD_HEADER.size <= size:
+                length, crc, seq, t = RECORD_HEADER.unpack_from(data, offset)
+                start = offset + RECORD_HEADER.size
+                end = start + length
+                if end > size or seq != segment.last_seq + 1 or \
+                        zlib.crc32(data[start-16:end]) & 0xffffffff != crc:
+                    break
+                key, event = decode_record(seq, t, data[start:end])
+                self._latest_time = max(t, self._latest_time)
+                self._restored.setdefault(key, []).append(
+                    (seq, self._latest_time))
+                segment.add(seq, offset, self._latest_time, end - offset)
+                offset = end
+            if size:
+                data.close()
+            if offset < size:
+                #TODO: Log
+                print 'Truncating event log "%s" from byte %s, after a ' \
+                      'partly written or corrupt record.' % (segment.path,
+                                                             offset)
+                f.truncate(offset)
+
+    def _add_segment(self, segment):
+        self._segments.append(segment)
+        self._segment_starts.append(segment.first_seq)
+
+    def _segment(self, seq):
+        i = bisect_right(self._segment_starts, seq) - 1
+        if i < 0:
+            return None
+        segment = self._segments[i]
+        if seq > segment.last_seq:
+            return None
+        return segment
+
+    def _store(self, event, event_list):
+        if not self._segments or \
+                self._segments[-1].size >= self.segment_bytes:
+            self._rotate(event.seq)
+        segment = self._segments[-1]
+        record = encode_record(event, event_list.key)
+        self._file.write(record)
+        segment.add(event.seq, segment.size,
+                    max(event.time, self._latest_time), len(record))
+
+    def _rotate(self, first_seq):
+        '''Start a new segment, whose first event is numbered first_seq.'''
+        if self._file:
+            self._file.close()
+            last = self._segments[-1]
+            if not last.live_count:
+                self._delete_segment(last)
+        path = os.path.join(self.directory,
+                            "%020d%s" % (first_seq, SEGMENT_SUFFIX))
+        self._file = open(path, "ab", 0)
+        self._add_segment(_Segment(path, first_seq))
+        self._enforce_max_bytes()
+
+    def _enforce_max_bytes(self):
+        '''Delete the oldest segments while the log is too big.'''
+        if self.max_bytes is None:
+            return
+        while len(self._segments) > 1 and \
+                sum(s.size for s in self._segments) > self.max_bytes:
+            segment = self._segments[0]
+            next_seq = self._segments[1].first_seq
+            for event_list in list(self.lists):
+                event_list._forget_before(next_seq)
+            for key, restored in self._restored.items():
+                restored = [(seq, t) for seq, t in restored
+                            if seq >= next_seq]
+                if restored:
+                    self._restored[key] = restored
+                else:
+                    del self._restored[key]
+            self._evicted_seq = max(self._evicted_seq, segment.last_seq)
+            self._delete_segment(segment)
+
+    def _delete_segment(self, segment):
+        segment.close()
+        os.remove(segment.path)
+        i = self._segments.index(segment)
+        del self._segments[i]
+        del self._segment_starts[i]
+        self._first_seq = self._segments[0].first_seq if self._segments \
+                          else self._last_seq + 1
+
+    def _get(self, seq):
+        segment = self._segment(seq)
+        if segment is None or not segment.is_live(seq):
+            return None
+        for record_seq, t, data in segment.records(seq):
+            return decode_record(record_seq, t, data)[1]
+
+    def _remove(self, seq, evicted=True):
+        event = self._get(seq)
+        segment = self._segment(seq)
+        segment.live[seq - segment.first_seq] = 0
+        segment.live_count -= 1
+        # The last segment is kept for appending to
+        if not segment.live_count and segment is not self._segments[-1]:
+            self._delete_segment(segment)
+        if evicted:
+            self._evicted_seq = max(self._evicted_seq, seq)
+        if self.event_cache is not None:
+            self.event_cache.discard(seq)
+        return event
+
+    def _read(self, first_seq, last_seq, limit):
+        events = []
+        i = max(bisect_right(self._segment_starts, first_seq) - 1, 0)
+        for segment in self._segments[i:]:
+            if len(events) >= limit or segment.first_seq > last_seq:
+                break
+            start = max(first_seq, segment.first_seq)
+            if start > segment.last_seq:
+                continue
+            for seq, t, data in segment.records(start):
+                if seq > last_seq or len(events) >= limit:
+                    break
+                if segment.is_live(seq):
+                    events.append(decode_record(seq, t, data)[1])
+        return events
+
+    def _first_seq_since(self, start_time):
+        # The index times are the latest time in the log at each entry, so
+        # they are sorted across segments.
+        first_seq = self._first_seq
+        for segment in self._segments:
+            if not segment.index_times or segment.index_times[0] > start_time:
+                break
+            i = bisect_right(segment.index_times, start_time) - 1
+            first_seq = segment.index_seqs[i]
+        return first_seq
+
+    def close(self):
+        with self.lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+            for segment in self._segments:
+                segment.close()
+
+
+class TestSegmentedEventLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open_log(self, **kwargs):
+        log = SegmentedEventLog(self.directory, 200, **kwargs)
+        self.addCleanup(log.close)
+        return log
+
+    def test_restart(self):
+        log = self.open_log()
+        channel = EventList(None, log, server="net", target="#chan")
+        for i in xrange(20):
+            channel.append(type="pubmsg", text="message %d" % i, time=i)
+        self.assertTrue(len(log._segments) > 1)
+        log.close()
+
+        log = self.open_log()
+        events, cursor = log.get_events_after(15, 100)
+        self.assertEquals([e.text for e in events],
+                          ["message %d" % i for i in xrange(15, 20)])
+        self.assertEquals([e.seq for e in log.get_events_since(17.5)],
+                          [19, 20])
+        channel = EventList(None, log, server="net", target="#chan")
+        self.assertEquals(len(channel), 20)
+        channel.append(type="pubmsg", text="after restart")
+        self.assertEquals(channel.get_events_after(20, 10)[0].seq, 21)
+
+    def test_torn_tail(self):
+        log = self.open_log()
+        events = EventList(None, log)
+        for i in xrange(3):
+            events.append(type="test")
+        log.close()
+        with open(log._segments[-1].path, "ab") as f:
+            f.write(encode_record(Event("test", 1.0, seq=4), ())[:-3])
+
+        log = self.open_log()
+        self.assertEquals(log.last_seq(), 3)
+        events = EventList(None, log)
+        events.append(type="test")
+        self.assertEquals([e.seq for e in log.get_events_after(0, 10)[0]],
+                          [1, 2, 3, 4])
+
+    def test_segments_deleted(self):
+        log = self.open_log()
+        events = EventList(RetentionPolicy(max_events=2), log)
+        for i in xrange(50):
+            events.append(type="test")
+        self.assertTrue(len(log._segments) <= 2)
+        self.assertEquals(len(os.listdir(self.directory)),
+                          len(log._segments))
+
+    def test_restored_retention(self):
+        log = self.open_log()
+        channel = EventList(None, log, server="net", target="#chan")
+        for i in xrange(20):
+            channel.append(type="pubmsg", text="message %d" % i)
+        log.close()
+
+        evicted = []
+        retention = Retention(sink=evicted.append,
+                              channels={("net", "#chan"): {"max_events": 5}})
+        log = self.open_log(retention=retention)
+        # The channel is never joined again
+        self.assertEquals([e.seq for e in evicted], range(1, 16))
+        self.assertEquals([e.seq for e in log.get_events_after(0, 100)[0]],
+                          range(16, 21))
+        self.assertTrue(len(log._segments) < 5)
+        log.close()
+
+        retention = Retention(channels={("net", "#chan"): {"max_events": 5,
+                                                           "max_age": 60}})
+        log = self.open_log(retention=retention)
+        self.assertEquals(len(log.get_events_after(0, 100)[0]), 5)
+        retention.channels[("net", "#chan")].max_age = 0.001
+        time.sleep(0.01)
+        log._last_sweep = 0
+        self.assertEquals(log.get_events_after(0, 100)[0], [])
+        self.assertEquals(log._restored, {})
+
+    def test_max_bytes(self):
+        log = self.open_log(max_bytes=1000)
+        events = EventList(None, log)
+        for i in xrange(100):
+            events.append(type="test")
+        self.assertTrue(sum(s.size for s in log._segments) < 1000 + 200)
+        seqs = [e.seq for e in events.get_events_after(0, 1000)]
+        self.assertEquals(seqs[0], log._first_seq - 1)  # history_truncated
+        self.assertEquals(seqs[1:], range(log._first_seq, 101))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,246 @@
+
+import threading
+import unittest
+from collections import deque
+
+from tools import TokenBucket
+
+FLOOD_CONTROL_LIMITS = ("burst", "rate")
+
+# Lines that can be sent at once, then lines per second after that.  Like
+# most IRC clients, this stays under what servers count as excess flood.
+DEFAULT_FLOOD_CONTROL = {"burst": 5, "rate": 0.5}
+
+# Lanes, in the order they are sent from
+LANES = ("urgent", "normal", "bulk")
+URGENT, NORMAL, BULK = range(len(LANES))
+
+# Lanes of IRC commands that aren't NORMAL
+_COMMAND_LANES = {
+    "PONG": URGENT,
+    "QUIT": URGENT,
+    "JOIN": BULK,
+    "WHO": BULK,
+    "NAMES": BULK,
+    "LIST": BULK,
+}
+
+def _check_limits(limits):
+    for name, value in limits.iteritems():
+        if name not in FLOOD_CONTROL_LIMITS:
+            raise ValueError('Unknown flood control limit "%s".' % name)
+    burst, rate = limits["burst"], limits["rate"]
+    if not isinstance(burst, (int, long)) or burst < 1:
+        raise ValueError('Flood control limit "burst" must be a positive '
+                         'integer, not %r.' % (burst,))
+    if rate is not None and \
+            (not isinstance(rate, (int, long, float)) or rate <= 0):
+        raise ValueError('Flood control limit "rate" must be a positive '
+                         'number or None, not %r.' % (rate,))
+
+class FloodControl(object):
+    '''The limits on sending to IRC servers configured for the proxy.
+
+    Limits are given as dictionaries with keys from `FLOOD_CONTROL_LIMITS`:
+    "burst", how many lines can be sent at once, and "rate", how many lines
+    per second can be sent after that, or None for no limit.  A server's
+    limits override the defaults.
+
+    :param default:
+        Limits for every server, overriding `DEFAULT_FLOOD_CONTROL`.
+
+    :param servers:
+        Maps server names to limits for that server.
+
+    '''
+
+    def __init__(self, default=None, servers=None):
+        self.default = dict(DEFAULT_FLOOD_CONTROL)
+        self.default.update(default or {})
+        _check_limits(self.default)
+        self.servers = {}
+        for server_name, limits in (servers or {}).iteritems():
+            self.servers[server_name] = dict(self.default)
+            self.servers[server_name].update(limits)
+            _check_limits(self.servers[server_name])
+
+    def limits(self, server_name):
+        '''Return the limits for server_name, as keyword arguments for
+        `SendQueue`.'''
+        return self.servers.get(server_name, self.default)
+
+class SendQueue(object):
+    '''Queues the lines sent on an IRC connection, so that they go out no
+    faster than the server allows.
+
+    The queue takes over the connection's send_raw, so everything sent on
+    the connection goes through it, whether the proxy or the IRC library
+    sends it.  Lines are sent at once while a `TokenBucket` of `burst` lines,
+    refilled at `rate` lines per second, has tokens, and queued otherwise.
+
+    Lines are sent as UTF-8, which is also how `ircutil.split_message`
+    measures them.
+
+    Queued lines wait in one of three lanes, by command, and are sent from
+    the first lane that has any:
+
+        * urgent: PONG and QUIT, which are never queued at all, as a late
+          PONG gets the connection dropped, and a QUIT is followed by
+          closing it.
+        * normal: messages, and everything else.
+        * bulk: JOIN, WHO, NAMES and LIST, which can flood a server when
+          there are many channels, and can wait.
+
+    '''
+
+    def __init__(self, connection, call_later, burst=5, rate=0.5):
+        '''
+        :param call_later:
+            call_later(delay, callback), which may be called from any thread,
+            and calls callback() after delay seconds.
+
+        '''
+        self.connection = connection
+        self.call_later = call_later
+        self.burst = burst
+        self.rate = rate
+        self.bucket = TokenBucket(rate, burst) if rate is not None else None
+
+        self._send_raw = connection.send_raw
+        connection.send_raw = self.send
+        self._lanes = tuple(deque() for lane in LANES)
+        self._timer = False  # Whether a drain is scheduled
+        # Sending can fail, and disconnect, which clears the queue
+        self._lock = threading.RLock()
+
+    def send(self, line):
+        '''Send line, an IRC line without the CRLF, or queue it.  Unicode
+        lines are sent as UTF-8.'''
+        if isinstance(line, unicode):
+            line = line.encode("utf-8")
+        lane = _COMMAND_LANES.get(line.split(" ", 1)[0].upper(), NORMAL)
+        with self._lock:
+            if lane == URGENT:
+                if self.bucket is not None:
+                    self.bucket.consume()
+                self._send_raw(line)
+            else:
+                self._lanes[lane].append(line)
+                self._drain()
+
+    def _drain(self):
+        '''Send queued lines while there are tokens, and schedule the next
+        drain if any are left.'''
+        for lane in self._lanes:
+            while lane and (self.bucket is None or self.bucket.consume()):
+                self._send_raw(lane.popleft())
+            if lane:
+                break
+        else:
+            return
+        if not self._timer:
+            self._timer = True
+            self.call_later(self.bucket.delay(), self._drain_timer_done)
+
+    def _drain_timer_done(self):
+        with self._lock:
+            self._timer = False
+            if self.connection.connected:
+                self._drain()
+            else:
+                self.clear()
+
+    def clear(self):
+        '''Drop the queued lines, when the connection is closed.  A new
+        connection starts with a full burst.'''
+        with self._lock:
+            for lane in self._lanes:
+                lane.clear()
+            if self.bucket is not None:
+                self.bucket = TokenBucket(self.rate, self.burst)
+
+    def state(self):
+        '''Return the number of lines queued in the 'normal' and 'bulk'
+        lanes, their total 'depth', and the estimated 'delay', in seconds,
+        until the last of them is sent.'''
+        with self._lock:
+            state = dict((LANES[lane], len(self._lanes[lane]))
+                         for lane in (NORMAL, BULK))
+            state['depth'] = sum(len(lane) for lane in self._lanes)
+            if self.bucket is None or not state['depth']:
+                state['delay'] = 0.0
+            else:
+                state['delay'] = self.bucket.delay(state['depth'])
+            return state
+
+
+class _Connection(object):
+    def __init__(self):
+        self.connected = True
+        self.sent = []
+    def send_raw(self, line):
+        self.sent.append(line)
+
+class TestSendQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = _Connection()
+        self.timers = []
+        self.queue = SendQueue(self.connection,
+                               lambda delay, callback:
+                                   self.timers.append((delay, callback)),
+                               burst=2, rate=0.5)
+
+    def test_rate_limit(self):
+        for i in xrange(4):
+            self.connection.send_raw("PRIVMSG #chan :%d" % i)
+        self.assertEquals(self.connection.sent,
+                          ["PRIVMSG #chan :0", "PRIVMSG #chan :1"])
+        state = self.queue.state()
+        self.assertEquals((state['depth'], state['normal']), (2, 2))
+        self.assertAlmostEquals(state['delay'], 4, 1)
+        self.assertEquals(len(self.timers), 1)
+        self.assertAlmostEquals(self.timers[0][0], 2, 1)
+
+    def test_lanes(self):
+        send = self.connection.send_raw
+        for line in ["PRIVMSG #a :0", "PRIVMSG #a :1", "JOIN #b",
+                     "WHO #a", "PRIVMSG #a :2", "PONG irc.example.net"]:
+            send(line)
+        self.assertEquals(self.connection.sent, ["PRIVMSG #a :0",
+            "PRIVMSG #a :1", "PONG irc.example.net"])
+
+        self.queue.bucket.tokens = 2
+        self.timers.pop()[1]()
+        self.assertEquals(self.connection.sent[3:],
+                          ["PRIVMSG #a :2", "JOIN #b"])
+        self.assertEquals(self.queue.state()['bulk'], 1)
+        self.assertEquals(len(self.timers), 1)
+
+    def test_disconnected(self):
+        for line in ["PRIVMSG #a :0", "PRIVMSG #a :1", "PRIVMSG #a :2"]:
+            self.connection.send_raw(line)
+        self.connection.connected = False
+        self.timers.pop()[1]()
+        self.assertEquals(self.queue.state()['depth'], 0)
+        self.assertEquals(len(self.connection.sent), 2)
+
+    def test_unlimited(self):
+        queue = SendQueue(_Connection(), None, rate=None)
+        for i in xrange(100):
+            queue.connection.send_raw("PRIVMSG #a :%d" % i)
+        self.assertEquals(len(queue.connection.sent), 100)
+        self.assertEquals(queue.state()['delay'], 0)
+
+    def test_flood_control(self):
+        flood_control = FloodControl({"rate": 1},
+                                     {"slow": {"burst": 2, "rate": 0.25}})
+        self.assertEquals(flood_control.limits("other"),
+                          {"burst": 5, "rate": 1})
+        self.assertEquals(flood_control.limits("slow"),
+                          {"burst": 2, "rate": 0.25})
+        for default in [{"burst": 0}, {"rate": -1}, {"lines": 3}]:
+            self.assertRaises(ValueError, FloodControl, default)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+
+import time
+import threading
+import unittest
+
+from event import Event
+from eventlist import EventList, EventLog
+
+class ClientSession(object):
+    '''One client's position in the event log, kept by the proxy.
+
+    Without a session, each client has to remember its own cursor.  With
+    one, the proxy remembers it, and `fetch` returns whatever the client
+    hasn't had yet.  Every session reads the same shared log, so attaching
+    another client only costs another cursor.
+
+    Each session has its own `EventFilter` (its subscriptions), and its own
+    backlog limit.  A client that comes back after missing more than
+    `max_backlog` events skips the oldest of them, rather than having to
+    fetch everything the proxy still keeps.
+
+    '''
+
+    def __init__(self, client_id, event_log, max_backlog=None):
+        '''
+        :param client_id:
+            What identifies the client, the fingerprint of its certificate.
+
+        :param max_backlog:
+            Most events a fetch can be behind by before the oldest are
+            skipped, or None for no limit.
+
+        '''
+        self.client_id = client_id
+        self.event_log = event_log
+        self.max_backlog = max_backlog
+        self.cursor = 0
+        self.event_filter = None
+        self.filter_spec = {}
+        self.last_fetch = None
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+
+    def fetch(self, limit):
+        '''Return events since the last fetch, and move the cursor past them.
+
+        If the oldest events were skipped, the events start with a
+        "session_backlog_skipped" event.
+
+        :returns:
+            (events, cursor)
+
+        '''
+        with self.lock:
+            skipped = self._skip_backlog()
+            if skipped:
+                limit -= 1
+            events, self.cursor = self.event_log.get_events_after(
+                self.cursor, max(limit, 1), self.event_filter)
+            if skipped:
+                events.insert(0, skipped)
+            self.last_fetch = self.last_used = time.time()
+            return events, self.cursor
+
+    def _skip_backlog(self):
+        '''Move the cursor past events beyond max_backlog, and return an event
+        saying so, or None if none were skipped.'''
+        last_seq = self.event_log.last_seq()
+        if self.cursor > last_seq:
+            # From before the proxy restarted
+            self.cursor = 0
+        if self.max_backlog is None or \
+                last_seq - self.cursor <= self.max_backlog:
+            return None
+        cursor = last_seq - self.max_backlog
+        skipped = Event("session_backlog_skipped", time.time(), seq=cursor,
+                        count=cursor - self.cursor)
+        self.cursor = cursor
+        return skipped
+
+    def seek(self, cursor):
+        '''Make the next fetch start after cursor.'''
+        with self.lock:
+            self.cursor = cursor
+            self.last_used = time.time()
+
+    def subscribe(self, event_filter, spec):
+        '''Only fetch events matching event_filter, from spec.  None for
+        every event.'''
+        with self.lock:
+            self.event_filter = event_filter
+            self.filter_spec = spec
+            self.last_used = time.time()
+
+    def state(self):
+        '''Return the session's state, as sent to clients.'''
+        last_seq = self.event_log.last_seq()
+        with self.lock:
+            return {
+                'client_id': self.client_id,
+                'cursor': str(self.cursor),
+                'behind': str(max(last_seq - self.cursor, 0)),
+                'filter': self.filter_spec,
+                'last_fetch': self.last_fetch or 0,
+            }
+
+class SessionTable(object):
+    '''The proxy's `ClientSession`s, by client id.
+
+    Sessions are made when a client first uses one, and forgotten once
+    unused for `idle_timeout` seconds.
+
+    '''
+
+    def __init__(self, event_log, max_backlog=None, idle_timeout=None):
+        self.event_log = event_log
+        self.max_backlog = max_backlog
+        self.idle_timeout = idle_timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, client_id):
+        '''Return client_id's session, making it if needed.'''
+        with self._lock:
+            session = self._sessions.get(client_id)
+            if session is None:
+                self._expire()
+                session = ClientSession(client_id, self.event_log,
+                                        self.max_backlog)
+                self._sessions[client_id] = session
+            return session
+
+    def find(self, client_id):
+        '''Return client_id's session, or None if it has none.'''
+        return self._sessions.get(client_id)
+
+    def sessions(self):
+        with self._lock:
+            self._expire()
+            return self._sessions.values()
+
+    def _expire(self):
+        if self.idle_timeout is None:
+            return
+        oldest = time.time() - self.idle_timeout
+        for client_id, session in self._sessions.items():
+            if session.last_used < oldest:
+                del self._sessions[client_id]
+
+
+class TestClientSession(unittest.TestCase):
+
+    def setUp(self):
+        self.log = EventLog()
+        self.events = EventList(None, self.log)
+
+    def append(self, count):
+        for i in xrange(count):
+            self.events.append(type="test")
+
+    def test_fetch(self):
+        session = ClientSession("a", self.log)
+        self.append(3)
+        events, cursor = session.fetch(2)
+        self.assertEquals([e.seq for e in events], [1, 2])
+        events, cursor = session.fetch(10)
+        self.assertEquals([e.seq for e in events], [3])
+        self.assertEquals(session.fetch(10), ([], 3))
+        self.assertEquals(session.state()['behind'], "0")
+
+    def test_backlog(self):
+        session = ClientSession("a", self.log, max_backlog=2)
+        self.append(5)
+        events, cursor = session.fetch(10)
+        self.assertEquals([(e.type, e.seq) for e in events],
+                          [("session_backlog_skipped", 3), ("test", 4),
+                           ("test", 5)])
+        self.assertEquals(events[0]['count'], 3)
+
+    def test_table(self):
+        table = SessionTable(self.log, idle_timeout=60)
+        a = table.get("a")
+        self.assertTrue(table.get("a") is a)
+        self.assertEquals(table.find("b"), None)
+        a.last_used -= 120
+        table.get("b")
+        self.assertEquals([s.client_id for s in table.sessions()], ["b"])
+
+if __name__ == '__main__':
+    unittest.main()
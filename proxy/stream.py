@@ -0,0 +1,453 @@
+
+import ssl
+import json
+import time
+import errno
+import socket
+import shutil
+import tempfile
+import threading
+import unittest
+from collections import deque
+
+from reactor import Reactor
+from errors import ServerError
+from tools import parse_cursor
+from eventlist import EventList
+from eventcache import EncodedEvents
+from common.securexmlrpc import SSLContextCache, _make_test_cert
+from common.streamframes import FORMATS, FRAME_HEADER, MAX_FRAME_BYTES, \
+    FrameReader, pack_frame
+
+# Most events sent in one frame
+STREAM_BATCH_SIZE = 1000
+
+# Seconds a connection has to finish the TLS handshake and send its hello
+HELLO_TIMEOUT = 10
+
+# Hellos are small.  Anything longer is refused.
+MAX_HELLO_BYTES = 4096
+
+# What happens to a connection that can't keep up
+SLOW_CONSUMER_POLICIES = ("drop", "disconnect")
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+class _StreamConnection(object):
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.reader = FrameReader()
+        self.dumps = None  # Set by the hello
+        self.event_filter = None  # Set by the hello
+        self.cursor = None  # Sequence number of the last event queued
+        self.out = deque()  # Frames, or what is left of them, to send
+        self.out_bytes = 0
+        # When the send buffer filled up before this caught up, if it hasn't
+        # caught up since
+        self.behind_since = None
+        self.closing = False  # Close once everything is sent
+        self.closed = False
+
+class StreamServer(object):
+    '''Pushes events to clients over long lived TLS connections.
+
+    The framing and handshake are described in `common.streamframes`.  The
+    server runs on its own thread, with its own `Reactor`, and reads events
+    from the `EventLog`, so it works with either engine and never holds up
+    IRC processing.  The log wakes it whenever an event is appended.
+
+    Each connection has a send buffer of `buffer_bytes`.  Events are read
+    from the log, after the connection's cursor, only while there is room,
+    so a slow client holds no more than that (and one frame) in memory, and
+    catches up from the log once it reads again.  With the "drop" policy, a client that
+    falls so far behind that the events it hasn't had are evicted gets a
+    history_truncated event in their place.  With "disconnect", a client
+    that hasn't caught up `stall_timeout` seconds after its buffer filled is
+    disconnected, and can resume from its cursor when it reconnects.
+
+    The TLS arguments are the same as `SecureXMLRPCServer`'s.
+
+    :param make_filter:
+        Function that turns the "filter" of a hello into an `EventFilter`,
+        raising `ServerError` if it is invalid.  If None, hellos can't have
+        filters.
+
+    '''
+
+    def __init__(self, event_log, address, certfile, keyfile=None,
+                 ca_certs=None, cert_reqs=ssl.CERT_REQUIRED,
+                 ssl_version=ssl.PROTOCOL_TLSv1, buffer_bytes=1024*1024,
+                 slow_consumer="drop", stall_timeout=30, make_filter=None):
+        if slow_consumer not in SLOW_CONSUMER_POLICIES:
+            raise ValueError('Unknown slow consumer policy "%s".' %
+                             slow_consumer)
+        self.event_log = event_log
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.ca_certs = ca_certs
+        self.cert_reqs = cert_reqs
+        self.ssl_version = ssl_version
+        self.buffer_bytes = buffer_bytes
+        self.slow_consumer = slow_consumer
+        self.stall_timeout = stall_timeout
+        self.make_filter = make_filter
+        self.ssl_contexts = SSLContextCache(
+            server_side = True,
+            certfile = certfile,
+            keyfile = keyfile,
+            ca_certs = ca_certs,
+            cert_reqs = cert_reqs,
+            ssl_version = ssl_version,
+        )
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        self.socket.listen(16)
+        self.socket.setblocking(False)
+
+        self.connections = set()
+        self.reactor = Reactor()
+        self.reactor.add_reader(self.socket, self._accept)
+        self._thread = threading.Thread(target=self._run, name="StreamServer")
+        self._thread.daemon = True
+
+    def start(self):
+        '''Start serving, on a thread of its own.'''
+        self._thread.start()
+
+    def stop(self):
+        '''Close every connection and the listening socket, and wait for the
+        server's thread to finish.'''
+        self.reactor.call_soon_threadsafe(self._stop)
+        self._thread.join()
+
+    def _run(self):
+        self._wait_for_events()
+        self.reactor.run()
+
+    def _stop(self):
+        for conn in list(self.connections):
+            self._close(conn)
+        self.reactor.remove_reader(self.socket)
+        self.socket.close()
+        self.event_log.remove_waiter(self._appended)
+        self.reactor.stop()
+
+    def _wait_for_events(self):
+        self.event_log.add_waiter(self._appended)
+
+    def _appended(self):
+        # Called by the log, from whichever thread appended
+        self.reactor.call_soon_threadsafe(self._fill_all)
+
+    def _fill_all(self):
+        self._wait_for_events()
+        for conn in list(self.connections):
+            if conn.cursor is not None and not conn.closing:
+                self._fill(conn)
+
+    def _accept(self):
+        try:
+            sock, address = self.socket.accept()
+            sock = self.ssl_contexts.wrap_socket(
+                sock, do_handshake_on_connect=False)
+            sock.setblocking(False)
+        except (socket.error, ssl.SSLError):
+            return
+        conn = _StreamConnection(sock, address)
+        self.connections.add(conn)
+        self.reactor.call_later(HELLO_TIMEOUT, self._hello_timeout, conn)
+        self._handshake(conn)
+
+    def _hello_timeout(self, conn):
+        if conn.cursor is None:
+            self._close(conn)
+
+    def _handshake(self, conn):
+        try:
+            conn.sock.do_handshake()
+        except ssl.SSLError as e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.reactor.remove_writer(conn.sock)
+                self.reactor.add_reader(conn.sock, self._handshake, conn)
+            elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.reactor.remove_reader(conn.sock)
+                self.reactor.add_writer(conn.sock, self._handshake, conn)
+            else:
+                #TODO: Log
+                self._close(conn)
+            return
+        except socket.error:
+            self._close(conn)
+            return
+        self.reactor.remove_writer(conn.sock)
+        self.reactor.add_reader(conn.sock, self._readable, conn)
+        self._readable(conn)
+
+    def _readable(self, conn):
+        while not conn.closed:
+            try:
+                data = conn.sock.recv(16384)
+            except ssl.SSLError as e:
+                if e.args[0] != ssl.SSL_ERROR_WANT_READ:
+                    self._close(conn)
+                return
+            except socket.error as e:
+                if e.args[0] not in _WOULD_BLOCK:
+                    self._close(conn)
+                return
+            if not data:
+                self._close(conn)
+                return
+            if conn.cursor is None and not conn.closing:
+                self._receive_hello(conn, data)
+            # Anything sent after the hello is ignored
+
+    def _receive_hello(self, conn, data):
+        try:
+            frames = conn.reader.feed(data)
+        except ValueError:
+            frames = None
+        # Whether or not the whole of a long hello has arrived
+        if frames is None or conn.reader.buffered() > MAX_HELLO_BYTES or \
+                (frames and len(frames[0]) > MAX_HELLO_BYTES):
+            self._refuse(conn, "Hello is too long.")
+        elif frames:
+            try:
+                hello = json.loads(frames[0])
+                if not isinstance(hello, dict):
+                    raise ValueError()
+            except ValueError:
+                self._refuse(conn, "Hello is not a JSON object.")
+                return
+            format = hello.get("format", "json")
+            if format not in FORMATS:
+                self._refuse(conn, 'Unknown format "%s".' % format)
+                return
+            dumps = FORMATS[format][0]
+            try:
+                cursor = parse_cursor("cursor", hello.get("cursor", "0"))
+                event_filter = self._make_filter(hello.get("filter"))
+            except ServerError as e:
+                self._refuse(conn, ' '.join(e.args), dumps)
+                return
+            conn.dumps = dumps
+            conn.event_filter = event_filter
+            conn.cursor = cursor
+            self._fill(conn, True)
+
+    def _make_filter(self, spec):
+        if spec is None:
+            return None
+        if self.make_filter is None:
+            raise ServerError("Filters are not supported.")
+        return self.make_filter(spec)
+
+    def _refuse(self, conn, message, dumps=FORMATS["json"][0]):
+        '''Send an error frame, then close the connection.'''
+        #TODO: Log
+        self._send(conn, dumps({'error': message}))
+        conn.closing = True
+        self._flush(conn)
+
+    def _fill(self, conn, first=False):
+        '''Queue and send events after conn's cursor, while its send buffer
+        has room.
+
+        :param first:
+            Whether this is the first fill, which always sends a frame.
+
+        '''
+        while not conn.closed:
+            while conn.out_bytes < self.buffer_bytes:
+                events, cursor = self.event_log.get_events_after(
+                    conn.cursor, STREAM_BATCH_SIZE, conn.event_filter)
+                if cursor == conn.cursor and not first:
+                    break
+                caught_up = cursor == self.event_log.last_seq()
+                conn.cursor = cursor
+                # Batches the filter emptied aren't worth a frame
+                if events or first:
+                    self._send(conn, conn.dumps({
+                        'events': EncodedEvents(events,
+                                                self.event_log.event_cache),
+                        'cursor': str(cursor),
+                    }))
+                first = False
+                if caught_up:
+                    break
+            else:
+                # The buffer filled up before conn caught up.  Try again if
+                # sending has drained it, otherwise once it drains.
+                self._flush(conn)
+                if conn.out_bytes < self.buffer_bytes // 2:
+                    continue
+                if not conn.closed and conn.behind_since is None:
+                    conn.behind_since = time.time()
+                    if self.slow_consumer == "disconnect":
+                        self.reactor.call_later(self.stall_timeout,
+                            self._check_stalled, conn, conn.behind_since)
+                return
+
+            conn.behind_since = None
+            self._flush(conn)
+            return
+
+    def _check_stalled(self, conn, behind_since):
+        '''Disconnect conn if it hasn't caught up since behind_since.'''
+        if conn.behind_since == behind_since:
+            #TODO: Log
+            self._close(conn)
+
+    def _send(self, conn, data):
+        frame = pack_frame(data)
+        conn.out.append(frame)
+        conn.out_bytes += len(frame)
+
+    def _flush(self, conn):
+        '''Send as much of conn's send buffer as the socket will take.'''
+        while conn.out and not conn.closed:
+            data = conn.out[0]
+            try:
+                sent = conn.sock.send(data)
+            except ssl.SSLError as e:
+                if e.args[0] not in (ssl.SSL_ERROR_WANT_WRITE,
+                                     ssl.SSL_ERROR_WANT_READ):
+                    self._close(conn)
+                    return
+                break
+            except socket.error as e:
+                if e.args[0] not in _WOULD_BLOCK:
+                    self._close(conn)
+                    return
+                break
+            if not sent:
+                # SSL sockets return 0, rather than raising, when they would
+                # block
+                break
+            conn.out_bytes -= sent
+            if sent < len(data):
+                conn.out[0] = data[sent:]
+            else:
+                conn.out.popleft()
+
+        if conn.closed:
+            return
+        if conn.out:
+            self.reactor.add_writer(conn.sock, self._writable, conn)
+        else:
+            self.reactor.remove_writer(conn.sock)
+            if conn.closing:
+                self._close(conn)
+
+    def _writable(self, conn):
+        self._flush(conn)
+        # If it is behind, top the buffer back up once it has half drained
+        if not conn.closed and conn.behind_since is not None and \
+                conn.out_bytes < self.buffer_bytes // 2:
+            self._fill(conn)
+
+    def _close(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        self.reactor.remove_reader(conn.sock)
+        self.reactor.remove_writer(conn.sock)
+        conn.sock.close()
+        self.connections.discard(conn)
+
+
+class _Socket(object):
+
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    def send(self, data):
+        self.sent.append(data)
+        return len(data)
+
+    def close(self):
+        self.closed = True
+
+class TestStreamHello(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        certfile, keyfile = _make_test_cert(self.directory)
+        self.events = EventList()
+        self.server = StreamServer(self.events.log, ("127.0.0.1", 0),
+                                   certfile, keyfile)
+        self.conn = _StreamConnection(_Socket(), None)
+        self.server.connections.add(self.conn)
+
+    def tearDown(self):
+        self.server._stop()
+        shutil.rmtree(self.directory)
+
+    def received(self):
+        reader = FrameReader()
+        return [json.loads(frame)
+                for frame in reader.feed("".join(self.conn.sock.sent))]
+
+    def assertRefused(self, message):
+        self.assertEquals(self.received(), [{"error": message}])
+        self.assertTrue(self.conn.closed)
+        self.assertTrue(self.conn.sock.closed)
+
+    def test_hello(self):
+        self.events.append(type="test")
+        self.events.append(type="test")
+        data = pack_frame(json.dumps({"format": "json", "cursor": "1"}))
+        self.server._receive_hello(self.conn, data[:3])
+        self.server._receive_hello(self.conn, data[3:-1])
+        self.assertEquals(self.conn.sock.sent, [])
+        self.server._receive_hello(self.conn, data[-1:])
+        frames = self.received()
+        self.assertEquals(len(frames), 1)
+        self.assertEquals(frames[0]["cursor"], "2")
+        self.assertEquals([e["seq"] for e in frames[0]["events"]], ["2"])
+        self.assertFalse(self.conn.closed)
+
+    def test_not_an_object(self):
+        self.server._receive_hello(self.conn, pack_frame("[1]"))
+        self.assertRefused("Hello is not a JSON object.")
+
+    def test_not_json(self):
+        self.server._receive_hello(self.conn, pack_frame("{cursor"))
+        self.assertRefused("Hello is not a JSON object.")
+
+    def test_unknown_format(self):
+        self.server._receive_hello(self.conn, pack_frame('{"format": "xml"}'))
+        self.assertRefused('Unknown format "xml".')
+
+    def test_no_filters(self):
+        self.server._receive_hello(self.conn, pack_frame(
+            '{"filter": {"channels": {}}}'))
+        self.assertRefused("Filters are not supported.")
+
+    def test_too_long(self):
+        # Refused once more than MAX_HELLO_BYTES arrive, before the frame
+        # is complete
+        data = pack_frame(json.dumps({"cursor": "0",
+                                      "pad": "x" * MAX_HELLO_BYTES}))
+        self.server._receive_hello(self.conn, data[:MAX_HELLO_BYTES])
+        self.assertEquals(self.conn.sock.sent, [])
+        self.server._receive_hello(self.conn, data[MAX_HELLO_BYTES:])
+        self.assertRefused("Hello is too long.")
+
+    def test_too_long_at_once(self):
+        self.server._receive_hello(self.conn, pack_frame(json.dumps(
+            {"cursor": "0", "pad": "x" * MAX_HELLO_BYTES})))
+        self.assertRefused("Hello is too long.")
+
+    def test_too_long_frame(self):
+        self.server._receive_hello(self.conn,
+                                   FRAME_HEADER.pack(MAX_FRAME_BYTES + 1))
+        self.assertRefused("Hello is too long.")
+
+if __name__ == '__main__':
+    unittest.main()
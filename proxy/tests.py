@@ -93,6 +93,13 @@ class ProxyXMLRPCTestCase(unittest.TestCase):
         if not self.get_matching_events(event, limit=1, since=since):
             self.fail("No event matching: %s" % event)
 
+    def waitForMatchingEvent(self, event, since=0, timeout=30):
+        end = time.time() + timeout
+        while not self.get_matching_events(event, limit=1, since=since):
+            if time.time() > end:
+                self.fail("No event matching within %ss: %s" % (timeout, event))
+            time.sleep(0.1)
+
     def assertNoMatchingEvent(self, event, since=0):
         if self.get_matching_events(event, limit=1, since=since):
             self.fail("Matching event was found: %s" % event)
@@ -112,13 +119,15 @@ class ProxyXMLRPCTestCase(unittest.TestCase):
                             port=IRC_SERVER_PORT):
 
         t = time.time()
-        self.proxy.server_connect(server_name, nick_name, uri, port)
+        state = self.proxy.server_connect(server_name, nick_name, uri, port)
+        self.assertEquals(state, "connecting")
         servers = self.proxy.server_list()
         self.assertTrue(server_name in servers)
-        self.assertMatchingEvent({
+        self.waitForMatchingEvent({
             'type': 'server_connect',
             'server': server_name,
         }, since=t)
+        self.assertEquals(self.proxy.server_state(server_name), "connected")
 
     def assertConnectFails(self, server_name, nick_name, uri=IRC_SERVER_ADDRESS,
                             port=IRC_SERVER_PORT):
@@ -268,6 +277,22 @@ class ProxyXMLRPCTestCase(unittest.TestCase):
         self.assertConnectWorks("server1", "pirc_test_user1")
         self.assertDisconnectWorks("server1", "kthxbye")
 
+    def test_server_connect_unreachable(self):
+
+        # Returns right away, then fails in the background
+        t = time.time()
+        self.proxy.server_connect("server1", "pirc_test_user1", "127.0.0.1", 1)
+        self.assertTrue(time.time() - t < 1)
+        self.assertMatchingEvent({
+            'type': 'server_connecting',
+            'server': "server1",
+        }, since=t)
+        self.waitForMatchingEvent({
+            'type': 'server_connect_failed',
+            'server': "server1",
+        }, since=t, timeout=120)
+        self.assertFalse("server1" in self.proxy.server_list())
+
     def test_channel_join_leave(self):
 
         #XXX
@@ -1,4 +1,8 @@
 
+import random
+import time
+import unittest
+
 from errors import ServerError
 
 def type_check(var_name, var_value, *var_types):
@@ -12,3 +16,95 @@ def type_check(var_name, var_value, *var_types):
         'Value was: %s"' % (var_type, var_name, type(var_value),
         var_value))
 
+def parse_cursor(var_name, cursor):
+    '''Return the sequence number in cursor.
+
+    Cursors are sent as strings of decimal digits, because XMLRPC integers
+    are only 32 bits, but small ones are accepted as integers too.  Raises a
+    ServerError if cursor isn't a valid cursor.
+
+    '''
+    type_check(var_name, cursor, basestring, int)
+    try:
+        seq = int(cursor)
+    except ValueError:
+        raise ServerError('Invalid cursor "%s".' % cursor)
+    if seq < 0:
+        raise ServerError("%s must be a positive number." % var_name)
+    return seq
+
+def backoff_delay(attempt, base, maximum):
+    '''Seconds to wait before retry number `attempt` (starting at 0).
+
+    The delay doubles with each attempt up to `maximum`, and is then jittered
+    to between half and all of that, so clients that failed together don't
+    all retry together.
+
+    '''
+    delay = min(maximum, base * 2 ** attempt)
+    return random.uniform(delay / 2.0, delay)
+
+class TokenBucket(object):
+    '''Rate limiter allowing `rate` operations per second, in bursts of up to
+    `burst` operations.'''
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, tokens=1):
+        '''Take tokens if they are available.  Returns True if they were.'''
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens=1):
+        '''Seconds until `tokens` tokens will be available.'''
+        self._refill()
+        return max(0, (tokens - self.tokens) / self.rate)
+
+
+class TestTools(unittest.TestCase):
+
+    def test_backoff_delay(self):
+        for attempt in xrange(40):
+            delay = min(30, 2 ** attempt)
+            for i in xrange(20):
+                self.assertTrue(delay / 2.0 <= backoff_delay(attempt, 1, 30)
+                                <= delay)
+        delays = set(backoff_delay(10, 1, 30) for i in xrange(20))
+        self.assertTrue(len(delays) > 1, "Delays aren't jittered")
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(2, 3)
+        self.assertEquals([bucket.consume() for i in xrange(4)],
+                          [True, True, True, False])
+        self.assertTrue(0.4 < bucket.delay() <= 0.5)
+        self.assertTrue(1.4 < bucket.delay(3) <= 1.5)
+
+        bucket.updated -= 1  # A second later
+        self.assertTrue(bucket.consume(2))
+        self.assertFalse(bucket.consume())
+
+        bucket.updated -= 60  # Never more than the burst
+        self.assertTrue(bucket.consume(3))
+        self.assertFalse(bucket.consume())
+
+    def test_parse_cursor(self):
+        self.assertEquals(parse_cursor("cursor", "12345678901"), 12345678901)
+        self.assertEquals(parse_cursor("cursor", 5), 5)
+        for cursor in ["x", "-1", -1, 1.5]:
+            self.assertRaises(ServerError, parse_cursor, "cursor", cursor)
+
+if __name__ == '__main__':
+    unittest.main()
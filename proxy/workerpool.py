@@ -0,0 +1,135 @@
+
+import sys
+import threading
+import traceback
+import unittest
+from Queue import Queue, Full, Empty
+from StringIO import StringIO
+
+class WorkerPool(object):
+    '''A fixed number of threads that run jobs from a bounded queue.'''
+
+    def __init__(self, size, queue_depth):
+        '''
+        :param size:
+            Number of worker threads.
+
+        :param queue_depth:
+            Maximum number of jobs waiting for a free worker.  `submit` refuses
+            jobs beyond this.  It must be at least 1, so the queue is always
+            bounded.
+
+        '''
+        if size < 1:
+            raise ValueError("size must be at least 1, not %s." % size)
+        if queue_depth < 1:
+            raise ValueError("queue_depth must be at least 1, not %s." %
+                             queue_depth)
+        self._jobs = Queue(queue_depth)
+        self._closed = False
+        self._threads = []
+        for i in xrange(size):
+            thread = threading.Thread(target=self._work,
+                                      name="worker-%s" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args):
+        '''Queue func(*args) to be run by a worker.
+
+        :returns:
+            True if the job was queued, False if the queue is full, or the
+            pool has been shut down.
+
+        '''
+        if self._closed:
+            return False
+        try:
+            self._jobs.put_nowait((func, args))
+        except Full:
+            return False
+        return True
+
+    def shutdown(self):
+        '''Stop the workers once they have run the jobs already queued, and
+        wait for them to finish.'''
+        if self._closed:
+            return
+        self._closed = True
+        for thread in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            func, args = job
+            try:
+                func(*args)
+            except Exception:
+                #TODO: Log
+                traceback.print_exc()
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = WorkerPool(2, 2)
+        self.results = Queue()
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_run(self):
+        for i in xrange(2):
+            self.assertTrue(self.pool.submit(self.results.put, i))
+        self.assertEquals(sorted([self.results.get(timeout=5),
+                                  self.results.get(timeout=5)]), [0, 1])
+
+    def test_full(self):
+        release = threading.Event()
+        def block(i):
+            self.results.put(i)
+            release.wait()
+        for i in xrange(2):
+            self.assertTrue(self.pool.submit(block, i))
+        for i in xrange(2):
+            self.results.get(timeout=5)  # Both workers are busy
+        self.assertTrue(self.pool.submit(self.results.put, "a"))
+        self.assertTrue(self.pool.submit(self.results.put, "b"))
+        self.assertFalse(self.pool.submit(self.results.put, "c"))
+
+        release.set()
+        self.assertEquals(sorted([self.results.get(timeout=5),
+                                  self.results.get(timeout=5)]), ["a", "b"])
+        self.assertRaises(Empty, self.results.get, timeout=0.05)
+
+    def test_shutdown(self):
+        self.pool.submit(self.results.put, "queued")
+        self.pool.shutdown()
+        self.assertEquals(self.results.get_nowait(), "queued")
+        self.assertFalse(any(thread.is_alive()
+                             for thread in self.pool._threads))
+        self.assertFalse(self.pool.submit(self.results.put, "late"))
+
+    def test_errors(self):
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            self.pool.submit(lambda: 1/0)
+            self.pool.submit(self.results.put, "after")
+            self.assertEquals(self.results.get(timeout=5), "after")
+            self.pool.shutdown()
+            self.assertTrue("ZeroDivisionError" in sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+
+    def test_bounded(self):
+        self.assertRaises(ValueError, WorkerPool, 2, 0)
+        self.assertRaises(ValueError, WorkerPool, 0, 2)
+
+if __name__ == '__main__':
+    unittest.main()
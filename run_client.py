@@ -14,6 +14,8 @@ if __name__ == "__main__":
             ("accepted_certs_file", basestring, None),
             ("proxy_address", basestring, "http://localhost"),
             ("proxy_port", int, 2939),
+            ("proxy_stream_port", int, None),
+            ("proxy_format", basestring, "json"),
         ])
     except conf.ConfigError as e:
         print "Error in configuration:", e
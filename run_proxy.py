@@ -11,10 +11,40 @@ if __name__ == "__main__":
             ("accepted_certs_file", basestring, None),
             ("bind_address", basestring, "0.0.0.0"),
             ("bind_port", int, 2939),
+            ("xmlrpc_workers", int, 0),
+            ("xmlrpc_queue_depth", int, 16),
+            ("xmlrpc_idle_timeout", (int, float), 60),
+            ("xmlrpc_compress_threshold", int, 4096),
+            ("engine", basestring, "reactor"),
+            ("reconnect_max_concurrent", int, 4),
+            ("reconnect_max_per_second", (int, float), 2),
+            ("flood_control", dict, {"burst": 5, "rate": 0.5}),
+            ("server_flood_control", dict, {}),
+            ("event_retention", dict, {"max_events": 10000}),
+            ("server_event_retention", dict, {}),
+            ("channel_event_retention", dict, {}),
+            ("event_eviction_sink", config.ANY_TYPE, None),
+            ("event_log_dir", basestring, None),
+            ("event_log_segment_bytes", (int, long), 16*1024*1024),
+            ("event_log_max_bytes", (int, long), None),
+            ("event_cache_bytes", (int, long), 32*1024*1024),
+            ("archive_file", basestring, None),
+            ("stream_port", int, None),
+            ("stream_buffer_bytes", int, 1024*1024),
+            ("stream_slow_consumer", basestring, "drop"),
+            ("stream_stall_timeout", (int, float), 30),
+            ("session_max_backlog", int, None),
+            ("session_idle_timeout", (int, float), 7*24*60*60),
         ])
     except conf.ConfigError as e:
         raise #TODO
 
-    proxy = IRCProxyServer(conf)
+    if conf.engine == "asyncio":
+        from proxy.asyncengine import AsyncIRCProxyServer
+        proxy = AsyncIRCProxyServer(conf)
+    elif conf.engine == "reactor":
+        proxy = IRCProxyServer(conf)
+    else:
+        raise config.ConfigError('Unknown engine "%s".' % conf.engine)
     proxy._run()
 